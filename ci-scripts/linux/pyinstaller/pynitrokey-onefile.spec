@@ -24,7 +24,16 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=datas,
-    hiddenimports=[],
+    # subcommands are imported lazily by pynitrokey.cli
+    hiddenimports=[
+        'pynitrokey.cli.fido2',
+        'pynitrokey.cli.nethsm',
+        'pynitrokey.cli.nk3',
+        'pynitrokey.cli.nkpk',
+        'pynitrokey.cli.pro',
+        'pynitrokey.cli.start',
+        'pynitrokey.cli.storage',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -26,7 +26,16 @@ a = Analysis(
         ('..\\..\\..\\venv\\Lib\\site-packages\\usb1\\libusb-1.0.dll', '.')
     ],
     datas=datas,
-    hiddenimports=[],
+    # subcommands are imported lazily by pynitrokey.cli
+    hiddenimports=[
+        'pynitrokey.cli.fido2',
+        'pynitrokey.cli.nethsm',
+        'pynitrokey.cli.nk3',
+        'pynitrokey.cli.nkpk',
+        'pynitrokey.cli.pro',
+        'pynitrokey.cli.start',
+        'pynitrokey.cli.storage',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
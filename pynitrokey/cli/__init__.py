@@ -4,26 +4,21 @@
 
 import logging
 import os
-import platform
 import sys
 import warnings
 from datetime import datetime
-from importlib.metadata import version as package_version
 
 import click
 
 import pynitrokey
-import pynitrokey.fido2.operations
 from pynitrokey.cli.exceptions import CliException
-from pynitrokey.cli.fido2 import fido2
-from pynitrokey.cli.nethsm import nethsm
-from pynitrokey.cli.nk3 import nk3
-from pynitrokey.cli.nkpk import nkpk
-from pynitrokey.cli.pro import pro
-from pynitrokey.cli.start import start
-from pynitrokey.cli.storage import storage
-from pynitrokey.confconsts import LOG_FN, LOG_FORMAT
-from pynitrokey.helpers import filter_sensitive_parameters, local_critical
+from pynitrokey.cli.lazy import LazyGroup
+from pynitrokey.confconsts import LOG_FN, LOG_FORMAT, VERBOSE, Verbosity
+from pynitrokey.helpers import (
+    filter_sensitive_parameters,
+    local_critical,
+    log_environment,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -49,24 +44,17 @@ def check_root():
             print()
 
 
-@click.group(context_settings={"help_option_names": ["-h", "--help"]})
+@click.group(cls=LazyGroup, context_settings={"help_option_names": ["-h", "--help"]})
 def nitropy():
     handler = logging.FileHandler(filename=LOG_FN, delay=True, encoding="utf-8")
     logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG, handlers=[handler])
 
     logger.info(f"Timestamp: {datetime.now()}")
-    logger.info(f"OS: {platform.uname()}")
-    logger.info(f"Python version: {platform.python_version()}")
     logger.info(f"Cli arguments: {filter_sensitive_parameters(sys.argv[1:])}")
-    pymodules = [
-        "pynitrokey",
-        "cryptography",
-        "ecdsa",
-        "fido2",
-        "pyusb",
-    ]
-    for x in pymodules:
-        logger.info(f"{x} version: {package_version(x)}")
+    # The environment information is only needed for error reports and is
+    # logged by local_critical, see log_environment.
+    if VERBOSE == Verbosity.debug:
+        log_environment()
 
     print(
         f"Command line tool to interact with Nitrokey devices {pynitrokey.__version__}",
@@ -76,17 +64,43 @@ def nitropy():
     check_root()
 
 
-from . import nkfido2
-
-nkfido2.add_commands(fido2)
-
-nitropy.add_command(fido2)
-nitropy.add_command(nethsm)
-nitropy.add_command(nk3)
-nitropy.add_command(nkpk)
-nitropy.add_command(start)
-nitropy.add_command(storage)
-nitropy.add_command(pro)
+# The subcommand modules pull in heavy dependencies (fido2, pyusb, the NetHSM
+# SDK, ...), so they are only imported once the subcommand is invoked.
+nitropy.add_lazy_command(
+    "fido2",
+    "pynitrokey.cli.fido2:fido2",
+    "Interact with Nitrokey FIDO2 devices, see subcommands.",
+)
+nitropy.add_lazy_command(
+    "nethsm",
+    "pynitrokey.cli.nethsm:nethsm",
+    "Interact with NetHSM devices, see subcommands.",
+)
+nitropy.add_lazy_command(
+    "nk3",
+    "pynitrokey.cli.nk3:nk3",
+    "Interact with Nitrokey 3 devices, see subcommands.",
+)
+nitropy.add_lazy_command(
+    "nkpk",
+    "pynitrokey.cli.nkpk:nkpk",
+    "Interact with Nitrokey Passkey devices, see subcommands.",
+)
+nitropy.add_lazy_command(
+    "pro",
+    "pynitrokey.cli.pro:pro",
+    "Interact with Nitrokey Pro devices, see subcommands.",
+)
+nitropy.add_lazy_command(
+    "start",
+    "pynitrokey.cli.start:start",
+    "Interact with Nitrokey Start devices, see subcommands.",
+)
+nitropy.add_lazy_command(
+    "storage",
+    "pynitrokey.cli.storage:storage",
+    "Interact with Nitrokey Storage devices, see subcommands.",
+)
 
 
 @click.command()
@@ -99,8 +113,10 @@ nitropy.add_command(version)
 
 
 def _list():
+    from .fido2 import fido2
     from .nk3 import _list as list_nk3
     from .nkpk import _list as list_nkpk
+    from .start import start
 
     fido2.commands["list"].callback()
     start.commands["list"].callback()
@@ -657,3 +657,7 @@ fido2.add_command(reset)
 fido2.add_command(set_pin)
 fido2.add_command(verify)
 fido2.add_command(wink)
+
+from . import nkfido2  # noqa: E402
+
+nkfido2.add_commands(fido2)
@@ -0,0 +1,69 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+import importlib
+from typing import Any, Optional
+
+import click
+
+
+class LazyGroup(click.Group):
+    """
+    A click group that imports the module of a subcommand only when the
+    subcommand is resolved.
+
+    Lazy subcommands are registered with the import path of the command object
+    (``module:attribute``) and the short help text that is shown in the command
+    listing, so that showing the help of the group does not import any of the
+    subcommand modules.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        lazy_commands: Optional[dict[str, tuple[str, str]]] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazy_commands: dict[str, tuple[str, str]] = lazy_commands or {}
+
+    def add_lazy_command(self, name: str, import_path: str, short_help: str) -> None:
+        self.lazy_commands[name] = (import_path, short_help)
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            self.add_command(self.load_command(cmd_name), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def load_command(self, cmd_name: str) -> click.Command:
+        import_path, _ = self.lazy_commands[cmd_name]
+        module_name, attribute = import_path.split(":", maxsplit=1)
+        module = importlib.import_module(module_name)
+        command = getattr(module, attribute)
+        if not isinstance(command, click.Command):
+            raise ValueError(f"{import_path} is not a click command")
+        return command
+
+    def format_commands(
+        self, ctx: click.Context, formatter: click.HelpFormatter
+    ) -> None:
+        names = self.list_commands(ctx)
+        limit = formatter.width - 6 - max(len(name) for name in names)
+
+        rows = []
+        for name in names:
+            if name in self.commands:
+                command = self.commands[name]
+                if command.hidden:
+                    continue
+                rows.append((name, command.get_short_help_str(limit)))
+            else:
+                _, short_help = self.lazy_commands[name]
+                rows.append((name, short_help))
+
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
@@ -3,24 +3,41 @@
 
 import base64
 import contextlib
+import csv
 import datetime
 import json
 import mimetypes
 import os
 import os.path
 import sys
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field, replace
 from enum import Enum
-from typing import Any, Iterable, Iterator, Optional, Protocol, Sequence
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Protocol,
+    Sequence,
+    TextIO,
+)
 
 import click
 import nethsm as nethsm_sdk
 from click import Context
 from nethsm import Authentication, Base64, NetHSM, State
-from nethsm.backup import EncryptedBackup
 
 from pynitrokey.cli.exceptions import CliException
-from pynitrokey.helpers import prompt
+from pynitrokey.helpers import daemonize, prompt
+from pynitrokey.nethsm import agent as nethsm_agent
+from pynitrokey.nethsm import backup as nethsm_backup
+from pynitrokey.nethsm import bulk
+from pynitrokey.nethsm import cache as nethsm_cache
+from pynitrokey.nethsm import fanout, manifest
+from pynitrokey.nethsm import metrics as nethsm_metrics
 
 
 class EnumMeta(Protocol):
@@ -46,16 +63,32 @@ MECHANISM_TYPE = make_enum_type(nethsm_sdk.KeyMechanism)
 ENCRYPT_MODE_TYPE = make_enum_type(nethsm_sdk.EncryptMode)
 DECRYPT_MODE_TYPE = make_enum_type(nethsm_sdk.DecryptMode)
 SIGN_MODE_TYPE = make_enum_type(nethsm_sdk.SignMode)
+BULK_FORMAT_TYPE = make_enum_type(bulk.InputFormat)
+MANIFEST_FORMAT_TYPE = make_enum_type(manifest.ManifestFormat)
+
+
+def check_interactive(msg: str) -> None:
+    if fanout.is_worker():
+        raise click.UsageError(
+            f"Cannot prompt for {msg!r} when running on multiple hosts, please "
+            "set the corresponding option"
+        )
 
 
 def prompt_str(
     msg: str, default: Optional[str] = None, hide_input: bool = False
 ) -> str:
+    check_interactive(msg)
     value = prompt(msg, default=default, hide_input=hide_input)
     assert isinstance(value, str)
     return value
 
 
+def confirm(msg: str) -> bool:
+    check_interactive(msg)
+    return click.confirm(msg)
+
+
 def print_row(values: Iterable[str], widths: Iterable[int]) -> None:
     row = [value.ljust(width) for (value, width) in zip(values, widths)]
     print(*row, sep="\t")
@@ -78,16 +111,207 @@ def print_table(headers: Sequence[str], data: Iterable[Sequence[Any]]) -> None:
         print_row(row, widths)
 
 
+OUTPUT_FORMAT_TYPE = click.Choice(["table", "csv", "json"], case_sensitive=False)
+
+
+def format_value(value: Any) -> str:
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(v) for v in value)
+    return str(value)
+
+
+def print_data(
+    format: str,
+    headers: Sequence[str],
+    fields: Sequence[str],
+    data: Iterable[Sequence[Any]],
+) -> None:
+    """Print rows in the given output format.
+
+    The table format needs all rows to compute the column widths.  The CSV
+    and JSON formats are written row by row as the data is produced, using
+    the headers as the CSV header and the fields as the JSON keys."""
+    format = format.lower()
+    if format == "table":
+        print_table(headers, [[format_value(v) for v in row] for row in data])
+    elif format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(headers)
+        for row in data:
+            writer.writerow([format_value(v) for v in row])
+            sys.stdout.flush()
+    elif format == "json":
+        separator = "\n"
+        print("[", end="")
+        for row in data:
+            print(separator + "  " + json.dumps(dict(zip(fields, row))), end="")
+            sys.stdout.flush()
+            separator = ",\n"
+        print("\n]")
+    else:
+        raise ValueError(f"Unsupported output format {format}")
+
+
+def output_format_option(f: Callable[..., Any]) -> Callable[..., Any]:
+    return click.option(
+        "--format",
+        "output_format",
+        type=OUTPUT_FORMAT_TYPE,
+        default="table",
+        show_default=True,
+        help="The output format",
+    )(f)
+
+
+def jobs_option(f: Callable[..., Any]) -> Callable[..., Any]:
+    return click.option(
+        "-j",
+        "--jobs",
+        type=click.IntRange(min=1),
+        default=8,
+        show_default=True,
+        help="The maximum number of concurrent requests",
+    )(f)
+
+
 @dataclass
 class Config:
     host: Optional[str]
     username: Optional[str]
     password: Optional[str]
     verify_tls: bool
+    use_agent: bool = True
+    cache_ttl: int = nethsm_cache.DEFAULT_TTL
+    refresh: bool = False
+    hosts: list[str] = field(default_factory=list)
+    host_jobs: int = fanout.DEFAULT_JOBS
+    results_format: str = "table"
+
+
+def summarize_error(error: str, width: int = 60) -> str:
+    line = error.splitlines()[0]
+    return line if len(line) <= width else line[: width - 3] + "..."
+
+
+def print_host_results(results: list[fanout.HostResult], format: str) -> None:
+    """Print the results of a command run on multiple hosts, either as one
+    JSON document or as the output of every host and a summary table."""
+    if format == "json":
+        print(json.dumps([result.to_json() for result in results], indent=2))
+        return
+
+    for result in results:
+        status = "ok" if result.ok else "failed"
+        print(f"=== {result.host} ({status}, {result.latency:.3f} s)")
+        if result.output:
+            print(result.output.rstrip("\n"))
+        if result.error:
+            print(f"Error: {result.error}")
+        print()
+
+    print_table(
+        ["Host", "Status", "Latency", "Error"],
+        [
+            [
+                result.host,
+                "ok" if result.ok else "failed",
+                f"{result.latency:.3f} s",
+                summarize_error(result.error) if result.error else "",
+            ]
+            for result in results
+        ],
+    )
 
 
-@click.group()
+class FanOutCommand(click.Command):
+    """A NetHSM command that is executed concurrently for every host if
+    multiple hosts are set with --hosts or --inventory.
+
+    Commands that do not connect to a NetHSM or that cannot be run per host,
+    e. g. because they consume stdin, are created with fan_out=False."""
+
+    def __init__(self, *args: Any, fan_out: bool = True, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.fan_out = fan_out
+
+    def invoke(self, ctx: Context) -> Any:
+        config = ctx.obj
+        if not isinstance(config, Config) or not config.hosts or not self.fan_out:
+            return super().invoke(ctx)
+
+        # Workers cannot prompt, so ask for the password once for all hosts
+        if config.username and not config.password:
+            if not config.use_agent or any(
+                nethsm_agent.find(host, config.username) is None
+                for host in config.hosts
+            ):
+                config.password = prompt_str(
+                    f"[auth] Password for user {config.username} on the NetHSMs",
+                    hide_input=True,
+                )
+
+        def run(host: str) -> None:
+            host_config = replace(config, host=host, hosts=[])
+            host_ctx = Context(
+                self, info_name=ctx.info_name, parent=ctx.parent, obj=host_config
+            )
+            host_ctx.params = dict(ctx.params)
+            try:
+                with host_ctx:
+                    super(FanOutCommand, self).invoke(host_ctx)
+            except click.exceptions.Exit as e:
+                if e.exit_code:
+                    raise fanout.HostError(f"Exit code {e.exit_code}")
+            except click.ClickException as e:
+                raise fanout.HostError(e.format_message())
+            except CliException as e:
+                raise fanout.HostError(str(e))
+            except SystemExit as e:
+                if e.code:
+                    raise fanout.HostError(f"Exit code {e.code}")
+
+        results = fanout.run(config.hosts, run, config.host_jobs)
+        print_host_results(results, config.results_format)
+
+        failed = sum(1 for result in results if not result.ok)
+        if failed:
+            raise click.ClickException(
+                f"{ctx.info_name} failed on {failed} of {len(results)} hosts"
+            )
+
+
+class FanOutGroup(click.Group):
+    command_class = FanOutCommand
+
+
+@click.group(cls=FanOutGroup)
 @click.option("-h", "--host", "host", help="Set the host of the NetHSM API")
+@click.option(
+    "--hosts",
+    "host_list",
+    multiple=True,
+    help="Run the command on multiple hosts, separated by commas (can be repeated)",
+)
+@click.option(
+    "--inventory",
+    type=click.File("r"),
+    help="Run the command on the hosts listed in this file, one per line",
+)
+@click.option(
+    "--host-jobs",
+    type=click.IntRange(min=1),
+    default=fanout.DEFAULT_JOBS,
+    show_default=True,
+    help="The maximum number of hosts to run the command on concurrently",
+)
+@click.option(
+    "--results",
+    "results_format",
+    type=click.Choice(["table", "json"]),
+    default="table",
+    show_default=True,
+    help="The format of the aggregated results for multiple hosts",
+)
 @click.option("-u", "--username", "username", help="The NetHSM user name")
 @click.option("-p", "--password", "password", help="The NetHSM password")
 @click.option(
@@ -95,6 +319,24 @@ class Config:
     default=True,
     help="Whether to verify the TLS certificate of the NetHSM",
 )
+@click.option(
+    "--agent/--no-agent",
+    "use_agent",
+    default=True,
+    help="Whether to use a running NetHSM agent for the host and user, see the agent command",
+)
+@click.option(
+    "--cache-ttl",
+    type=click.IntRange(min=0),
+    default=nethsm_cache.DEFAULT_TTL,
+    show_default=True,
+    help="How long key metadata and public keys are cached, in seconds (0 disables the cache)",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Ignore cached key metadata and query the NetHSM",
+)
 @click.pass_context
 def nethsm(
     ctx: Context,
@@ -102,19 +344,46 @@ def nethsm(
     username: Optional[str],
     password: Optional[str],
     verify_tls: bool,
+    use_agent: bool,
+    cache_ttl: int,
+    refresh: bool,
+    host_list: tuple[str, ...],
+    inventory: Optional[TextIO],
+    host_jobs: int,
+    results_format: str,
 ) -> None:
-    """Interact with NetHSM devices, see subcommands."""
+    """Interact with NetHSM devices, see subcommands.
+
+    With the --hosts or --inventory option, the command is run concurrently
+    on all hosts and the output, latency and errors of every host are
+    reported.  In this mode, all values that are usually prompted for must be
+    set with options, except for the password."""
+
+    hosts = [h.strip() for hosts in host_list for h in hosts.split(",") if h.strip()]
+    if inventory:
+        hosts += fanout.read_inventory(inventory)
+    if hosts and host:
+        raise click.UsageError("--host cannot be combined with --hosts or --inventory")
 
     ctx.obj = Config(
-        host=host, username=username, password=password, verify_tls=verify_tls
+        host=host,
+        username=username,
+        password=password,
+        verify_tls=verify_tls,
+        use_agent=use_agent,
+        cache_ttl=cache_ttl,
+        refresh=refresh,
+        hosts=hosts,
+        host_jobs=host_jobs,
+        results_format=results_format,
     )
 
 
-@contextlib.contextmanager
-def connect(ctx: Context, require_auth: bool = True) -> Iterator[NetHSM]:
-    config = ctx.obj
-    assert isinstance(config, Config)
-
+def get_host(config: Config) -> str:
+    if config.hosts:
+        raise CliException(
+            "This command cannot be run on multiple hosts", support_hint=False
+        )
     host = config.host
     if host is None:
         v = "NETHSM_HOST"
@@ -125,21 +394,53 @@ def connect(ctx: Context, require_auth: bool = True) -> Iterator[NetHSM]:
                 support_hint=False,
             )
         host = os.environ[v]
+    return host
+
+
+def get_auth(config: Config, host: str) -> Authentication:
+    username = config.username
+    password = config.password
+    if not username:
+        username = prompt_str(f"[auth] User name for NetHSM {host}")
+    if not password:
+        password = prompt_str(
+            f"[auth] Password for user {username} on NetHSM {host}",
+            hide_input=True,
+        )
+    return Authentication(username=username, password=password)
+
+
+@contextlib.contextmanager
+def connect(
+    ctx: Context, require_auth: bool = True, pool_size: Optional[int] = None
+) -> Iterator[NetHSM]:
+    """Connect to the NetHSM, or to the agent for the NetHSM if available.
+
+    If `pool_size` is set, up to this number of connections are kept open for
+    commands that send concurrent requests."""
+    config = ctx.obj
+    assert isinstance(config, Config)
+
+    host = get_host(config)
+
+    agent_info = None
+    if config.use_agent:
+        agent_info = nethsm_agent.find(host, config.username)
 
     auth = None
-    if require_auth:
-        username = config.username
-        password = config.password
-        if not username:
-            username = prompt_str(f"[auth] User name for NetHSM {host}")
-        if not password:
-            password = prompt_str(
-                f"[auth] Password for user {username} on NetHSM {host}",
-                hide_input=True,
-            )
-        auth = Authentication(username=username, password=password)
+    if agent_info:
+        # The agent replaces the credentials with the ones it has been
+        # started with, so we only have to tell the SDK to authenticate.
+        if require_auth:
+            auth = Authentication(username=agent_info.username, password="")
+    elif require_auth:
+        auth = get_auth(config, host)
 
     with nethsm_sdk.connect(host, auth=auth, verify_tls=config.verify_tls) as nethsm:
+        if pool_size:
+            bulk.set_pool_size(nethsm, pool_size)
+        if agent_info:
+            nethsm_agent.attach(nethsm, agent_info, maxsize=pool_size or 4)
         try:
             yield nethsm
         except nethsm_sdk.NetHSMError as e:
@@ -155,6 +456,108 @@ def connect(ctx: Context, require_auth: bool = True) -> Iterator[NetHSM]:
                 )
 
 
+@contextlib.contextmanager
+def key_cache(ctx: Context, nethsm: NetHSM) -> Iterator[nethsm_cache.KeyCache]:
+    """Open the key metadata cache for the host and namespace of the
+    connection and write back the changes when done."""
+    config = ctx.obj
+    assert isinstance(config, Config)
+
+    username = nethsm.auth.username if nethsm.auth else None
+    cache = nethsm_cache.KeyCache(
+        nethsm.host,
+        nethsm_cache.namespace(username),
+        ttl=config.cache_ttl,
+        refresh=config.refresh,
+    )
+    try:
+        yield cache
+    finally:
+        cache.save()
+
+
+def key_modes(
+    ctx: Context,
+    nethsm: NetHSM,
+    key_id: str,
+    mode_type: click.Choice,  # type: ignore[type-arg]
+    operation: str,
+) -> list[str]:
+    """Return the modes of `mode_type` that the key supports for the
+    operation (Signature, Encryption or Decryption).
+
+    The mechanisms of the key are read from the key metadata cache if
+    possible."""
+    with key_cache(ctx, nethsm) as cache:
+        key = cache.get_key(nethsm, key_id)
+
+    modes = []
+    for mechanism in key.mechanisms:
+        prefix, sep, suffix = mechanism.value.partition(f"_{operation}")
+        if not sep:
+            continue
+        suffix = suffix.lstrip("_")
+        if prefix == "RSA":
+            modes.append(suffix)
+        elif suffix:
+            modes.append(f"{prefix}_{suffix}")
+        else:
+            modes.append(prefix)
+    return [m for m in modes if m in mode_type.choices]
+
+
+def select_mode(
+    ctx: Context,
+    nethsm: NetHSM,
+    key_id: str,
+    mode: Optional[str],
+    mode_type: click.Choice,  # type: ignore[type-arg]
+    operation: str,
+) -> str:
+    """Return the given mode or the only mode of the key for the operation."""
+    if mode:
+        return mode
+
+    modes = key_modes(ctx, nethsm, key_id, mode_type, operation)
+    if len(modes) == 1:
+        return modes[0]
+    if not modes:
+        raise click.ClickException(
+            f"Key {key_id} does not support the {operation.lower()} operation"
+        )
+    raise click.ClickException(
+        f"Key {key_id} supports multiple modes, please set -m/--mode: "
+        + ", ".join(modes)
+    )
+
+
+def check_mode(
+    ctx: Context,
+    nethsm: NetHSM,
+    key_id: str,
+    mode: Optional[str],
+    mode_type: click.Choice,  # type: ignore[type-arg]
+    operation: str,
+) -> str:
+    """Return the given mode if the key supports it for the operation, or
+    prompt for one of the modes of the key, so that an unsupported mode is
+    rejected without sending a request to the NetHSM."""
+    modes = key_modes(ctx, nethsm, key_id, mode_type, operation)
+    if not modes:
+        raise click.ClickException(
+            f"Key {key_id} does not support the {operation.lower()} operation"
+        )
+    if mode is None:
+        check_interactive("Mode")
+        return str(click.prompt("Mode", type=click.Choice(modes)))
+    if mode.lower() not in [m.lower() for m in modes]:
+        raise click.ClickException(
+            f"Key {key_id} does not support the mode {mode}, supported modes: "
+            + ", ".join(modes)
+        )
+    return mode
+
+
 @nethsm.command()
 @click.argument("passphrase", required=False)
 @click.pass_context
@@ -237,29 +640,39 @@ def provision(
     default=True,
     help="Also query the real name and role of the user",
 )
+@jobs_option
+@output_format_option
 @click.pass_context
-def list_users(ctx: Context, details: bool) -> None:
+def list_users(ctx: Context, details: bool, jobs: int, output_format: str) -> None:
     """List all users on the NetHSM.
 
+    The details of the users are queried concurrently.
+
     This command requires authentication as a user with the Administrator
     role."""
-    with connect(ctx) as nethsm:
+    with connect(ctx, pool_size=jobs) as nethsm:
         user_ids = nethsm.list_users()
 
-        print(f"Users on NetHSM {nethsm.host}:")
-        print()
+        if output_format == "table":
+            print(f"Users on NetHSM {nethsm.host}:")
+            print()
 
         headers = ["User ID"]
+        fields = ["user_id"]
+        data: Iterable[Sequence[Any]]
         if details:
             headers += ["Real name", "Role"]
-            data = []
-            for user_id in user_ids:
+            fields += ["real_name", "role"]
+
+            def get_user(user_id: str) -> Sequence[Any]:
                 user = nethsm.get_user(user_id=user_id)
-                data.append([user_id, user.real_name, user.role.value])
+                return [user_id, user.real_name, user.role.value]
+
+            data = bulk.ordered_map(get_user, user_ids, jobs)
         else:
             data = [[user_id] for user_id in user_ids]
 
-        print_table(headers, data)
+        print_data(output_format, headers, fields, data)
 
 
 @nethsm.command()
@@ -480,7 +893,8 @@ def add_key_tag(ctx: Context, key_id: str, tag: str) -> None:
 
     This command requires authentication as a user with the Administrator
     role."""
-    with connect(ctx) as nethsm:
+    with connect(ctx) as nethsm, key_cache(ctx, nethsm) as cache:
+        cache.invalidate(key_id)
         nethsm.add_key_tag(key_id=key_id, tag=tag)
         print(f"Added tag {tag} for key {key_id} on the NetHSM {nethsm.host}")
 
@@ -494,7 +908,8 @@ def delete_key_tag(ctx: Context, key_id: str, tag: str) -> None:
 
     This command requires authentication as a user with the Administrator
     role."""
-    with connect(ctx) as nethsm:
+    with connect(ctx) as nethsm, key_cache(ctx, nethsm) as cache:
+        cache.invalidate(key_id)
         nethsm.delete_key_tag(key_id=key_id, tag=tag)
         print(f"Deleted tag {tag} for key {key_id} on the NetHSM {nethsm.host}")
 
@@ -520,26 +935,179 @@ def state(ctx: Context) -> None:
 
 
 @nethsm.command()
-@click.argument("length", type=int)
+@click.argument("length", type=click.IntRange(min=0))
+@click.option(
+    "--raw",
+    is_flag=True,
+    help="Write the random bytes as binary data instead of a Base64 string",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("wb"),
+    help="The file to write the binary data to (default: stdout)",
+)
+@jobs_option
 @click.pass_context
-def random(ctx: Context, length: int) -> None:
+def random(
+    ctx: Context, length: int, raw: bool, output: Optional[BinaryIO], jobs: int
+) -> None:
     """Retrieve random bytes from the NetHSM as a Base64 string.
 
+    With --raw, the random bytes are written as binary data to stdout or to
+    the output file.  LENGTH may then exceed the maximum of 1024 bytes of a
+    single request:  the data is retrieved in chunks with up to JOBS
+    concurrent requests over one connection.  If LENGTH is 0, random data is
+    streamed until the command is interrupted or the output is closed, e. g.
+    when piping into rngtest.  The throughput is printed to stderr.
+
     This command requires authentication as a user with the Operator role."""
-    with connect(ctx) as nethsm:
-        print(nethsm.get_random_data(length))
+    if not raw:
+        if output:
+            raise click.UsageError("-o/--output can only be used with --raw")
+        with connect(ctx) as nethsm:
+            print(nethsm.get_random_data(length).data)
+        return
+
+    if fanout.is_worker():
+        raise click.UsageError("--raw cannot be used with multiple hosts")
+    if output is None:
+        output = sys.stdout.buffer
+
+    with connect(ctx, pool_size=jobs) as nethsm:
+        start = time.monotonic()
+        size = 0
+        progress = bulk.Progress("Received")
+        try:
+            for data in bulk.random_stream(nethsm, length or None, jobs):
+                output.write(data)
+                size += len(data)
+                progress.update(size)
+            output.flush()
+        except BrokenPipeError:
+            # The reader has closed the pipe.  Redirect the output to devnull
+            # so that flushing it at exit does not fail again.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, output.fileno())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            progress.close()
+            bulk.report_throughput("Received", size, start)
 
 
 @nethsm.command()
+@click.option(
+    "-w",
+    "--watch",
+    is_flag=True,
+    help="Query the metrics periodically until interrupted",
+)
+@click.option(
+    "-n",
+    "--interval",
+    type=click.FloatRange(min=0.1),
+    default=15,
+    show_default=True,
+    help="The interval between two queries in seconds (with --watch)",
+)
+@click.option(
+    "--listen",
+    metavar="[HOST:]PORT",
+    help="Serve the metrics in the Prometheus text format at /metrics on this address (with --watch)",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("a"),
+    help="Append the metrics in the Prometheus text format to this file (with --watch)",
+)
 @click.pass_context
-def metrics(ctx: Context) -> None:
+def metrics(
+    ctx: Context,
+    watch: bool,
+    interval: float,
+    listen: Optional[str],
+    output: Optional[TextIO],
+) -> None:
     """Query the metrics of a NetHSM.
 
+    With --watch, the metrics are queried periodically over one connection
+    and the rates per second of the counters, e. g. the number of
+    requests, since the previous query are computed.  The results are printed as a table, or exported in the
+    Prometheus text format with --listen and/or --output.
+
     This command requires authentication as a user with the Metrics role."""
+    if not watch:
+        if listen or output:
+            raise click.UsageError("--listen and --output require --watch")
+        with connect(ctx) as nethsm:
+            headers = ["Metric", "Value"]
+            data = nethsm.get_metrics()
+            print_table(headers, [list(row) for row in sorted(data.items())])
+        return
+
+    if fanout.is_worker():
+        raise click.UsageError("--watch cannot be used with multiple hosts")
+
     with connect(ctx) as nethsm:
-        headers = ["Metric", "Value"]
-        data = nethsm.get_metrics()
-        print_table(headers, [list(row) for row in sorted(data.items())])
+        state = nethsm_metrics.MetricsState(nethsm.host)
+
+        server = None
+        if listen:
+            try:
+                address = nethsm_metrics.parse_listen_address(listen)
+                server = nethsm_metrics.MetricsServer(address, state)
+            except (ValueError, OSError) as e:
+                raise click.ClickException(f"Cannot listen on {listen}: {e}")
+            server.start()
+            host, port = address
+            print(
+                f"Serving metrics for NetHSM {nethsm.host} at "
+                f"http://{host}:{port}/metrics",
+                file=sys.stderr,
+            )
+
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    sample = state.update(nethsm.get_metrics())
+                except (
+                    nethsm_sdk.NetHSMError,
+                    nethsm_sdk.NetHSMRequestError,
+                ) as e:
+                    state.failed()
+                    print(f"Failed to query the metrics: {e}", file=sys.stderr)
+                else:
+                    if output:
+                        output.write(state.to_prometheus())
+                        output.flush()
+                    if not server and not output:
+                        print_table(
+                            ["Metric", "Value", "Rate (1/s)"],
+                            [
+                                [
+                                    name,
+                                    str(int(value))
+                                    if value.is_integer()
+                                    else str(value),
+                                    f"{sample.rates[name]:.2f}"
+                                    if name in sample.rates
+                                    else "",
+                                ]
+                                for name, value in sorted(sample.values.items())
+                            ],
+                        )
+                        print()
+                        sys.stdout.flush()
+                time.sleep(max(0.0, interval - (time.monotonic() - start)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
 
 
 @nethsm.command()
@@ -554,37 +1122,55 @@ def metrics(ctx: Context) -> None:
     type=str,
     help="Filter keys by tags for respective user",
 )
+@jobs_option
+@output_format_option
 @click.pass_context
-def list_keys(ctx: Context, details: bool, filter: Optional[str]) -> None:
+def list_keys(
+    ctx: Context,
+    details: bool,
+    filter: Optional[str],
+    jobs: int,
+    output_format: str,
+) -> None:
     """List all keys on the NetHSM.
 
+    The details of the keys are queried concurrently and cached, see the
+    --cache-ttl and --refresh options.  The operation counters of cached keys
+    can be outdated.
+
     This command requires authentication as a user with the Administrator or
     Operator role."""
-    with connect(ctx) as nethsm:
+    with connect(ctx, pool_size=jobs) as nethsm, key_cache(ctx, nethsm) as cache:
         key_ids = nethsm.list_keys(filter)
+        if not filter:
+            cache.retain(key_ids)
 
-        print(f"Keys on NetHSM {nethsm.host}:")
-        print()
+        if output_format == "table":
+            print(f"Keys on NetHSM {nethsm.host}:")
+            print()
 
         headers = ["Key ID"]
+        fields = ["key_id"]
+        data: Iterable[Sequence[Any]]
         if details:
             headers += ["Type", "Mechanisms", "Operations", "Tags"]
-            data = []
-            for key_id in key_ids:
-                key = nethsm.get_key(key_id=key_id)
-                data.append(
-                    [
-                        key_id,
-                        key.type.value,
-                        ", ".join([m.value for m in key.mechanisms]),
-                        key.operations,
-                        ", ".join(key.tags) if key.tags is not None else "",
-                    ]
-                )
+            fields += ["type", "mechanisms", "operations", "tags"]
+
+            def get_key(key_id: str) -> Sequence[Any]:
+                key = cache.get_key(nethsm, key_id)
+                return [
+                    key_id,
+                    key.type.value,
+                    [m.value for m in key.mechanisms],
+                    key.operations,
+                    key.tags or [],
+                ]
+
+            data = bulk.ordered_map(get_key, key_ids, jobs)
         else:
             data = [[key_id] for key_id in key_ids]
 
-        print_table(headers, data)
+        print_data(output_format, headers, fields, data)
 
 
 @nethsm.command()
@@ -594,13 +1180,18 @@ def list_keys(ctx: Context, details: bool, filter: Optional[str]) -> None:
 def get_key(ctx: Context, key_id: str, public_key: bool) -> None:
     """Get information about a key on the NetHSM.
 
+    The public key is read from the key metadata cache if available, see the
+    --cache-ttl and --refresh options.
+
     This command requires authentication as a user with the Administrator or
     Operator role."""
-    with connect(ctx) as nethsm:
+    with connect(ctx) as nethsm, key_cache(ctx, nethsm) as cache:
         if public_key:
-            print(nethsm.get_key_public_key(key_id))
+            print(cache.get_key_public_key(nethsm, key_id))
         else:
-            key = nethsm.get_key(key_id)
+            # Always query the key to show the current operation counter
+            cache.invalidate(key_id)
+            key = cache.get_key(nethsm, key_id)
             mechanisms = ", ".join([str(m.value) for m in key.mechanisms])
             print(f"Key {key_id} on NetHSM {nethsm.host}:")
             print(f"Type:            {key.type.value}")
@@ -627,25 +1218,35 @@ def delete_key(ctx: Context, key_id: str) -> None:
 
     This command requires authentication as a user with the Administrator
     role."""
-    with connect(ctx) as nethsm:
+    with connect(ctx) as nethsm, key_cache(ctx, nethsm) as cache:
+        cache.invalidate(key_id)
         nethsm.delete_key(key_id)
         print(f"Key {key_id} deleted on NetHSM {nethsm.host}")
 
 
-def prompt_mechanisms(type: str) -> list[str]:
+def key_mechanisms(type: str) -> list[str]:
+    """Return the mechanisms that are supported for a key type."""
     # We assume that key type X corresponds to the mechanisms starting with X.
     # This is no longer true for curves, so we have to adapt the type
     if type == nethsm_sdk.KeyType.CURVE25519.value:
         type = "EdDSA"
     elif type.startswith("EC_"):
         type = "ECDSA"
+    elif type == nethsm_sdk.KeyType.GENERIC.value:
+        type = "AES"
+
+    return [
+        mechanism.value
+        for mechanism in nethsm_sdk.KeyMechanism
+        if mechanism.value.startswith(type)
+    ]
+
 
-    available_mechanisms = []
+def prompt_mechanisms(type: str) -> list[str]:
+    available_mechanisms = key_mechanisms(type)
     print("Supported mechanisms for this key type:")
-    for mechanism in nethsm_sdk.KeyMechanism:
-        if mechanism.value.startswith(type):
-            available_mechanisms.append(mechanism.value)
-            print(f"  {mechanism.value}")
+    for mechanism in available_mechanisms:
+        print(f"  {mechanism}")
 
     # If there is only one matching algorithm, we can choose it and don’t have
     # to ask the user.
@@ -787,7 +1388,7 @@ def add_key(
             data = prompt_str("Key data")
         private_key = nethsm_sdk.GenericPrivateKey(data=base64_input(data))
 
-    with connect(ctx) as nethsm:
+    with connect(ctx) as nethsm, key_cache(ctx, nethsm) as cache:
         key_id = nethsm.add_key(
             key_id=key_id,
             type=key_type,
@@ -795,6 +1396,7 @@ def add_key(
             tags=tags,
             private_key=private_key,
         )
+        cache.invalidate(key_id)
         print(f"Key {key_id} added to NetHSM {nethsm.host}")
 
 
@@ -838,13 +1440,14 @@ def import_key(
     with open(filename) as f:
         private_key = f.read()
 
-    with connect(ctx) as nethsm:
+    with connect(ctx) as nethsm, key_cache(ctx, nethsm) as cache:
         key_id = nethsm.add_key_pem(
             key_id=key_id,
             mechanisms=[nethsm_sdk.KeyMechanism.from_string(m) for m in mechanisms],
             tags=tags,
             private_key=private_key,
         )
+        cache.invalidate(key_id)
         print(f"Key {key_id} added to NetHSM {nethsm.host}")
 
 
@@ -886,16 +1489,174 @@ def generate_key(
     This command requires authentication as a user with the Administrator
     role."""
     mechanisms = list(mechanisms) or prompt_mechanisms(type)
-    with connect(ctx) as nethsm:
+    with connect(ctx) as nethsm, key_cache(ctx, nethsm) as cache:
         key_id = nethsm.generate_key(
             nethsm_sdk.KeyType.from_string(type),
             [nethsm_sdk.KeyMechanism.from_string(m) for m in mechanisms],
             length,
             key_id,
         )
+        cache.invalidate(key_id)
         print(f"Key {key_id} generated on NetHSM {nethsm.host}")
 
 
+def resolve_mechanisms(spec: manifest.KeySpec) -> None:
+    """Set the mechanisms of a key specification to the only mechanism
+    supported by its type if they are not set in the manifest."""
+    if spec.mechanisms:
+        return
+    if spec.type is None:
+        raise click.ClickException(f"Missing mechanisms for key {spec.id}")
+    available = key_mechanisms(spec.type.value)
+    if len(available) != 1:
+        raise click.ClickException(
+            f"Missing mechanisms for key {spec.id}, supported mechanisms for "
+            f"{spec.type.value} keys: {', '.join(available)}"
+        )
+    spec.mechanisms = [nethsm_sdk.KeyMechanism.from_string(available[0])]
+
+
+@dataclass
+class KeyCreator:
+    """Creates the keys of a manifest for bulk-add-keys, or adds the missing
+    tags to keys that already exist."""
+
+    nethsm: NetHSM
+    cache: nethsm_cache.KeyCache
+    existing: set[str]
+    dry_run: bool
+
+    def add_tags(self, key_id: str, tags: list[str]) -> None:
+        try:
+            for tag in tags:
+                self.nethsm.add_key_tag(key_id, tag)
+        finally:
+            self.cache.invalidate(key_id)
+
+    def update(self, spec: manifest.KeySpec) -> tuple[str, str]:
+        try:
+            tags = self.nethsm.get_key(spec.id).tags
+        except nethsm_sdk.NetHSMError as e:
+            return "failed", str(e)
+        missing = [tag for tag in spec.tags if tag not in tags]
+        if not missing:
+            return "skipped", "Key already exists"
+        message = f"Key already exists, missing tags: {', '.join(missing)}"
+        if self.dry_run:
+            return "would tag", message
+        try:
+            self.add_tags(spec.id, missing)
+        except nethsm_sdk.NetHSMError as e:
+            return "failed", f"Tagging failed: {e}"
+        return "tagged", message
+
+    def add(self, spec: manifest.KeySpec) -> tuple[str, str]:
+        if spec.id in self.existing:
+            return self.update(spec)
+        if self.dry_run:
+            return f"would {spec.action}", ""
+        try:
+            if spec.pem:
+                self.nethsm.add_key_pem(
+                    spec.id, spec.mechanisms, spec.read_pem(), spec.tags
+                )
+                return "imported", ""
+            assert spec.type is not None and spec.length is not None
+            self.nethsm.generate_key(spec.type, spec.mechanisms, spec.length, spec.id)
+        except (nethsm_sdk.NetHSMError, OSError) as e:
+            return "failed", str(e)
+        finally:
+            self.cache.invalidate(spec.id)
+        try:
+            self.add_tags(spec.id, spec.tags)
+        except nethsm_sdk.NetHSMError as e:
+            return "failed", f"Key generated, but tagging failed: {e}"
+        return "generated", ""
+
+
+@nethsm.command()
+@click.option(
+    "-f",
+    "--manifest-format",
+    type=MANIFEST_FORMAT_TYPE,
+    help="The format of the manifest (default: determined from the file extension)",
+)
+@jobs_option
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only check which keys would be created without changing the NetHSM",
+)
+@output_format_option
+@click.argument("filename", type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def bulk_add_keys(
+    ctx: Context,
+    manifest_format: Optional[str],
+    jobs: int,
+    dry_run: bool,
+    output_format: str,
+    filename: str,
+) -> None:
+    """Generate and import the keys listed in a manifest.
+
+    The manifest is a JSON, YAML or CSV file with one entry per key and the
+    fields id, type, length, mechanisms, tags and pem.  Keys with a pem field
+    are imported from that PEM file, all other keys are generated.  If the
+    mechanisms are not set, the only mechanism supported by the key type is
+    used.  The length of elliptic curve keys defaults to the curve size.
+
+    Keys that already exist on the NetHSM are not created again, but the tags
+    from the manifest that they do not have yet are added, so the command can
+    be repeated after a partial failure.  Requests are sent concurrently over one
+    connection, and a summary is printed to stderr at the end.
+
+    This command requires authentication as a user with the Administrator
+    role."""
+    try:
+        specs = manifest.read_manifest(
+            filename,
+            manifest.ManifestFormat(manifest_format) if manifest_format else None,
+        )
+    except (OSError, ValueError) as e:
+        raise click.ClickException(f"Invalid manifest {filename}: {e}")
+    for spec in specs:
+        resolve_mechanisms(spec)
+
+    start = time.monotonic()
+    with connect(ctx, pool_size=jobs) as nethsm, key_cache(ctx, nethsm) as cache:
+        creator = KeyCreator(nethsm, cache, set(nethsm.list_keys()), dry_run)
+        results = []
+        for spec, (status, message) in zip(
+            specs, bulk.ordered_map(creator.add, specs, jobs)
+        ):
+            results.append([spec.id, spec.action, status, message])
+
+    elapsed = time.monotonic() - start
+    print_data(
+        output_format,
+        ["Key ID", "Action", "Result", "Message"],
+        ["id", "action", "result", "message"],
+        results,
+    )
+
+    counts: dict[str, int] = {}
+    for _, _, status, _ in results:
+        counts[status] = counts.get(status, 0) + 1
+    summary = ", ".join(f"{count} {status}" for status, count in counts.items())
+    print(
+        f"{len(results)} keys in {elapsed:.2f} s: {summary or 'nothing to do'}",
+        file=sys.stderr,
+    )
+
+    failed = counts.get("failed", 0)
+    if failed:
+        raise click.ClickException(
+            f"{failed} of {len(results)} keys could not be created on NetHSM "
+            f"{nethsm.host}"
+        )
+
+
 @nethsm.command()
 @click.option("--logging", is_flag=True, help="Query the logging configuration")
 @click.option("--network", is_flag=True, help="Query the network configuration")
@@ -1002,7 +1763,7 @@ def set_backup_passphrase(
         file=sys.stderr,
     )
 
-    confirmed = force or click.confirm("Do you want to continue?")
+    confirmed = force or confirm("Do you want to continue?")
     if not confirmed:
         raise click.Abort()
 
@@ -1059,7 +1820,7 @@ def set_unlock_passphrase(
         file=sys.stderr,
     )
 
-    confirmed = force or click.confirm("Do you want to continue?")
+    confirmed = force or confirm("Do you want to continue?")
     if not confirmed:
         raise click.Abort()
 
@@ -1361,6 +2122,7 @@ def generate_tls_key(ctx: Context, type: str, length: Optional[int]) -> None:
     key_type = nethsm_sdk.TlsKeyType.from_string(type)
     if key_type == nethsm_sdk.TlsKeyType.RSA:
         if not length:
+            check_interactive("Length")
             length = click.prompt("Length", type=int)
     else:
         if length:
@@ -1395,22 +2157,44 @@ def system_info(ctx: Context) -> None:
                 print(f"  {key}:              {value}")
 
 
+def backup_filename(filename: str, host: str) -> str:
+    """Replace the {host} placeholder in the name of a backup file, or append
+    the host if the backup is made for one of multiple hosts."""
+    name = host.replace(":", "_").replace("/", "_")
+    if "{host}" in filename:
+        return filename.replace("{host}", name)
+    if fanout.is_worker():
+        return f"{filename}.{name}"
+    return filename
+
+
 @nethsm.command()
 @click.argument("filename")
 @click.pass_context
 def backup(ctx: Context, filename: str) -> None:
     """Make a backup of a NetHSM instance and write it to a file.
 
+    The backup is downloaded in chunks to a temporary file that is renamed
+    when the download is complete.  A {host} placeholder in FILENAME is
+    replaced with the host.  With --hosts or --inventory, every host writes
+    its own file, FILENAME.<host> if FILENAME has no placeholder.
+
     This command requires authentication as a user with the Backup role."""
+    filename = backup_filename(filename, get_host(ctx.obj))
     if os.path.exists(filename):
         raise click.ClickException(f"Backup file {filename} already exists")
     with connect(ctx) as nethsm:
-        data = nethsm.backup()
-        with open(filename, "xb") as f:
-            f.write(data)
-            print(f"Backup for {nethsm.host} written to {filename}")
+        start = time.monotonic()
+        try:
+            with nethsm_backup.temporary_file(filename) as f:
+                size = nethsm_backup.download(nethsm, f)
+        except FileExistsError as e:
+            raise click.ClickException(str(e))
+        print(f"Backup for {nethsm.host} written to {filename}")
+        bulk.report_throughput("Downloaded", size, start)
         try:
-            EncryptedBackup.parse(data)
+            with nethsm_backup.open_backup(filename) as reader:
+                reader.validate()
         except ValueError as e:
             raise CliException(f"Failed to validate backup: {e}", support_hint=False)
 
@@ -1450,10 +2234,12 @@ def restore(
     if not system_time:
         system_time = datetime.datetime.now(datetime.timezone.utc)
 
-    with open(filename, "rb") as f:
-        data = f.read()
     try:
-        EncryptedBackup.parse(data).decrypt(backup_passphrase)
+        with nethsm_backup.open_backup(filename) as reader:
+            key = reader.key(backup_passphrase)
+            reader.decrypt_metadata(key)
+            for _ in reader.decrypt_items(key):
+                pass
     except ValueError as e:
         if force:
             print(f"Failed to validate backup: {e}")
@@ -1471,12 +2257,16 @@ def restore(
             require_auth = True
 
     with connect(ctx, require_auth=require_auth) as nethsm:
+        with key_cache(ctx, nethsm) as cache:
+            cache.clear()
+        start = time.monotonic()
         with open(filename, "rb") as f:
-            nethsm.restore(data, backup_passphrase, system_time)
+            nethsm.restore(f, backup_passphrase, system_time)
         print(f"Backup restored on NetHSM {nethsm.host}")
+        bulk.report_throughput("Uploaded", os.path.getsize(filename), start)
 
 
-@nethsm.command()
+@nethsm.command(fan_out=False)
 @click.option(
     "-p",
     "--backup-passphrase",
@@ -1490,28 +2280,33 @@ def validate_backup(backup_passphrase: Optional[str], filename: str) -> None:
     the backup passphrase is set, the backup is decrypted and the content is
     also validated."""
 
-    with open(filename, "rb") as f:
-        data = f.read()
-    try:
-        encrypted = EncryptedBackup.parse(data)
-    except ValueError as e:
-        raise CliException(
-            f"Failed to validate backup metadata: {e}", support_hint=False
-        )
-
-    if backup_passphrase:
+    start = time.monotonic()
+    with contextlib.ExitStack() as stack:
         try:
-            encrypted.decrypt(backup_passphrase)
+            reader = stack.enter_context(nethsm_backup.open_backup(filename))
+            reader.validate()
         except ValueError as e:
             raise CliException(
-                f"Failed to validate backup content: {e}", support_hint=False
+                f"Failed to validate backup metadata: {e}", support_hint=False
             )
-        print("Backup metadata and content are valid.")
-    else:
-        print("Backup metadata is valid.")
 
+        if backup_passphrase:
+            try:
+                key = reader.key(backup_passphrase)
+                reader.decrypt_metadata(key)
+                for _ in reader.decrypt_items(key):
+                    pass
+            except ValueError as e:
+                raise CliException(
+                    f"Failed to validate backup content: {e}", support_hint=False
+                )
+            print("Backup metadata and content are valid.")
+        else:
+            print("Backup metadata is valid.")
+    bulk.report_throughput("Validated", os.path.getsize(filename), start)
 
-@nethsm.command()
+
+@nethsm.command(fan_out=False)
 @click.option(
     "-p",
     "--backup-passphrase",
@@ -1519,35 +2314,105 @@ def validate_backup(backup_passphrase: Optional[str], filename: str) -> None:
     prompt=True,
     help="The backup passphrase",
 )
+@click.option(
+    "-f",
+    "--format",
+    type=click.Choice(["json", "jsonl"]),
+    default="json",
+    show_default=True,
+    help="Print one JSON object or one JSON object per key",
+)
+@click.option(
+    "--diff",
+    "diff_filename",
+    metavar="OLD_FILENAME",
+    help="Only print the keys that were added, changed or removed compared to this backup file (implies --format jsonl)",
+)
+@click.option(
+    "--diff-passphrase",
+    hide_input=True,
+    help="The backup passphrase of the --diff backup file (default: the backup passphrase)",
+)
 @click.argument("filename")
-def export_backup(backup_passphrase: str, filename: str) -> None:
+def export_backup(
+    backup_passphrase: str,
+    format: str,
+    diff_filename: Optional[str],
+    diff_passphrase: Optional[str],
+    filename: str,
+) -> None:
     """Export the content of a NetHSM backup file.
 
     The key-value data stored in the backup file is printed to the standard
     output as a JSON object using the base64 encoding for binary data.
     Additionally, the .locked-domain-key and .version keys are set with the
-    domain key and version info extracted from the backup file."""
+    domain key and version info extracted from the backup file.  The values
+    are decrypted and printed one at a time.
 
-    with open(filename, "rb") as f:
-        data = f.read()
-    try:
-        encrypted = EncryptedBackup.parse(data)
-    except ValueError as e:
-        raise CliException(f"Failed to parse backup metadata: {e}", support_hint=False)
+    With --format jsonl, every key is printed as a separate JSON object with
+    the "key" and "value" fields.  With --diff, only the keys that differ
+    from the given older backup file are printed, with the "change" field
+    set to "added", "changed" or "removed"."""
 
-    try:
-        decrypted = encrypted.decrypt(backup_passphrase)
-    except ValueError as e:
-        raise CliException(f"Failed to decrypt backup content: {e}", support_hint=False)
+    start = time.monotonic()
+    with contextlib.ExitStack() as stack:
+        try:
+            reader = stack.enter_context(nethsm_backup.open_backup(filename))
+            old_reader = None
+            if diff_filename:
+                old_reader = stack.enter_context(
+                    nethsm_backup.open_backup(diff_filename)
+                )
+        except ValueError as e:
+            raise CliException(
+                f"Failed to parse backup metadata: {e}", support_hint=False
+            )
+
+        # Check the passphrases before anything is printed so that a wrong
+        # passphrase does not leave incomplete output.
+        try:
+            key = reader.key(backup_passphrase)
+            reader.decrypt_metadata(key)
+            if old_reader:
+                old_key = old_reader.key(diff_passphrase or backup_passphrase)
+                old_reader.decrypt_metadata(old_key)
+        except ValueError as e:
+            raise CliException(
+                f"Failed to decrypt backup metadata: {e}", support_hint=False
+            )
 
-    values: dict[str, Any] = {}
-    values[".locked-domain-key"] = base64.b64encode(decrypted.domain_key).decode()
-    values[".version"] = decrypted.version
-    for key, value in decrypted.data.items():
-        values[key] = base64.b64encode(value).decode()
+        try:
+            entries = nethsm_backup.export_entries(reader, key)
+            if old_reader:
+                old_entries = nethsm_backup.export_entries(old_reader, old_key)
+                for change, name, value in nethsm_backup.diff_entries(
+                    old_entries, entries
+                ):
+                    record = {"change": change, "key": name}
+                    if value is not None:
+                        record["value"] = value
+                    print(json.dumps(record))
+            elif format == "jsonl":
+                for name, value in entries:
+                    print(json.dumps({"key": name, "value": value}))
+            else:
+                separator = ""
+                sys.stdout.write("{")
+                for name, value in entries:
+                    sys.stdout.write(
+                        f"{separator}\n    {json.dumps(name)}: {json.dumps(value)}"
+                    )
+                    separator = ","
+                sys.stdout.write("\n}\n")
+        except ValueError as e:
+            raise CliException(
+                f"Failed to decrypt backup content: {e}", support_hint=False
+            )
 
-    json.dump(values, sys.stdout, indent=4)
-    print()
+    size = os.path.getsize(filename)
+    if diff_filename:
+        size += os.path.getsize(diff_filename)
+    bulk.report_throughput("Exported", size, start)
 
 
 @nethsm.command()
@@ -1606,7 +2471,7 @@ def reboot(ctx: Context, force: bool) -> None:
     role."""
     with connect(ctx) as nethsm:
         print(f"NetHSM {nethsm.host} will be rebooted.")
-        reboot = force or click.confirm("Do you want to continue?")
+        reboot = force or confirm("Do you want to continue?")
 
         if reboot:
             nethsm.reboot()
@@ -1630,7 +2495,7 @@ def shutdown(ctx: Context, force: bool) -> None:
     role."""
     with connect(ctx) as nethsm:
         print(f"NetHSM {nethsm.host} will be shutdown.")
-        shutdown = force or click.confirm("Do you want to continue?")
+        shutdown = force or confirm("Do you want to continue?")
 
         if shutdown:
             nethsm.shutdown()
@@ -1655,9 +2520,11 @@ def factory_reset(ctx: Context, force: bool) -> None:
     with connect(ctx) as nethsm:
         print(f"NetHSM {nethsm.host} will be set to factory defaults.")
         print(f"All data will be lost!")
-        factory_reset = force or click.confirm("Do you want to continue?")
+        factory_reset = force or confirm("Do you want to continue?")
 
         if factory_reset:
+            with key_cache(ctx, nethsm) as cache:
+                cache.clear()
             nethsm.factory_reset()
             print(f"NetHSM {nethsm.host} is about to perform a factory reset")
         else:
@@ -1681,8 +2548,7 @@ def factory_reset(ctx: Context, force: bool) -> None:
     "-m",
     "--mode",
     type=ENCRYPT_MODE_TYPE,
-    prompt=True,
-    help="The encrypt mode",
+    help="The encrypt mode (prompted for from the modes of the key if not set)",
 )
 @click.option(
     "-iv",
@@ -1692,11 +2558,14 @@ def factory_reset(ctx: Context, force: bool) -> None:
     help="The initialization vector in Base64 encoding",
 )
 @click.pass_context
-def encrypt(ctx: Context, key_id: str, data: str, mode: str, iv: Optional[str]) -> None:
+def encrypt(
+    ctx: Context, key_id: str, data: str, mode: Optional[str], iv: Optional[str]
+) -> None:
     """Encrypt data with an asymmetric secret key on the NetHSM and print the encrypted message.
 
     This command requires authentication as a user with the Operator role."""
     with connect(ctx) as nethsm:
+        mode = check_mode(ctx, nethsm, key_id, mode, ENCRYPT_MODE_TYPE, "Encryption")
         encrypted = nethsm.encrypt(
             key_id,
             base64_input(data),
@@ -1724,8 +2593,7 @@ def encrypt(ctx: Context, key_id: str, data: str, mode: str, iv: Optional[str])
     "-m",
     "--mode",
     type=DECRYPT_MODE_TYPE,
-    prompt=True,
-    help="The decrypt mode",
+    help="The decrypt mode (prompted for from the modes of the key if not set)",
 )
 @click.option(
     "-iv",
@@ -1735,11 +2603,14 @@ def encrypt(ctx: Context, key_id: str, data: str, mode: str, iv: Optional[str])
     help="The initialization vector in Base64 encoding",
 )
 @click.pass_context
-def decrypt(ctx: Context, key_id: str, data: str, mode: str, iv: Optional[str]) -> None:
+def decrypt(
+    ctx: Context, key_id: str, data: str, mode: Optional[str], iv: Optional[str]
+) -> None:
     """Decrypt data with a secret key on the NetHSM and print the decrypted message.
 
     This command requires authentication as a user with the Operator role."""
     with connect(ctx) as nethsm:
+        mode = check_mode(ctx, nethsm, key_id, mode, DECRYPT_MODE_TYPE, "Decryption")
         decrypted = nethsm.decrypt(
             key_id,
             base64_input(data),
@@ -1766,16 +2637,618 @@ def decrypt(ctx: Context, key_id: str, data: str, mode: str, iv: Optional[str])
     "-m",
     "--mode",
     type=SIGN_MODE_TYPE,
-    prompt=True,
-    help="The sign mode",
+    help="The sign mode (prompted for from the modes of the key if not set)",
 )
 @click.pass_context
-def sign(ctx: Context, key_id: str, data: str, mode: str) -> None:
+def sign(ctx: Context, key_id: str, data: str, mode: Optional[str]) -> None:
     """Sign data with a secret key on the NetHSM and print the signature.
 
     This command requires authentication as a user with the Operator role."""
     with connect(ctx) as nethsm:
+        mode = check_mode(ctx, nethsm, key_id, mode, SIGN_MODE_TYPE, "Signature")
         signature = nethsm.sign(
             key_id, base64_input(data), nethsm_sdk.SignMode.from_string(mode)
         )
         print(signature.data)
+
+
+def bulk_options(f: Callable[..., Any]) -> Callable[..., Any]:
+    """Common options for the bulk-* commands."""
+    options = [
+        click.option(
+            "-i",
+            "--input",
+            "input",
+            type=click.File("r"),
+            default="-",
+            help="The file to read the input from, one item per line (default: stdin)",
+        ),
+        click.option(
+            "-o",
+            "--output",
+            type=click.File("w"),
+            default="-",
+            help="The file to write the results to, one item per line (default: stdout)",
+        ),
+        click.option(
+            "-f",
+            "--format",
+            type=BULK_FORMAT_TYPE,
+            default=bulk.InputFormat.BASE64.value,
+            show_default=True,
+            help="The format of the input and output lines",
+        ),
+        click.option(
+            "-j",
+            "--jobs",
+            type=click.IntRange(min=1),
+            default=8,
+            show_default=True,
+            help="The maximum number of concurrent requests",
+        ),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def run_bulk(
+    nethsm: NetHSM,
+    operation: str,
+    fn: Callable[[bulk.Item], dict[str, str]],
+    input: TextIO,
+    output: TextIO,
+    format: str,
+    jobs: int,
+    columns: Sequence[str] = (),
+    data_fields: Sequence[str] = ("data",),
+) -> None:
+    """Execute `fn` for all items read from `input` and write the results to
+    `output` in input order.  Failed requests are reported per item and do
+    not abort the command, but the exit code is set if any request failed."""
+    input_format = bulk.InputFormat(format)
+
+    def execute(item: bulk.Item) -> bulk.Result:
+        try:
+            return bulk.Result(item, value=fn(item))
+        except (nethsm_sdk.NetHSMError, ValueError) as e:
+            return bulk.Result(item, error=str(e))
+
+    throughput = bulk.Throughput(operation)
+    try:
+        items = bulk.read_items(input, input_format, columns, data_fields)
+        for result in bulk.ordered_map(execute, items, jobs):
+            bulk.write_result(output, input_format, result)
+            throughput.add(result)
+    except ValueError as e:
+        raise click.ClickException(f"Invalid input: {e}")
+    finally:
+        throughput.report()
+
+    if throughput.errors:
+        raise click.ClickException(
+            f"{throughput.errors} of {throughput.count} requests to NetHSM {nethsm.host} failed"
+        )
+
+
+@nethsm.command(fan_out=False)
+@click.option(
+    "-k",
+    "--key-id",
+    prompt=True,
+    help="The ID of the key to sign the data with",
+)
+@click.option(
+    "-m",
+    "--mode",
+    type=SIGN_MODE_TYPE,
+    prompt=True,
+    help="The sign mode",
+)
+@bulk_options
+@click.pass_context
+def bulk_sign(
+    ctx: Context,
+    key_id: str,
+    mode: str,
+    input: TextIO,
+    output: TextIO,
+    format: str,
+    jobs: int,
+) -> None:
+    """Sign a stream of data with a secret key on the NetHSM.
+
+    The input is read line by line, either as Base64 strings or as JSON
+    objects with the data in the "data" field and an optional "id" field.
+    The signatures are written in the same order and format as the input,
+    with the "signature" field and the "id" of the input for JSON lines.
+    Requests are sent concurrently over one connection, and the throughput is
+    printed to stderr at the end.
+
+    This command requires authentication as a user with the Operator role."""
+    with connect(ctx, pool_size=jobs) as nethsm:
+        sign_mode = nethsm_sdk.SignMode.from_string(mode)
+
+        def sign(item: bulk.Item) -> dict[str, str]:
+            signature = nethsm.sign(key_id, base64_input(item.data), sign_mode)
+            return {"signature": signature.data}
+
+        run_bulk(nethsm, "Signed", sign, input, output, format, jobs)
+
+
+@nethsm.command(fan_out=False)
+@click.option(
+    "-k",
+    "--key-id",
+    prompt=True,
+    help="The ID of the key to encrypt the data with",
+)
+@click.option(
+    "-m",
+    "--mode",
+    type=ENCRYPT_MODE_TYPE,
+    prompt=True,
+    help="The encrypt mode",
+)
+@bulk_options
+@click.pass_context
+def bulk_encrypt(
+    ctx: Context,
+    key_id: str,
+    mode: str,
+    input: TextIO,
+    output: TextIO,
+    format: str,
+    jobs: int,
+) -> None:
+    """Encrypt a stream of data with a secret key on the NetHSM.
+
+    The input is read line by line, either as Base64 strings or as JSON
+    objects with the data in the "data" field and optional "id" and "iv"
+    fields.  The results are written in the same order and format as the
+    input, either as the Base64 encoded message and initialization vector
+    separated by a space or as JSON objects with the "encrypted" and "iv"
+    fields.  The output can be used as the input of bulk-decrypt.  Requests
+    are sent concurrently over one connection, and the throughput is printed
+    to stderr at the end.
+
+    This command requires authentication as a user with the Operator role."""
+    with connect(ctx, pool_size=jobs) as nethsm:
+        encrypt_mode = nethsm_sdk.EncryptMode.from_string(mode)
+
+        def encrypt(item: bulk.Item) -> dict[str, str]:
+            iv = item.fields.get("iv")
+            encrypted = nethsm.encrypt(
+                key_id,
+                base64_input(item.data),
+                encrypt_mode,
+                iv=base64_input(iv) if iv else None,
+            )
+            return {"encrypted": encrypted.encrypted.data, "iv": encrypted.iv.data}
+
+        run_bulk(nethsm, "Encrypted", encrypt, input, output, format, jobs)
+
+
+@nethsm.command(fan_out=False)
+@click.option(
+    "-k",
+    "--key-id",
+    prompt=True,
+    help="The ID of the key to decrypt the data with",
+)
+@click.option(
+    "-m",
+    "--mode",
+    type=DECRYPT_MODE_TYPE,
+    prompt=True,
+    help="The decrypt mode",
+)
+@click.option(
+    "-iv",
+    "--initialization-vector",
+    "iv",
+    type=str,
+    help="The initialization vector in Base64 encoding for items without an initialization vector",
+)
+@bulk_options
+@click.pass_context
+def bulk_decrypt(
+    ctx: Context,
+    key_id: str,
+    mode: str,
+    iv: Optional[str],
+    input: TextIO,
+    output: TextIO,
+    format: str,
+    jobs: int,
+) -> None:
+    """Decrypt a stream of data with a secret key on the NetHSM.
+
+    The input is read line by line, either as Base64 strings optionally
+    followed by a space and the initialization vector, or as JSON objects
+    with the data in the "data" or "encrypted" field and optional "id" and
+    "iv" fields.  The decrypted data is written in the same order and format as the input, with
+    the "decrypted" field and the "id" of the input for JSON lines.  Requests
+    are sent concurrently over one connection, and the throughput is printed
+    to stderr at the end.
+
+    This command requires authentication as a user with the Operator role."""
+    with connect(ctx, pool_size=jobs) as nethsm:
+        decrypt_mode = nethsm_sdk.DecryptMode.from_string(mode)
+
+        def decrypt(item: bulk.Item) -> dict[str, str]:
+            item_iv = item.fields.get("iv", iv)
+            decrypted = nethsm.decrypt(
+                key_id,
+                base64_input(item.data),
+                decrypt_mode,
+                base64_input(item_iv) if item_iv else None,
+            )
+            return {"decrypted": decrypted.data}
+
+        run_bulk(
+            nethsm,
+            "Decrypted",
+            decrypt,
+            input,
+            output,
+            format,
+            jobs,
+            columns=["iv"],
+            data_fields=["data", "encrypted"],
+        )
+
+
+BENCH_OPERATIONS = ["sign", "encrypt", "decrypt", "random"]
+BENCH_MOCK_KEYS = {"sign": "ed25519", "encrypt": "aes", "decrypt": "aes"}
+
+
+def rsa_encrypt(key: nethsm_sdk.Key, data: bytes, mode: str) -> bytes:
+    """Encrypt data locally with the public key of an RSA key for the given
+    decryption mode."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+    assert isinstance(key.public_key, nethsm_sdk.RsaPublicKey)
+    public_key = rsa.RSAPublicNumbers(
+        e=int.from_bytes(key.public_key.public_exponent.decode(), "big"),
+        n=int.from_bytes(key.public_key.modulus.decode(), "big"),
+    ).public_key()
+
+    pad: padding.AsymmetricPadding
+    if mode.startswith("OAEP_"):
+        algorithm = getattr(hashes, mode[len("OAEP_") :])()
+        pad = padding.OAEP(
+            mgf=padding.MGF1(algorithm=algorithm), algorithm=algorithm, label=None
+        )
+    else:
+        # Raw decryption accepts any ciphertext
+        pad = padding.PKCS1v15()
+    return public_key.encrypt(data, pad)
+
+
+@nethsm.command()
+@click.option(
+    "-o",
+    "--operation",
+    type=click.Choice(BENCH_OPERATIONS),
+    default="sign",
+    show_default=True,
+    help="The operation to benchmark",
+)
+@click.option(
+    "-k",
+    "--key-id",
+    help="The ID of the key to use (not required for random)",
+)
+@click.option(
+    "-m",
+    "--mode",
+    help="The sign, encrypt or decrypt mode (default: the only mode supported by the key)",
+)
+@click.option(
+    "-n",
+    "--count",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="The number of operations",
+)
+@jobs_option
+@click.option(
+    "-s",
+    "--size",
+    type=click.IntRange(min=1),
+    default=32,
+    show_default=True,
+    help="The size of the data per operation in bytes",
+)
+@click.option(
+    "--warmup",
+    type=click.IntRange(min=0),
+    help="The number of operations to run before measuring so that all connections are open (default: twice the number of jobs)",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["table", "json"]),
+    default="table",
+    show_default=True,
+    help="The output format",
+)
+@click.option(
+    "--mock",
+    is_flag=True,
+    help="Run against a local mock of the NetHSM API instead of a NetHSM",
+)
+@click.option(
+    "--mock-delay",
+    type=click.FloatRange(min=0),
+    default=0,
+    help="The processing time per operation of the mock in seconds",
+)
+@click.pass_context
+def bench(
+    ctx: Context,
+    operation: str,
+    key_id: Optional[str],
+    mode: Optional[str],
+    count: int,
+    jobs: int,
+    size: int,
+    warmup: Optional[int],
+    output_format: str,
+    mock: bool,
+    mock_delay: float,
+) -> None:
+    """Measure the throughput and latency of NetHSM operations.
+
+    The operation is executed COUNT times with up to JOBS concurrent requests
+    over pooled connections.  The number of operations per second, the
+    latency percentiles and the errors are reported, optionally as JSON to
+    compare the results of different firmware versions.
+
+    With --mock, a local mock of the NetHSM API is started and used instead
+    of the configured NetHSM, e. g. to test the client in CI.  The mock does
+    not perform real cryptographic operations.
+
+    This command requires authentication as a user with the Operator role."""
+    from pynitrokey.nethsm import bench as nethsm_bench
+
+    with contextlib.ExitStack() as stack:
+        if mock:
+            from pynitrokey.nethsm import mock as nethsm_mock
+
+            if fanout.is_worker():
+                raise click.UsageError("--mock cannot be used with multiple hosts")
+            server = nethsm_mock.MockNetHSM(delay=mock_delay)
+            server.start()
+            stack.callback(server.server_close)
+            stack.callback(server.shutdown)
+            ctx.obj = replace(
+                ctx.obj,
+                host=server.host,
+                username=nethsm_mock.DEFAULT_USERNAME,
+                password=nethsm_mock.DEFAULT_PASSWORD,
+                verify_tls=False,
+                use_agent=False,
+                cache_ttl=0,
+            )
+            key_id = key_id or BENCH_MOCK_KEYS.get(operation)
+
+        if operation != "random" and not key_id:
+            raise click.UsageError(f"--key-id is required for {operation}")
+
+        nethsm = stack.enter_context(connect(ctx, pool_size=jobs))
+        data = os.urandom(size)
+        # AES-CBC requires full blocks
+        blocks = data.ljust(-(-size // 16) * 16, b"\0")
+        fn: Callable[[], Any]
+
+        if operation == "random":
+            if size > 1024:
+                raise click.UsageError("--size must be at most 1024 for random")
+
+            def fn() -> None:
+                nethsm.get_random_data(size)
+
+        else:
+            assert key_id
+            mode_types = {
+                "sign": SIGN_MODE_TYPE,
+                "encrypt": ENCRYPT_MODE_TYPE,
+                "decrypt": DECRYPT_MODE_TYPE,
+            }
+            kinds = {
+                "sign": "Signature",
+                "encrypt": "Encryption",
+                "decrypt": "Decryption",
+            }
+            if mode and mode not in mode_types[operation].choices:
+                raise click.UsageError(f"Invalid {operation} mode {mode}")
+            mode = select_mode(
+                ctx,
+                nethsm,
+                key_id,
+                mode,
+                mode_types[operation],
+                kinds[operation],
+            )
+
+            if operation == "sign":
+                sign_mode = nethsm_sdk.SignMode.from_string(mode)
+                message = Base64.from_encoded(base64.b64encode(data))
+
+                def fn() -> None:
+                    nethsm.sign(key_id, message, sign_mode)
+
+            elif operation == "encrypt":
+                encrypt_mode = nethsm_sdk.EncryptMode.from_string(mode)
+                message = Base64.from_encoded(base64.b64encode(blocks))
+
+                def fn() -> None:
+                    nethsm.encrypt(key_id, message, encrypt_mode)
+
+            else:
+                decrypt_mode = nethsm_sdk.DecryptMode.from_string(mode)
+                iv: Optional[Base64] = None
+                if decrypt_mode == nethsm_sdk.DecryptMode.AES_CBC:
+                    encrypted = nethsm.encrypt(
+                        key_id,
+                        Base64.from_encoded(base64.b64encode(blocks)),
+                        nethsm_sdk.EncryptMode.AES_CBC,
+                    )
+                    message, iv = encrypted.encrypted, encrypted.iv
+                else:
+                    key = nethsm.get_key(key_id)
+                    message = Base64.from_encoded(
+                        base64.b64encode(rsa_encrypt(key, data, mode))
+                    )
+
+                def fn() -> None:
+                    nethsm.decrypt(key_id, message, decrypt_mode, iv)
+
+        name = operation if operation == "random" else f"{operation} {mode}"
+        if warmup is None:
+            warmup = 2 * jobs
+        result = nethsm_bench.run(name, fn, count, jobs, warmup=warmup)
+
+        if output_format == "json":
+            data_json = result.to_json()
+            data_json["host"] = nethsm.host
+            data_json["key_id"] = key_id
+            data_json["size"] = size
+            print(json.dumps(data_json, indent=2))
+        else:
+            print(f"Benchmark of {name} on NetHSM {nethsm.host}:")
+            print()
+            print_table(
+                ["Operations", "Errors", "Jobs", "Time", "Ops/s", "p50", "p95", "p99"],
+                [
+                    [
+                        str(result.count),
+                        str(sum(result.errors.values())),
+                        str(jobs),
+                        f"{result.elapsed:.2f} s",
+                        f"{result.ops_per_second:.1f}",
+                    ]
+                    + [f"{result.latency(p) * 1000:.1f} ms" for p in (50, 95, 99)]
+                ],
+            )
+            for message_text, n in result.errors.most_common(
+                nethsm_bench.MAX_ERROR_MESSAGES
+            ):
+                print(f"Error ({n}x): {message_text}", file=sys.stderr)
+
+    if result.errors:
+        raise click.ClickException(
+            f"{sum(result.errors.values())} of {result.count} operations failed"
+        )
+
+
+@nethsm.group()
+def agent() -> None:
+    """Manage a local agent that keeps a NetHSM connection open.
+
+    While an agent is running for a host and user, the nethsm commands for
+    this host and user are sent through the agent, which re-uses its
+    authenticated keep-alive connection to the NetHSM instead of performing a
+    new TLS handshake for every command.  Use the --no-agent option to bypass
+    a running agent.
+
+    The agent is only supported on POSIX systems."""
+    if not nethsm_agent.is_supported():
+        raise CliException(
+            "The NetHSM agent is not supported on this system", support_hint=False
+        )
+
+
+@agent.command("start")
+@click.option(
+    "-t",
+    "--idle-timeout",
+    type=click.IntRange(min=1),
+    default=nethsm_agent.DEFAULT_IDLE_TIMEOUT,
+    show_default=True,
+    help="Stop the agent after this number of seconds without requests",
+)
+@click.option(
+    "--pool-size",
+    type=click.IntRange(min=1),
+    default=nethsm_agent.DEFAULT_POOL_SIZE,
+    show_default=True,
+    help="The maximum number of connections to the NetHSM that are kept open",
+)
+@click.option("--foreground", is_flag=True, help="Run the agent in the current process")
+@click.pass_context
+def start_agent(
+    ctx: Context, idle_timeout: int, pool_size: int, foreground: bool
+) -> None:
+    """Start an agent for a NetHSM host and user.
+
+    The credentials are kept in the memory of the agent process.  The agent
+    listens on a Unix socket that can only be accessed by the current user."""
+    config = ctx.obj
+    assert isinstance(config, Config)
+
+    host = get_host(config)
+    auth = get_auth(config, host)
+    agent = nethsm_agent.Agent(
+        host,
+        auth,
+        verify_tls=config.verify_tls,
+        idle_timeout=idle_timeout,
+        pool_size=pool_size,
+    )
+    try:
+        agent.bind()
+    except (OSError, ValueError) as e:
+        raise CliException(f"Failed to start the NetHSM agent: {e}", support_hint=False)
+
+    if foreground:
+        print(
+            f"NetHSM agent for {auth.username} on {host} listening on {agent.socket_path}"
+        )
+        agent.serve()
+    elif daemonize():
+        try:
+            agent.serve()
+        finally:
+            os._exit(0)
+    else:
+        print(f"NetHSM agent for {auth.username} on {host} started")
+
+
+@agent.command("stop")
+@click.pass_context
+def stop_agent(ctx: Context) -> None:
+    """Stop the agent for a NetHSM host and user."""
+    config = ctx.obj
+    assert isinstance(config, Config)
+
+    host = get_host(config)
+    info = nethsm_agent.find(host, config.username)
+    if info is None:
+        raise CliException(f"No NetHSM agent running for {host}", support_hint=False)
+    nethsm_agent.stop(info.socket_path)
+    print(f"NetHSM agent for {info.username} on {host} stopped")
+
+
+@agent.command("status")
+@click.pass_context
+def agent_status(ctx: Context) -> None:
+    """Query the agent for a NetHSM host and user."""
+    config = ctx.obj
+    assert isinstance(config, Config)
+
+    host = get_host(config)
+    info = nethsm_agent.find(host, config.username)
+    if info is None:
+        print(f"No NetHSM agent running for {host}")
+        return
+    print(f"Host:         {info.host}")
+    print(f"User:         {info.username}")
+    print(f"PID:          {info.pid}")
+    print(f"Socket:       {info.socket_path}")
+    print(f"Idle timeout: {info.idle_timeout} s")
+    print(f"Requests:     {info.requests}")
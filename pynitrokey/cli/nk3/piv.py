@@ -2,8 +2,25 @@
 # SPDX-License-Identifier: Apache-2.0 OR MIT
 
 import datetime
+import json
+import logging
+import os
+import statistics
 import sys
-from typing import Optional, Sequence, Tuple, Union
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Iterator,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 import click
 import cryptography
@@ -16,15 +33,39 @@ from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
 from cryptography.hazmat.primitives.serialization import Encoding
 
 from pynitrokey.cli.nk3 import nk3
-from pynitrokey.helpers import check_experimental_flag, local_critical, local_print
+from pynitrokey.confconsts import VERBOSE, Verbosity
+from pynitrokey.helpers import (
+    check_experimental_flag,
+    daemonize,
+    local_critical,
+    local_print,
+)
 from pynitrokey.tlv import Tlv
 
+# Issues a certificate for a certificate signing request
+CertificateSigner = Callable[[x509.CertificateSigningRequest], x509.Certificate]
+
 # Pyscard does not have wheels for all targets, leading to installation errors
 # It is therefore made optional
 #
 # C901: `TryExcept` is too complex
 try:  # noqa: C901
-    from pynitrokey.nk3.piv_app import PivApp, find_by_id
+    from pynitrokey.nk3 import piv_agent
+    from pynitrokey.nk3.piv_app import (
+        ALGO_NISTP256,
+        ALGO_RSA2048,
+        PivApp,
+        StatusError,
+        find_by_id,
+    )
+    from pynitrokey.nk3.piv_trace import (
+        DEFAULT_MAX_DUMP,
+        DEVICE,
+        LOGGER_NAME,
+        ApduTrace,
+        Redaction,
+        read_trace,
+    )
 
     class RsaPivSigner(rsa.RSAPrivateKey):
         _device: PivApp
@@ -128,10 +169,177 @@ try:  # noqa: C901
         is_flag=True,
         help="Allow to execute experimental features",
     )
-    def piv(experimental: bool) -> None:
+    @click.option(
+        "--agent/--no-agent",
+        "use_agent",
+        default=True,
+        help="Whether to use a running PIV agent, see the agent command",
+    )
+    @click.option(
+        "--trace",
+        type=click.File("wb"),
+        help="Write the exchanged APDUs to a binary trace file, see show-trace",
+    )
+    @click.option(
+        "--redact",
+        type=click.Choice([r.value for r in Redaction]),
+        default=Redaction.SECRETS.value,
+        show_default=True,
+        help="The data to redact in the log and the trace file",
+    )
+    @click.option(
+        "--log-apdus",
+        is_flag=True,
+        help="Write the exchanged APDUs to the log file",
+    )
+    @click.pass_context
+    def piv(
+        ctx: click.Context,
+        experimental: bool,
+        use_agent: bool,
+        trace: Optional[BinaryIO],
+        redact: str,
+        log_apdus: bool,
+    ) -> None:
         """Nitrokey PIV App"""
         check_experimental_flag(experimental)
-        pass
+        # Logging every APDU is expensive, so it has its own switch unless
+        # everything is logged with PYNK_DEBUG.
+        if not log_apdus and VERBOSE != Verbosity.debug:
+            logging.getLogger(LOGGER_NAME).setLevel(logging.INFO)
+        ctx.meta[USE_AGENT_KEY] = use_agent
+        ctx.meta[TRACE_KEY] = ApduTrace(redaction=Redaction(redact), file=trace)
+
+    USE_AGENT_KEY = "pynitrokey.nk3.piv.use_agent"
+    TRACE_KEY = "pynitrokey.nk3.piv.trace"
+
+    def open_device() -> PivApp:
+        """Connect to the PIV application, through the agent if it is running
+        and not disabled."""
+        meta = click.get_current_context().meta
+        trace = meta.get(TRACE_KEY)
+        if meta.get(USE_AGENT_KEY, True):
+            device = piv_agent.connect(trace=trace)
+            if device is not None:
+                return device
+        return PivApp(trace=trace)
+
+    @piv.command()
+    @click.argument("trace", type=click.File("rb"))
+    @click.option(
+        "--full", is_flag=True, help="Print the complete APDUs instead of a prefix"
+    )
+    def show_trace(trace: BinaryIO, full: bool) -> None:
+        """Print the APDUs of a trace file written with --trace.
+
+        Every line contains the time, the device number, the direction and
+        the APDU.  With --devices all, a line with the direction @ shows the
+        reader of every device number instead of an APDU."""
+        max_dump = None if full else DEFAULT_MAX_DUMP
+        try:
+            for record in read_trace(trace):
+                if record.direction == DEVICE:
+                    apdu = record.apdu.decode(errors="replace")
+                else:
+                    apdu = record.apdu[:max_dump].hex()
+                    if max_dump is not None and len(record.apdu) > max_dump:
+                        apdu += f"... ({len(record.apdu)} bytes)"
+                direction = record.direction.decode()
+                local_print(f"{record.time:10.6f} {record.device:3} {direction} {apdu}")
+        except ValueError as e:
+            local_critical(f"Failed to read {trace.name}: {e}", support_hint=False)
+
+    @piv.group()
+    def agent() -> None:
+        """Manage a local agent that keeps the PIV connection open.
+
+        While the agent is running, the piv commands are sent through the
+        agent, which keeps the application selected and remembers the admin
+        key and PIN that have been verified, so that they are only verified
+        again if they change.  Use the --no-agent option to bypass a running
+        agent.
+
+        The agent is only supported on POSIX systems."""
+        if not piv_agent.is_supported():
+            local_critical(
+                "The PIV agent is not supported on this system", support_hint=False
+            )
+
+    @agent.command("start")
+    @click.option(
+        "--idle-timeout",
+        type=click.IntRange(min=1),
+        default=piv_agent.DEFAULT_IDLE_TIMEOUT,
+        show_default=True,
+        help="Stop the agent after this number of seconds without commands",
+    )
+    @click.option(
+        "--foreground", is_flag=True, help="Run the agent in the current process"
+    )
+    def start_agent(idle_timeout: int, foreground: bool) -> None:
+        """Start an agent for the PIV application.
+
+        The agent connects to the first card with a PIV application and keeps
+        the connection until it is stopped or idle."""
+        info = piv_agent.find()
+        if info is not None:
+            local_critical(
+                f"A PIV agent is already running for {info.reader}",
+                support_hint=False,
+            )
+
+        agent = piv_agent.Agent(idle_timeout=idle_timeout)
+        if foreground:
+            try:
+                agent.open()
+                agent.bind()
+            except Exception as e:
+                local_critical(
+                    f"Failed to start the PIV agent: {e}", support_hint=False
+                )
+            local_print(f"PIV agent listening on {agent.socket_path}")
+            agent.serve()
+        elif daemonize():
+            # the card is only opened in the child process because PC/SC
+            # contexts cannot be shared with a forked process
+            try:
+                agent.open()
+                agent.bind()
+                agent.serve()
+            finally:
+                os._exit(0)
+        else:
+            info = piv_agent.wait_for_start()
+            if info is None:
+                local_critical(
+                    "Failed to start the PIV agent, use --foreground to see the error",
+                    support_hint=False,
+                )
+                return
+            local_print(f"PIV agent started for {info.reader}")
+
+    @agent.command("stop")
+    def stop_agent() -> None:
+        """Stop the PIV agent."""
+        info = piv_agent.find()
+        if info is None:
+            local_critical("No PIV agent running", support_hint=False)
+            return
+        piv_agent.stop(info.socket_path)
+        local_print("PIV agent stopped")
+
+    @agent.command("status")
+    def agent_status() -> None:
+        """Query the PIV agent."""
+        info = piv_agent.find()
+        if info is None:
+            local_print("No PIV agent running")
+            return
+        local_print(f"PIV agent running for {info.reader}")
+        local_print(f"    PID: {info.pid}")
+        local_print(f"    Socket: {info.socket_path}")
+        local_print(f"    Idle timeout: {info.idle_timeout} s")
+        local_print(f"    Commands: {info.requests}")
 
     @piv.command(help="Authenticate with the admin key.")
     @click.argument(
@@ -148,7 +356,7 @@ try:  # noqa: C901
                 support_hint=False,
             )
 
-        device = PivApp()
+        device = open_device()
         device.authenticate_admin(admin_key_bytes)
         local_print("Authenticated successfully")
 
@@ -167,7 +375,7 @@ try:  # noqa: C901
                 support_hint=False,
             )
 
-        device = PivApp()
+        device = open_device()
         device.authenticate_admin(admin_key_bytes)
         guid = device.init()
         local_print("Device intialized successfully")
@@ -175,7 +383,7 @@ try:  # noqa: C901
 
     @piv.command(help="Print information about the PIV application.")
     def info() -> None:
-        device = PivApp()
+        device = open_device()
         serial_number = device.serial()
         local_print(f"Device: {serial_number}")
         reader = device.reader()
@@ -220,7 +428,7 @@ try:  # noqa: C901
                 support_hint=False,
             )
 
-        device = PivApp()
+        device = open_device()
         device.authenticate_admin(current_admin_key_bytes)
         device.set_admin_key(new_admin_key_bytes)
         local_print("Changed key successfully")
@@ -241,7 +449,7 @@ try:  # noqa: C901
         help="New PIN.",
     )
     def change_pin(current_pin: str, new_pin: str) -> None:
-        device = PivApp()
+        device = open_device()
         device.change_pin(current_pin, new_pin)
         local_print("Changed pin successfully")
 
@@ -261,7 +469,7 @@ try:  # noqa: C901
         help="New PUK.",
     )
     def change_puk(current_puk: str, new_puk: str) -> None:
-        device = PivApp()
+        device = open_device()
         device.change_puk(current_puk, new_puk)
         local_print("Changed puk successfully")
 
@@ -281,13 +489,13 @@ try:  # noqa: C901
         help="New PIN.",
     )
     def reset_retry_counter(puk: str, new_pin: str) -> None:
-        device = PivApp()
+        device = open_device()
         device.reset_retry_counter(puk, new_pin)
         local_print("Unlocked PIN successfully")
 
     @piv.command(help="Reset the PIV application.")
     def factory_reset() -> None:
-        device = PivApp()
+        device = open_device()
         try:
             device.factory_reset()
         except ValueError:
@@ -324,107 +532,37 @@ try:  # noqa: C901
         "95": "5FC120",
     }
 
-    @piv.command(help="Generate a new key and certificate signing request.")
-    @click.option(
-        "--admin-key",
-        type=click.STRING,
-        default="010203040506070801020304050607080102030405060708",
-        help="Current admin key",
-    )
-    @click.option(
-        "--key",
-        type=click.Choice(
-            [
-                "9A",
-                "9C",
-                "9D",
-                "9E",
-                "82",
-                "83",
-                "84",
-                "85",
-                "86",
-                "87",
-                "88",
-                "89",
-                "8A",
-                "8B",
-                "8C",
-                "8D",
-                "8E",
-                "8F",
-                "90",
-                "91",
-                "92",
-                "93",
-                "94",
-                "95",
-            ],
-            case_sensitive=False,
-        ),
-        default="9A",
-        help="Key slot for operation.",
+    # SEQUENCE
+    # SEQUENCE
+    # OBJECT            :aes-256-cbc
+    # SEQUENCE
+    # OBJECT            :id-aes256-wrap
+    # SEQUENCE
+    # OBJECT            :aes-192-cbc
+    # SEQUENCE
+    # OBJECT            :id-aes192-wrap
+    # SEQUENCE
+    # OBJECT            :aes-128-cbc
+    # SEQUENCE
+    # OBJECT            :id-aes128-wrap
+    # SEQUENCE
+    # OBJECT            :des-ede3-cbc
+    # SEQUENCE
+    # OBJECT            :des-cbc
+    # SEQUENCE
+    # OBJECT            :rc2-cbc
+    # INTEGER           :80
+    # SEQUENCE
+    # OBJECT            :rc4
+    # INTEGER           :0200
+    SMIME_CAPABILITIES = bytes.fromhex(
+        "308183300B060960864801650304012A300B060960864801650304012D300B0609608648016503040116300B0609608648016503040119300B0609608648016503040102300B0609608648016503040105300A06082A864886F70D0307300706052B0E030207300E06082A864886F70D030202020080300E06082A864886F70D030402020200"
     )
-    @click.option(
-        "--algo",
-        type=click.Choice(["rsa2048", "nistp256"], case_sensitive=False),
-        default="nistp256",
-        help="Algorithm for the key.",
-    )
-    @click.option(
-        "--domain-component",
-        type=click.STRING,
-        multiple=True,
-        help="Domain component for the certificate signing request.",
-    )
-    @click.option(
-        "--subject-name",
-        type=click.STRING,
-        multiple=True,
-        help="Subject name for the certificate signing request.",
-    )
-    @click.option(
-        "--subject-alt-name-upn",
-        type=click.STRING,
-        help="Subject alternative name (UPN) for the certificate signing request.",
-    )
-    @click.option(
-        "--pin",
-        type=click.STRING,
-        prompt="Enter the PIN",
-        hide_input=True,
-        help="Current PIN.",
-    )
-    @click.option(
-        "--path",
-        type=click.Path(allow_dash=True),
-        default="-",
-        help="Write certificate signing request to path.",
-    )
-    def generate_key(
-        admin_key: str,
-        key: str,
-        algo: str,
-        domain_component: Optional[Sequence[str]],
-        subject_name: Optional[Sequence[str]],
-        subject_alt_name_upn: Optional[str],
-        pin: str,
-        path: str,
-    ) -> None:
-        try:
-            admin_key_bytes = bytearray.fromhex(admin_key)
-        except ValueError:
-            local_critical(
-                "Key is expected to be an hexadecimal string",
-                support_hint=False,
-            )
-        key_hex = key.upper()
-        key_ref = int(key_hex, 16)
-
-        device = PivApp()
-        device.authenticate_admin(admin_key_bytes)
-        device.login(pin)
 
+    def generate_public_key(
+        device: PivApp, key_ref: int, algo: str
+    ) -> Union[ec.EllipticCurvePublicKey, rsa.RSAPublicKey]:
+        """Generate a key in a slot and return its public key."""
         algo = algo.lower()
         if algo == "rsa2048":
             algo_id = b"\x07"
@@ -433,7 +571,7 @@ try:  # noqa: C901
         else:
             local_critical("Unimplemented algorithm", support_hint=False)
 
-        body = Tlv.build([(0xAC, Tlv.build([(0x80, algo_id)]))])
+        body = Tlv.build([(0xAC, [(0x80, algo_id)])])
         ins = 0x47
         p1 = 0
         p2 = key_ref
@@ -443,7 +581,7 @@ try:  # noqa: C901
         data_tmp = find_by_id(0x7F49, data)
         if data_tmp is None:
             local_critical("Device did not send public key data")
-            return
+            raise click.Abort()
 
         data = Tlv.parse(data_tmp)
 
@@ -451,7 +589,7 @@ try:  # noqa: C901
             key_data = find_by_id(0x86, data)
             if key_data is None:
                 local_critical("Device did not send public key data")
-                return
+                raise click.Abort()
             key_data = key_data[1:]
             public_x = int.from_bytes(key_data[:32], byteorder="big", signed=False)
             public_y = int.from_bytes(key_data[32:], byteorder="big", signed=False)
@@ -460,46 +598,60 @@ try:  # noqa: C901
                 public_y,
                 cryptography.hazmat.primitives.asymmetric.ec.SECP256R1(),
             )
-            public_key_ecc = public_numbers_ecc.public_key()
-        elif algo == "rsa2048":
+            return public_numbers_ecc.public_key()
+        else:
             modulus_data = find_by_id(0x81, data)
             exponent_data = find_by_id(0x82, data)
             if modulus_data is None or exponent_data is None:
                 local_critical("Device did not send public key data")
-                return
+                raise click.Abort()
 
             modulus = int.from_bytes(modulus_data, byteorder="big", signed=False)
             exponent = int.from_bytes(exponent_data, byteorder="big", signed=False)
             public_numbers_rsa = rsa.RSAPublicNumbers(exponent, modulus)
-            public_key_rsa = public_numbers_rsa.public_key()
+            return public_numbers_rsa.public_key()
+
+    def build_certificates(
+        device: PivApp,
+        key_ref: int,
+        public_key: Union[ec.EllipticCurvePublicKey, rsa.RSAPublicKey],
+        domain_component: Sequence[str],
+        subject_name: Sequence[str],
+        subject_alt_name_upn: Optional[str],
+        signer: Optional[CertificateSigner] = None,
+    ) -> Tuple[x509.CertificateSigningRequest, x509.Certificate]:
+        """Create a certificate signing request signed with the key in a slot
+        and a certificate for it.  The certificate is issued by `signer`, or
+        self-signed if no signer is given."""
+        private_key: Union[P256PivSigner, RsaPivSigner]
+        if isinstance(public_key, ec.EllipticCurvePublicKey):
+            private_key = P256PivSigner(device, key_ref, public_key)
         else:
-            local_critical("Unimplemented algorithm")
+            private_key = RsaPivSigner(device, key_ref, public_key)
 
         certificate_builder = x509.CertificateBuilder()
         csr_builder = x509.CertificateSigningRequestBuilder()
 
-        if domain_component is None:
-            domain_component = []
-
-        if subject_name is None:
-            crypto_rdns = x509.Name([])
-        else:
-            crypto_rdns = x509.Name(
-                [
-                    x509.RelativeDistinguishedName(
-                        [
-                            x509.NameAttribute(x509.NameOID.DOMAIN_COMPONENT, subject)
-                            for subject in domain_component
-                        ]
-                    ),
-                    x509.RelativeDistinguishedName(
-                        [
-                            x509.NameAttribute(x509.NameOID.COMMON_NAME, subject)
-                            for subject in subject_name
-                        ]
-                    ),
-                ]
+        rdns = []
+        if domain_component:
+            rdns.append(
+                x509.RelativeDistinguishedName(
+                    [
+                        x509.NameAttribute(x509.NameOID.DOMAIN_COMPONENT, subject)
+                        for subject in domain_component
+                    ]
+                )
+            )
+        if subject_name:
+            rdns.append(
+                x509.RelativeDistinguishedName(
+                    [
+                        x509.NameAttribute(x509.NameOID.COMMON_NAME, subject)
+                        for subject in subject_name
+                    ]
+                )
             )
+        crypto_rdns = x509.Name(rdns)
 
         certificate_builder = (
             certificate_builder.subject_name(crypto_rdns)
@@ -510,35 +662,6 @@ try:  # noqa: C901
         )
         csr_builder = csr_builder.subject_name(crypto_rdns)
 
-        # SEQUENCE
-        # SEQUENCE
-        # OBJECT            :aes-256-cbc
-        # SEQUENCE
-        # OBJECT            :id-aes256-wrap
-        # SEQUENCE
-        # OBJECT            :aes-192-cbc
-        # SEQUENCE
-        # OBJECT            :id-aes192-wrap
-        # SEQUENCE
-        # OBJECT            :aes-128-cbc
-        # SEQUENCE
-        # OBJECT            :id-aes128-wrap
-        # SEQUENCE
-        # OBJECT            :des-ede3-cbc
-        # SEQUENCE
-        # OBJECT            :des-cbc
-        # SEQUENCE
-        # OBJECT            :rc2-cbc
-        # INTEGER           :80
-        # SEQUENCE
-        # OBJECT            :rc4
-        # INTEGER           :0200
-        smime_extension = bytes(
-            bytearray.fromhex(
-                "308183300B060960864801650304012A300B060960864801650304012D300B0609608648016503040116300B0609608648016503040119300B0609608648016503040102300B0609608648016503040105300A06082A864886F70D0307300706052B0E030207300E06082A864886F70D030202020080300E06082A864886F70D030402020200"
-            )
-        )
-
         crypto_extensions: Sequence[Tuple[x509.ExtensionType, bool]] = [
             (x509.BasicConstraints(ca=False, path_length=None), True),
             (
@@ -567,7 +690,7 @@ try:  # noqa: C901
             (
                 x509.UnrecognizedExtension(
                     oid=x509.oid.ObjectIdentifier("1.2.840.113549.1.9.15"),
-                    value=smime_extension,
+                    value=SMIME_CAPABILITIES,
                 ),
                 False,
             ),
@@ -595,42 +718,387 @@ try:  # noqa: C901
             )
             csr_builder = csr_builder.add_extension(crypto_sujbect_alt_name, False)
 
-        if algo == "nistp256":
-            csr = csr_builder.sign(
-                P256PivSigner(device, key_ref, public_key_ecc), hashes.SHA256()
-            )
-            certificate = certificate_builder.public_key(public_key_ecc).sign(
-                P256PivSigner(device, key_ref, public_key_ecc), hashes.SHA256()
-            )
-        elif algo == "rsa2048":
-            csr = csr_builder.sign(
-                RsaPivSigner(device, key_ref, public_key_rsa), hashes.SHA256()
-            )
-            certificate = certificate_builder.public_key(public_key_rsa).sign(
-                RsaPivSigner(device, key_ref, public_key_rsa), hashes.SHA256()
+        csr = csr_builder.sign(private_key, hashes.SHA256())
+        if signer is None:
+            certificate = certificate_builder.public_key(public_key).sign(
+                private_key, hashes.SHA256()
             )
         else:
-            local_critical("Unimplemented algorithm")
+            certificate = signer(csr)
+        return csr, certificate
+
+    def enroll_key(
+        device: PivApp,
+        key: str,
+        algo: str,
+        domain_component: Sequence[str] = (),
+        subject_name: Sequence[str] = (),
+        subject_alt_name_upn: Optional[str] = None,
+        signer: Optional[CertificateSigner] = None,
+    ) -> x509.CertificateSigningRequest:
+        """Generate a key in a slot, write a certificate for it to the slot and
+        return the certificate signing request.  The device must be
+        authenticated with the admin key and the PIN."""
+        key_hex = key.upper()
+        key_ref = int(key_hex, 16)
+        public_key = generate_public_key(device, key_ref, algo)
+        csr, certificate = build_certificates(
+            device,
+            key_ref,
+            public_key,
+            domain_component,
+            subject_name,
+            subject_alt_name_upn,
+            signer,
+        )
+        device.write_cert(
+            bytes(bytearray.fromhex(KEY_TO_CERT_OBJ_ID_MAP[key_hex])),
+            certificate.public_bytes(Encoding.DER),
+        )
+        return csr
+
+    @piv.command(help="Generate a new key and certificate signing request.")
+    @click.option(
+        "--admin-key",
+        type=click.STRING,
+        default="010203040506070801020304050607080102030405060708",
+        help="Current admin key",
+    )
+    @click.option(
+        "--key",
+        type=click.Choice(
+            [
+                "9A",
+                "9C",
+                "9D",
+                "9E",
+                "82",
+                "83",
+                "84",
+                "85",
+                "86",
+                "87",
+                "88",
+                "89",
+                "8A",
+                "8B",
+                "8C",
+                "8D",
+                "8E",
+                "8F",
+                "90",
+                "91",
+                "92",
+                "93",
+                "94",
+                "95",
+            ],
+            case_sensitive=False,
+        ),
+        default="9A",
+        help="Key slot for operation.",
+    )
+    @click.option(
+        "--algo",
+        type=click.Choice(["rsa2048", "nistp256"], case_sensitive=False),
+        default="nistp256",
+        help="Algorithm for the key.",
+    )
+    @click.option(
+        "--domain-component",
+        type=click.STRING,
+        multiple=True,
+        help="Domain component for the certificate signing request.",
+    )
+    @click.option(
+        "--subject-name",
+        type=click.STRING,
+        multiple=True,
+        help="Subject name for the certificate signing request.",
+    )
+    @click.option(
+        "--subject-alt-name-upn",
+        type=click.STRING,
+        help="Subject alternative name (UPN) for the certificate signing request.",
+    )
+    @click.option(
+        "--pin",
+        type=click.STRING,
+        prompt="Enter the PIN",
+        hide_input=True,
+        help="Current PIN.",
+    )
+    @click.option(
+        "--path",
+        type=click.Path(allow_dash=True),
+        default="-",
+        help="Write certificate signing request to path.",
+    )
+    def generate_key(
+        admin_key: str,
+        key: str,
+        algo: str,
+        domain_component: Sequence[str],
+        subject_name: Sequence[str],
+        subject_alt_name_upn: Optional[str],
+        pin: str,
+        path: str,
+    ) -> None:
+        try:
+            admin_key_bytes = bytearray.fromhex(admin_key)
+        except ValueError:
+            local_critical(
+                "Key is expected to be an hexadecimal string",
+                support_hint=False,
+            )
+
+        device = open_device()
+        device.authenticate_admin(admin_key_bytes)
+        device.login(pin)
+
+        csr = enroll_key(
+            device, key, algo, domain_component, subject_name, subject_alt_name_upn
+        )
 
         with click.open_file(path, mode="wb") as file:
             file.write(csr.public_bytes(Encoding.DER))
 
-        payload = Tlv.build(
-            [
-                (0x5C, bytes(bytearray.fromhex(KEY_TO_CERT_OBJ_ID_MAP[key_hex]))),
-                (
-                    0x53,
-                    Tlv.build(
-                        [
-                            (0x70, certificate.public_bytes(Encoding.DER)),
-                            (0x71, bytes([0])),
-                        ]
+    @dataclass
+    class EnrollmentSlot:
+        key: str
+        algo: str = "nistp256"
+        domain_component: Sequence[str] = ()
+        subject_name: Sequence[str] = ()
+        subject_alt_name_upn: Optional[str] = None
+
+    def load_manifest(manifest: TextIO) -> list[EnrollmentSlot]:
+        try:
+            data = json.load(manifest)
+            slots = [EnrollmentSlot(**slot) for slot in data["slots"]]
+        except (ValueError, KeyError, TypeError) as e:
+            raise click.ClickException(f"Invalid manifest: {e}")
+        for slot in slots:
+            for name in ["key", "algo"]:
+                if not isinstance(getattr(slot, name), str):
+                    raise click.ClickException(
+                        f"Invalid manifest: {name} must be a string"
+                    )
+            if slot.subject_alt_name_upn is not None and not isinstance(
+                slot.subject_alt_name_upn, str
+            ):
+                raise click.ClickException(
+                    "Invalid manifest: subject_alt_name_upn must be a string"
+                )
+            for name in ["domain_component", "subject_name"]:
+                value = getattr(slot, name)
+                if not isinstance(value, (list, tuple)) or not all(
+                    isinstance(item, str) for item in value
+                ):
+                    raise click.ClickException(
+                        f"Invalid manifest: {name} must be a list of strings"
+                    )
+            slot.key = slot.key.upper()
+            if slot.key not in KEY_TO_CERT_OBJ_ID_MAP:
+                raise click.ClickException(f"Invalid key slot in manifest: {slot.key}")
+            if slot.algo.lower() not in ["rsa2048", "nistp256"]:
+                raise click.ClickException(
+                    f"Invalid algorithm in manifest: {slot.algo}"
+                )
+        return slots
+
+    def ca_signer(
+        ca_cert_file: BinaryIO, ca_key_file: BinaryIO, days: int
+    ) -> CertificateSigner:
+        """Return a signer that issues certificates with a local CA."""
+        ca_cert = x509.load_pem_x509_certificate(ca_cert_file.read())
+        ca_key = serialization.load_pem_private_key(ca_key_file.read(), password=None)
+        if not isinstance(ca_key, (rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey)):
+            raise click.ClickException("The CA key must be an RSA or EC key")
+
+        def sign(csr: x509.CertificateSigningRequest) -> x509.Certificate:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            builder = (
+                x509.CertificateBuilder()
+                .subject_name(csr.subject)
+                .issuer_name(ca_cert.subject)
+                .public_key(csr.public_key())
+                .not_valid_before(now)
+                .not_valid_after(now + datetime.timedelta(days=days))
+                .serial_number(x509.random_serial_number())
+            )
+            for extension in csr.extensions:
+                builder = builder.add_extension(extension.value, extension.critical)
+            return builder.sign(ca_key, hashes.SHA256())
+
+        return sign
+
+    def enrollment_error(e: BaseException) -> str:
+        if isinstance(e, SystemExit):
+            # local_critical has already printed the error
+            return "critical error, see above"
+        return str(e) or type(e).__name__
+
+    def enroll_device(
+        device: PivApp,
+        admin_key: bytes,
+        pin: str,
+        slots: Sequence[EnrollmentSlot],
+        output_dir: str,
+        signer: Optional[CertificateSigner],
+    ) -> list[Tuple[str, Optional[str]]]:
+        """Enroll the slots on a device and return the slot and the error, or
+        None, for every slot.  Errors are not raised so that the other devices
+        are enrolled when running in a worker thread."""
+        try:
+            try:
+                device.authenticate_admin(admin_key)
+                device.login(pin)
+                serial = device.serial()
+            except (Exception, SystemExit) as e:
+                error = f"authentication failed: {enrollment_error(e)}"
+                return [(slot.key, error) for slot in slots]
+
+            results: list[Tuple[str, Optional[str]]] = []
+            for slot in slots:
+                try:
+                    csr = enroll_key(
+                        device,
+                        slot.key,
+                        slot.algo,
+                        slot.domain_component,
+                        slot.subject_name,
+                        slot.subject_alt_name_upn,
+                        signer,
+                    )
+                    path = os.path.join(output_dir, f"{serial}-{slot.key}.csr")
+                    with open(path, "wb") as f:
+                        f.write(csr.public_bytes(Encoding.DER))
+                except (Exception, SystemExit) as e:
+                    results.append((slot.key, enrollment_error(e)))
+                else:
+                    local_print(
+                        f"{device.reader()}: enrolled key {slot.key}, CSR: {path}"
+                    )
+                    results.append((slot.key, None))
+            return results
+        finally:
+            device.close()
+
+    @piv.command()
+    @click.argument("manifest", type=click.File("r"))
+    @click.option(
+        "--admin-key",
+        type=click.STRING,
+        default="010203040506070801020304050607080102030405060708",
+        help="Current admin key",
+    )
+    @click.option(
+        "--pin",
+        type=click.STRING,
+        prompt="Enter the PIN",
+        hide_input=True,
+        help="Current PIN.",
+    )
+    @click.option(
+        "--devices",
+        type=click.Choice(["default", "all"]),
+        default="default",
+        show_default=True,
+        help="Enroll the default device or all connected devices concurrently",
+    )
+    @click.option(
+        "--output-dir",
+        type=click.Path(file_okay=False, dir_okay=True, writable=True),
+        default=".",
+        help="Write the certificate signing requests to this directory.",
+    )
+    @click.option(
+        "--ca-cert",
+        type=click.File("rb"),
+        help="Issue the certificates with this CA certificate (PEM).",
+    )
+    @click.option(
+        "--ca-key",
+        type=click.File("rb"),
+        help="The unencrypted private key of the CA certificate (PEM).",
+    )
+    @click.option(
+        "--days",
+        type=click.IntRange(min=1),
+        default=365,
+        show_default=True,
+        help="Validity of the certificates issued with the CA.",
+    )
+    def enroll(
+        manifest: TextIO,
+        admin_key: str,
+        pin: str,
+        devices: str,
+        output_dir: str,
+        ca_cert: Optional[BinaryIO],
+        ca_key: Optional[BinaryIO],
+        days: int,
+    ) -> None:
+        """Generate keys and certificates for the slots in a manifest.
+
+        The manifest is a JSON object with a list of slots, for example:
+
+        \b
+        {"slots": [{"key": "9A", "algo": "nistp256", "subject_name": ["Alice"],
+                    "domain_component": ["example", "com"],
+                    "subject_alt_name_upn": "alice@example.com"}]}
+
+        For every slot, a key is generated, a certificate is written to the slot
+        and the certificate signing request is written to the output directory
+        as <serial>-<slot>.csr.  The certificates are self-signed, or issued with
+        --ca-cert and --ca-key.  Each device is authenticated once for all slots.
+        A failure on one device or slot does not stop the enrollment of the
+        others; the failed slots are listed at the end.
+        """
+        try:
+            admin_key_bytes = bytes.fromhex(admin_key)
+        except ValueError:
+            local_critical(
+                "Key is expected to be an hexadecimal string",
+                support_hint=False,
+            )
+        if (ca_cert is None) != (ca_key is None):
+            raise click.UsageError("--ca-cert and --ca-key must be used together")
+
+        slots = load_manifest(manifest)
+        signer = None
+        if ca_cert is not None and ca_key is not None:
+            signer = ca_signer(ca_cert, ca_key, days)
+
+        if devices == "all":
+            device_list = PivApp.open_all(
+                trace=click.get_current_context().meta.get(TRACE_KEY)
+            )
+            if not device_list:
+                local_critical("No PIV card found", support_hint=False)
+        else:
+            device_list = [open_device()]
+        readers = [device.reader() for device in device_list]
+        with ThreadPoolExecutor(max_workers=len(device_list)) as executor:
+            results = list(
+                executor.map(
+                    lambda device: enroll_device(
+                        device, admin_key_bytes, pin, slots, output_dir, signer
                     ),
-                ),
-            ]
-        )
+                    device_list,
+                )
+            )
 
-        device.send_receive(0xDB, 0x3F, 0xFF, payload)
+        failed = 0
+        for reader, device_results in zip(readers, results):
+            for key, error in device_results:
+                if error is not None:
+                    local_print(f"{reader}: failed to enroll key {key}: {error}")
+                    failed += 1
+        if failed:
+            raise click.ClickException(
+                f"Failed to enroll {failed} of {len(slots) * len(device_list)} slots"
+            )
 
     @piv.command(help="Write a certificate to a key slot.")
     @click.argument(
@@ -693,7 +1161,7 @@ try:  # noqa: C901
                 support_hint=False,
             )
 
-        device = PivApp()
+        device = open_device()
         device.authenticate_admin(admin_key_bytes)
 
         with click.open_file(path, mode="rb") as f:
@@ -706,15 +1174,11 @@ try:  # noqa: C901
             cert = x509.load_pem_x509_certificate(cert_bytes)
             cert_serialized = cert.public_bytes(Encoding.DER)
 
-        payload = Tlv.build(
-            [
-                (0x5C, bytes(bytearray.fromhex(KEY_TO_CERT_OBJ_ID_MAP[key.upper()]))),
-                (0x53, Tlv.build([(0x70, cert_serialized), (0x71, bytes([0]))])),
-            ]
+        device.write_cert(
+            bytes(bytearray.fromhex(KEY_TO_CERT_OBJ_ID_MAP[key.upper()])),
+            cert_serialized,
         )
 
-        device.send_receive(0xDB, 0x3F, 0xFF, payload)
-
     @piv.command(help="Read a certificate from a key slot.")
     @click.option(
         "--format",
@@ -763,7 +1227,7 @@ try:  # noqa: C901
         help="Read certificate from path.",
     )
     def read_certificate(format: str, key: str, path: str) -> None:
-        device = PivApp()
+        device = open_device()
 
         value = device.cert(
             bytes(bytearray.fromhex(KEY_TO_CERT_OBJ_ID_MAP[key.upper()]))
@@ -784,6 +1248,178 @@ try:  # noqa: C901
         with click.open_file(path, mode="wb") as f:
             f.write(cert_serialized)
 
+    def describe_certificate(value: bytes) -> dict[str, Any]:
+        cert = x509.load_der_x509_certificate(value)
+        public_key = cert.public_key()
+        if isinstance(public_key, rsa.RSAPublicKey):
+            key_algorithm = f"RSA-{public_key.key_size}"
+        elif isinstance(public_key, ec.EllipticCurvePublicKey):
+            key_algorithm = f"EC-{public_key.curve.name}"
+        else:
+            key_algorithm = type(public_key).__name__
+        return {
+            "subject": cert.subject.rfc4514_string(),
+            "issuer": cert.issuer.rfc4514_string(),
+            "serial_number": f"{cert.serial_number:x}",
+            "not_before": cert.not_valid_before_utc.isoformat(),
+            "not_after": cert.not_valid_after_utc.isoformat(),
+            "key_algorithm": key_algorithm,
+            "signature_hash": getattr(cert.signature_hash_algorithm, "name", None),
+            "fingerprint_sha256": cert.fingerprint(hashes.SHA256()).hex(),
+        }
+
+    def read_inventory(device: PivApp) -> dict[str, Any]:
+        """Read and describe the certificates of all slots of a device.
+        Errors are reported in the result instead of aborting the inventory
+        of other slots and devices."""
+        inventory: dict[str, Any] = {"reader": device.reader()}
+        try:
+            inventory["serial"] = device.serial()
+        except (StatusError, ValueError):
+            inventory["serial"] = None
+
+        slots = []
+        for key, container in KEY_TO_CERT_OBJ_ID_MAP.items():
+            slot: dict[str, Any] = {"slot": key, "container": container}
+            try:
+                value = device.read_cert(bytes.fromhex(container))
+                slot["certificate"] = describe_certificate(value) if value else None
+            except ValueError as e:
+                slot["error"] = str(e)
+            slots.append(slot)
+        inventory["slots"] = slots
+        return inventory
+
+    def try_read_inventory(device: PivApp) -> dict[str, Any]:
+        try:
+            return read_inventory(device)
+        except Exception as e:
+            return {"reader": device.reader(), "error": str(e)}
+        finally:
+            device.close()
+
+    @piv.command()
+    @click.option(
+        "--devices",
+        type=click.Choice(["default", "all"]),
+        default="default",
+        show_default=True,
+        help="Read the default device or all connected devices concurrently",
+    )
+    @click.option(
+        "--path",
+        type=click.Path(allow_dash=True),
+        default="-",
+        help="Write the inventory to path.",
+    )
+    def inventory(devices: str, path: str) -> None:
+        """List the certificates in all key slots as JSON.
+
+        For every device, the reader, the serial number and the slots with the
+        subject, issuer, validity, key algorithm and SHA-256 fingerprint of
+        their certificate are listed.  Each device is read over one connection
+        and, with --devices all, the devices are read concurrently."""
+        trace = click.get_current_context().meta.get(TRACE_KEY)
+        if devices == "all":
+            device_list = PivApp.open_all(trace=trace)
+            if not device_list:
+                local_critical("No PIV card found", support_hint=False)
+            with ThreadPoolExecutor(max_workers=len(device_list)) as executor:
+                result = list(executor.map(try_read_inventory, device_list))
+        else:
+            result = [try_read_inventory(open_device())]
+
+        with click.open_file(path, mode="w") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+
+    def read_digests(lines: TextIO) -> Iterator[bytes]:
+        for number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield bytes.fromhex(line)
+            except ValueError:
+                raise click.ClickException(f"Invalid digest on line {number}")
+
+    @piv.command()
+    @click.option(
+        "--key",
+        type=click.Choice(list(KEY_TO_CERT_OBJ_ID_MAP), case_sensitive=False),
+        default="9C",
+        help="Key slot for operation.",
+    )
+    @click.option(
+        "--algo",
+        type=click.Choice(["rsa2048", "nistp256"], case_sensitive=False),
+        default="nistp256",
+        help="Algorithm of the key.",
+    )
+    @click.option(
+        "--pin",
+        type=click.STRING,
+        prompt="Enter the PIN",
+        hide_input=True,
+        help="Current PIN.",
+    )
+    @click.option(
+        "--input",
+        "input_",
+        type=click.File("r"),
+        default="-",
+        help="Read the digests from this file.",
+    )
+    @click.option(
+        "--path",
+        type=click.Path(allow_dash=True),
+        default="-",
+        help="Write the signatures to path.",
+    )
+    def sign(key: str, algo: str, pin: str, input_: TextIO, path: str) -> None:
+        """Sign a stream of SHA-256 digests with a key.
+
+        The digests are read as hex strings, one per line, and the signatures
+        are written as hex strings, one per line, as soon as they are created.
+        ECDSA signatures are DER encoded and RSA signatures use PKCS#1 v1.5.
+        The PIN is verified once and all digests are signed over the same
+        connection.  The throughput and latency are printed at the end."""
+        algo_id = ALGO_RSA2048 if algo.lower() == "rsa2048" else ALGO_NISTP256
+        device = open_device()
+        latencies = []
+        try:
+            # verify the PIN before the time measurement starts
+            device.login(pin)
+            start = time.perf_counter()
+            with click.open_file(path, mode="w") as f:
+                signatures = device.sign_digests(
+                    read_digests(input_), int(key, 16), algo_id, pin
+                )
+                for signature, latency in signatures:
+                    latencies.append(latency)
+                    f.write(signature.hex() + "\n")
+                    f.flush()
+        except (StatusError, ValueError) as e:
+            local_critical(
+                f"Signing failed after {len(latencies)} signatures: {e}",
+                support_hint=False,
+            )
+        finally:
+            device.close()
+        elapsed = time.perf_counter() - start
+
+        local_print(
+            f"Signed {len(latencies)} digests in {elapsed:.2f} s", file=sys.stderr
+        )
+        if latencies:
+            local_print(
+                f"Throughput: {len(latencies) / elapsed:.1f} signatures/s, "
+                f"latency: mean {statistics.mean(latencies) * 1000:.1f} ms, "
+                f"median {statistics.median(latencies) * 1000:.1f} ms, "
+                f"max {max(latencies) * 1000:.1f} ms",
+                file=sys.stderr,
+            )
+
 except ImportError:
     from pynitrokey.cli.nk3.pcsc_absent import PCSC_ABSENT
 
@@ -7,6 +7,7 @@ import pathlib
 import secrets
 from enum import Enum, IntEnum, auto
 from functools import partial
+from typing import Iterator
 
 import pytest
 from _pytest.fixtures import FixtureRequest
@@ -14,6 +15,8 @@ from nitrokey.nk3.secrets_app import Instruction, SecretsApp
 
 from pynitrokey.cli.exceptions import CliException
 from pynitrokey.cli.nk3 import Context
+from pynitrokey.nethsm.mock import MockNetHSM
+from pynitrokey.testing import mock_nethsm
 
 CORPUS_PATH = "/tmp/corpus"
 
@@ -74,6 +77,13 @@ def corpus_func(request: FixtureRequest, generate_corpus_args):
     return None
 
 
+@pytest.fixture
+def mock() -> Iterator[MockNetHSM]:
+    """A mock NetHSM for the NetHSM tests."""
+    with mock_nethsm() as server:
+        yield server
+
+
 @pytest.fixture(scope="session")
 def dev():
     ctx = Context(None)
@@ -7,18 +7,26 @@ import functools
 import logging
 import os
 import platform
+import stat
 import sys
+import tempfile
 import time
 from getpass import getpass
-from importlib.metadata import version
+from importlib.metadata import PackageNotFoundError, version
 from itertools import chain
 from threading import Event, Timer
-from typing import Any, Callable, List, Optional, Tuple, TypeVar, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import click
-from nitrokey.updates import Repository
-from semver.version import Version
-from tqdm import tqdm
 
 from pynitrokey.confconsts import (
     CLI_LOG_BLACKLIST,
@@ -30,8 +38,22 @@ from pynitrokey.confconsts import (
     Verbosity,
 )
 
+if TYPE_CHECKING:
+    from tqdm import tqdm
+
 STDOUT_PRINT = True
 
+# packages whose versions are written to the log file by log_environment
+LOGGED_PACKAGES = [
+    "pynitrokey",
+    "cryptography",
+    "ecdsa",
+    "fido2",
+    "pyusb",
+]
+
+_environment_logged = False
+
 
 def normalize_parameters(s: str) -> list[str]:
     """Helper function to normalize different writing of parameters
@@ -92,7 +114,7 @@ class ProgressBar:
     """
 
     def __init__(self, **kwargs: Any) -> None:
-        self.bar: Optional[tqdm[Any]] = None
+        self.bar: Optional["tqdm[Any]"] = None
         self.kwargs = kwargs
         self.sum = 0
 
@@ -102,15 +124,20 @@ class ProgressBar:
     def __exit__(self, exc_type: None, exc_val: None, exc_tb: None) -> None:
         self.close()
 
+    def _create_bar(self, total: int) -> "tqdm[Any]":
+        from tqdm import tqdm
+
+        return tqdm(total=total, **self.kwargs)
+
     def update(self, n: int, total: int) -> None:
         if not self.bar:
-            self.bar = tqdm(total=total, **self.kwargs)
+            self.bar = self._create_bar(total)
         self.bar.update(n)
         self.sum += n
 
     def update_sum(self, n: int, total: int) -> None:
         if not self.bar:
-            self.bar = tqdm(total=total, **self.kwargs)
+            self.bar = self._create_bar(total)
         if n > self.sum:
             self.bar.update(n - self.sum)
             self.sum = n
@@ -191,6 +218,63 @@ class Retries:
         return t
 
 
+def log_environment() -> None:
+    """Write the OS, Python and package versions to the log file.
+
+    The package metadata lookups have to scan the installed distributions, so
+    this is only done once and only if the information is actually needed,
+    e. g. before asking the user to attach the log to a support request."""
+
+    global _environment_logged
+    if _environment_logged:
+        return
+    _environment_logged = True
+
+    logger = logging.getLogger(__name__)
+    logger.info(f"OS: {platform.uname()}")
+    logger.info(f"Python version: {platform.python_version()}")
+    for package in LOGGED_PACKAGES:
+        try:
+            package_version = version(package)
+        except PackageNotFoundError:
+            package_version = "not installed"
+        logger.info(f"{package} version: {package_version}")
+
+
+def agent_dir() -> str:
+    """Return the directory for the agent sockets of the current user.
+
+    The directory is created with permissions that only allow access by the
+    current user.  This is what isolates the credentials and connections
+    held by agents of different users."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        path = os.path.join(runtime_dir, "nitropy")
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"nitropy-{os.getuid()}")
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise ValueError(f"Agent directory {path} is not owned by the current user")
+    if stat.S_IMODE(st.st_mode) & 0o077:
+        raise ValueError(f"Agent directory {path} is accessible by other users")
+    return path
+
+
+def daemonize() -> bool:
+    """Fork a detached agent process.  Returns True in the child and False in
+    the parent process."""
+    if os.fork() != 0:
+        return False
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    return True
+
+
 # @todo: introduce granularization: dbg, info, err (warn?)
 #        + machine-readable
 #        + logfile-only (partly solved)
@@ -235,6 +319,7 @@ def local_critical(
     local_print(*messages, **kwargs)
 
     if support_hint:
+        log_environment()
 
         # list all connected devices to logfile
         # @fixme: not the best solution
@@ -406,6 +491,9 @@ def require_windows_admin() -> None:
 def check_pynitrokey_version() -> None:
     """Checks wether the used pynitrokey version is the latest available version and warns the user if the used version is outdated"""
 
+    from nitrokey.updates import Repository
+    from semver.version import Version
+
     latest_release = Repository("Nitrokey", "pynitrokey").get_latest_release()
     latest_version = Version.parse(latest_release.tag[1:])
 
@@ -0,0 +1,377 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Local agent that keeps an authenticated connection to a NetHSM.
+
+The agent listens on a Unix socket in a directory that is only accessible by
+the current user and forwards the REST API requests it receives to the
+NetHSM, re-using a pool of keep-alive TLS connections and injecting the
+credentials it was started with.  Clients attach to the agent by replacing
+the connection pool of the NetHSM SDK client, see `attach`.
+"""
+
+import contextlib
+import hashlib
+import http.server
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from base64 import b64encode
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import urllib3
+from nethsm import Authentication, NetHSM
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.util import parse_url
+
+from pynitrokey.helpers import agent_dir
+from pynitrokey.nethsm.bulk import set_pool_size
+
+logger = logging.getLogger(__name__)
+
+AGENT_PATH_PREFIX = "/agent/"
+DEFAULT_IDLE_TIMEOUT = 600
+DEFAULT_POOL_SIZE = 16
+# headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "content-length",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+def is_supported() -> bool:
+    return hasattr(socket, "AF_UNIX") and hasattr(socketserver, "UnixStreamServer")
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
+
+def socket_path(host: str, username: str) -> str:
+    name = f"nethsm-{_digest(host)}-{_digest(username)}.sock"
+    return os.path.join(agent_dir(), name)
+
+
+class _UnixSocketConnection(HTTPConnection):
+    def __init__(self, *args: Any, socket_path: str, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixSocketConnectionPool(HTTPConnectionPool):
+    """A urllib3 connection pool that sends all requests to a Unix socket.
+
+    Absolute URLs are reduced to their path so that the pool can be used as
+    a drop-in replacement for the pool manager of the NetHSM SDK client."""
+
+    ConnectionCls = _UnixSocketConnection
+
+    def __init__(self, socket_path: str, maxsize: int = 4) -> None:
+        super().__init__("localhost", maxsize=maxsize, socket_path=socket_path)
+
+    def urlopen(self, method: str, url: str, *args: Any, **kwargs: Any) -> Any:
+        return super().urlopen(method, parse_url(url).request_uri, *args, **kwargs)
+
+
+@dataclass
+class AgentInfo:
+    socket_path: str
+    host: str
+    username: str
+    pid: int
+    idle_timeout: int
+    requests: int
+
+
+def status(path: str) -> Optional[AgentInfo]:
+    """Query the agent listening on the given socket, or return None if there
+    is no agent or if it does not respond."""
+    if not os.path.exists(path):
+        return None
+    pool = UnixSocketConnectionPool(path, maxsize=1)
+    try:
+        response = pool.request(
+            "GET", AGENT_PATH_PREFIX + "status", retries=False, timeout=5.0
+        )
+    except (urllib3.exceptions.HTTPError, OSError) as e:
+        logger.debug(f"NetHSM agent at {path} does not respond: {e}")
+        return None
+    finally:
+        pool.close()
+    if response.status != 200:
+        return None
+    data = response.json()
+    return AgentInfo(
+        socket_path=path,
+        host=data["host"],
+        username=data["username"],
+        pid=data["pid"],
+        idle_timeout=data["idle_timeout"],
+        requests=data["requests"],
+    )
+
+
+def stop(path: str) -> bool:
+    pool = UnixSocketConnectionPool(path, maxsize=1)
+    try:
+        response = pool.request(
+            "POST", AGENT_PATH_PREFIX + "stop", retries=False, timeout=5.0
+        )
+    except (urllib3.exceptions.HTTPError, OSError):
+        return False
+    finally:
+        pool.close()
+    return response.status == 200
+
+
+def find(host: str, username: Optional[str]) -> Optional[AgentInfo]:
+    """Find a running agent for the given host and user.
+
+    If no user name is given, an agent is only used if there is exactly one
+    agent for the host."""
+    if not is_supported():
+        return None
+    try:
+        directory = agent_dir()
+    except (OSError, ValueError) as e:
+        logger.debug(f"Cannot access the NetHSM agent directory: {e}")
+        return None
+
+    if username:
+        paths = [socket_path(host, username)]
+    else:
+        prefix = f"nethsm-{_digest(host)}-"
+        paths = [
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.startswith(prefix) and name.endswith(".sock")
+        ]
+        if len(paths) != 1:
+            return None
+
+    info = status(paths[0])
+    if info is None or info.host != host:
+        return None
+    if username and info.username != username:
+        return None
+    return info
+
+
+def attach(nethsm: NetHSM, info: AgentInfo, maxsize: int = 4) -> None:
+    """Send all requests of the given client through the agent, keeping up to
+    `maxsize` connections to the agent open."""
+    rest_client = nethsm.client.rest_client
+    rest_client.pool_manager.clear()
+    rest_client.pool_manager = UnixSocketConnectionPool(info.socket_path, maxsize)  # type: ignore[assignment]
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    agent: "Agent"
+
+    def verify_request(self, request: Any, client_address: Any) -> bool:
+        # The socket directory is private to the current user, but where
+        # possible we also check the peer credentials of the connection.
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = request.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+            )
+            _, uid, _ = struct.unpack("3i", creds)
+            if uid != os.getuid():
+                logger.warning(f"Rejected connection from user {uid}")
+                return False
+        return True
+
+
+class _AgentRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: _AgentServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+    def _send(self, status: int, body: bytes, headers: dict[str, str]) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: Any) -> None:
+        body = json.dumps(data).encode()
+        self._send(status, body, {"Content-Type": "application/json"})
+
+    def _handle(self) -> None:
+        agent = self.server.agent
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else None
+
+        if self.path.startswith(AGENT_PATH_PREFIX):
+            self._handle_agent(self.path[len(AGENT_PATH_PREFIX) :])
+            return
+
+        headers = {
+            name: value
+            for name, value in self.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != "host"
+        }
+        agent.touch()
+        if "Authorization" in headers:
+            headers["Authorization"] = agent.authorization
+
+        try:
+            response = agent.forward(self.command, self.path, body, headers)
+        except Exception as e:
+            logger.warning(f"Failed to forward request to {agent.host}: {e}")
+            self._send_json(502, {"message": f"NetHSM agent request failed: {e}"})
+            return
+
+        response_headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS
+        }
+        self._send(response.status, response.data, response_headers)
+
+    def _handle_agent(self, command: str) -> None:
+        agent = self.server.agent
+        if command == "status" and self.command == "GET":
+            self._send_json(200, agent.status())
+        elif command == "stop" and self.command == "POST":
+            self._send_json(200, {})
+            agent.stop()
+        else:
+            self._send_json(404, {"message": "Unknown agent command"})
+
+    do_GET = _handle
+    do_HEAD = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_PATCH = _handle
+    do_DELETE = _handle
+    do_OPTIONS = _handle
+
+
+class Agent:
+    """Serves NetHSM API requests on a Unix socket using one authenticated
+    NetHSM client until it is stopped or idle for `idle_timeout` seconds.
+    Up to `pool_size` connections to the NetHSM are kept open for concurrent
+    requests."""
+
+    def __init__(
+        self,
+        host: str,
+        auth: Authentication,
+        verify_tls: bool,
+        idle_timeout: int = DEFAULT_IDLE_TIMEOUT,
+        pool_size: int = DEFAULT_POOL_SIZE,
+    ) -> None:
+        self.host = host
+        self.auth = auth
+        self.idle_timeout = idle_timeout
+        self.socket_path = socket_path(host, auth.username)
+        self.requests = 0
+
+        credentials = f"{auth.username}:{auth.password}".encode("latin-1")
+        self.authorization = f"Basic {b64encode(credentials).decode()}"
+
+        self._nethsm = NetHSM(host, auth=auth, verify_tls=verify_tls)
+        set_pool_size(self._nethsm, pool_size)
+        self._last_activity = time.monotonic()
+        self._lock = threading.Lock()
+        self._server: Optional[_AgentServer] = None
+
+    def touch(self) -> None:
+        with self._lock:
+            self._last_activity = time.monotonic()
+            self.requests += 1
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "host": self.host,
+            "username": self.auth.username,
+            "pid": os.getpid(),
+            "idle_timeout": self.idle_timeout,
+            "requests": self.requests,
+        }
+
+    def forward(
+        self, method: str, path: str, body: Optional[bytes], headers: dict[str, str]
+    ) -> urllib3.BaseHTTPResponse:
+        pool_manager = self._nethsm.client.rest_client.pool_manager
+        response: urllib3.BaseHTTPResponse = pool_manager.request(
+            method,
+            f"https://{self.host}{path}",
+            body=body,
+            headers=headers,
+            redirect=False,
+        )
+        return response
+
+    def bind(self) -> None:
+        """Create the socket.  A stale socket of an agent that is no longer
+        running is replaced."""
+        if os.path.exists(self.socket_path):
+            if status(self.socket_path) is not None:
+                raise ValueError(f"An agent is already running for {self.host}")
+            os.unlink(self.socket_path)
+
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _AgentServer(self.socket_path, _AgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self._server.agent = self
+
+    def serve(self) -> None:
+        if self._server is None:
+            self.bind()
+        assert self._server is not None
+
+        watchdog = threading.Thread(target=self._watch_idle, daemon=True)
+        watchdog.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            with contextlib.suppress(OSError):
+                os.unlink(self.socket_path)
+            self._nethsm.close()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+    def _watch_idle(self) -> None:
+        while True:
+            time.sleep(min(self.idle_timeout, 1))
+            with self._lock:
+                idle = time.monotonic() - self._last_activity
+            if idle >= self.idle_timeout:
+                logger.info(f"NetHSM agent idle for {int(idle)} s, stopping")
+                self.stop()
+                return
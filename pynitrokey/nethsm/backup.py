@@ -0,0 +1,260 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Streaming download and parsing of NetHSM backups.
+
+The backup format is the same as the one handled by nethsm.backup, but the
+file is memory-mapped and parsed by offset, and the items are decrypted one
+at a time, so that the memory usage does not depend on the size of the
+backup.
+"""
+
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from base64 import b64encode
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Union,
+)
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from nethsm import NetHSM, NetHSMError
+
+HEADER = b"_NETHSM_BACKUP_"
+VERSION = 0
+CHUNK_SIZE = 1024 * 1024
+IV_SIZE = 12
+
+DOWNLOAD_ERRORS = {
+    401: "Unauthorized -- invalid username or password",
+    403: "Access denied -- you need to be in the Backup role",
+    406: "Invalid request",
+    412: "NetHSM is not Operational or the backup passphrase is not set",
+}
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+def _decrypt(key: bytes, adata: bytes, data: memoryview) -> bytes:
+    if len(data) < IV_SIZE + 16:
+        raise ValueError("Failed to decrypt field: unexpected EOF")
+    try:
+        return AESGCM(key).decrypt(data[:IV_SIZE], data[IV_SIZE:], adata)
+    except InvalidTag:
+        raise ValueError(
+            "Authentication tag verification failed. The data may be tampered."
+        )
+
+
+class BackupReader:
+    """Parse an encrypted NetHSM backup from a buffer without copying it.
+
+    The metadata is validated when the reader is created.  The encrypted
+    items are only parsed when iterating over `encrypted_items` or calling
+    `validate`."""
+
+    def __init__(self, data: Buffer) -> None:
+        self.data = memoryview(data)
+        if len(self.data) < len(HEADER) + 1 or self.data[: len(HEADER)] != HEADER:
+            raise ValueError("Data does not contain a NetHSM header")
+        self.version = self.data[len(HEADER)]
+        if self.version != VERSION:
+            raise ValueError(
+                f"Version mismatch on export, provided backup version is "
+                f"{self.version}, this tool expects {VERSION}"
+            )
+
+        offset = len(HEADER) + 1
+        self.salt, offset = self._field(offset)
+        self.encrypted_version, offset = self._field(offset)
+        self.encrypted_domain_key, offset = self._field(offset)
+        self._items_offset = offset
+
+    def _field(self, offset: int) -> tuple[memoryview, int]:
+        if len(self.data) - offset < 3:
+            raise ValueError("Failed to read field length: unexpected EOF")
+        high, low = struct.unpack_from(">BH", self.data, offset)
+        n = (high << 16) + low
+        offset += 3
+        if len(self.data) - offset < n:
+            raise ValueError("Failed to extract field: unexpected EOF")
+        return self.data[offset : offset + n], offset + n
+
+    def encrypted_items(self) -> Iterator[memoryview]:
+        offset = self._items_offset
+        while offset < len(self.data):
+            item, offset = self._field(offset)
+            yield item
+
+    def validate(self) -> int:
+        """Check the structure of all items and return the number of items."""
+        return sum(1 for _ in self.encrypted_items())
+
+    def key(self, passphrase: str) -> bytes:
+        return hashlib.scrypt(
+            password=passphrase.encode(),
+            salt=bytes(self.salt),
+            n=16384,
+            r=8,
+            p=16,
+            dklen=32,
+        )
+
+    def decrypt_metadata(self, key: bytes) -> tuple[int, bytes]:
+        """Decrypt and check the version and return it with the domain key."""
+        version_bytes = _decrypt(key, b"backup-version", self.encrypted_version)
+        if len(version_bytes) != 1:
+            raise ValueError(f"Overlong version: {version_bytes!r}")
+        version = version_bytes[0]
+        if version != self.version:
+            raise ValueError(
+                f"Internal and external version mismatch ({version} != {self.version})."
+            )
+        domain_key = _decrypt(key, b"domain-key", self.encrypted_domain_key)
+        return version, domain_key
+
+    def decrypt_items(self, key: bytes) -> Iterator[tuple[str, bytes]]:
+        """Decrypt the key-value pairs one at a time."""
+        for item in self.encrypted_items():
+            try:
+                pair = memoryview(_decrypt(key, b"backup", item))
+            finally:
+                item.release()
+            if len(pair) < 3:
+                raise ValueError("Failed to read field length: unexpected EOF")
+            high, low = struct.unpack_from(">BH", pair)
+            n = (high << 16) + low
+            if len(pair) - 3 < n:
+                raise ValueError("Failed to extract field: unexpected EOF")
+            yield bytes(pair[3 : 3 + n]).decode(), bytes(pair[3 + n :])
+
+    def release(self) -> None:
+        for view in [
+            self.salt,
+            self.encrypted_version,
+            self.encrypted_domain_key,
+            self.data,
+        ]:
+            view.release()
+
+
+def export_entries(reader: BackupReader, key: bytes) -> Iterator[tuple[str, Any]]:
+    """Decrypt a backup with the key derived from the backup passphrase and
+    yield its content as JSON-compatible name-value pairs, starting with the
+    .locked-domain-key and .version entries and followed by the key-value data
+    encoded with Base64."""
+    version, domain_key = reader.decrypt_metadata(key)
+    yield ".locked-domain-key", b64encode(domain_key).decode()
+    yield ".version", version
+    for name, value in reader.decrypt_items(key):
+        yield name, b64encode(value).decode()
+
+
+def diff_entries(
+    old: Iterable[tuple[str, Any]], new: Iterable[tuple[str, Any]]
+) -> Iterator[tuple[str, str, Any]]:
+    """Compare two exports and yield (change, name, value) for every entry
+    that was added, changed or removed in `new`.
+
+    Only a digest of every entry of `old` is kept in memory.  Added and
+    changed entries are yielded in the order of `new`, followed by the
+    removed entries with the value None."""
+    digests = {name: _digest(value) for name, value in old}
+    for name, value in new:
+        digest = digests.pop(name, None)
+        if digest is None:
+            yield "added", name, value
+        elif digest != _digest(value):
+            yield "changed", name, value
+    for name in digests:
+        yield "removed", name, None
+
+
+def _digest(value: Any) -> bytes:
+    return hashlib.sha256(json.dumps(value).encode()).digest()
+
+
+@contextlib.contextmanager
+def open_backup(filename: str) -> Iterator[BackupReader]:
+    """Memory-map a backup file and parse its metadata."""
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Data does not contain a NetHSM header")
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = BackupReader(m)
+            try:
+                yield reader
+            finally:
+                reader.release()
+        finally:
+            try:
+                m.close()
+            except BufferError:
+                # Views of the mapping are still referenced, e. g. by a
+                # traceback.  The mapping is closed when they are collected.
+                pass
+
+
+def download(
+    nethsm: NetHSM,
+    f: BinaryIO,
+    chunk_size: int = CHUNK_SIZE,
+    progress: Optional[Callable[[int], None]] = None,
+) -> int:
+    """Download a backup and write it to `f` in chunks.  Returns the size of
+    the backup."""
+    url = f"https://{nethsm.host}/api/{nethsm.version}/system/backup"
+    headers = {}
+    if nethsm.auth:
+        credentials = f"{nethsm.auth.username}:{nethsm.auth.password}"
+        headers["Authorization"] = f"Basic {b64encode(credentials.encode()).decode()}"
+
+    response = nethsm.client.rest_client.request(
+        "POST", url, headers=headers, stream=True  # type: ignore[arg-type]
+    )
+    try:
+        if response.status != 200:
+            message = DOWNLOAD_ERRORS.get(
+                response.status, f"Unexpected response status {response.status}"
+            )
+            raise NetHSMError(message)
+
+        size = 0
+        for chunk in response.stream(chunk_size):
+            f.write(chunk)
+            size += len(chunk)
+            if progress:
+                progress(size)
+        return size
+    finally:
+        response.release_conn()
+
+
+@contextlib.contextmanager
+def temporary_file(filename: str) -> Iterator[BinaryIO]:
+    """Create a temporary file next to `filename` that is moved to `filename`
+    if the block succeeds and removed otherwise."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".nethsm-backup-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        if os.path.exists(filename):
+            raise FileExistsError(f"Backup file {filename} already exists")
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,104 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Throughput and latency measurement for NetHSM operations.
+"""
+
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+MAX_ERROR_MESSAGES = 5
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Return the p-th percentile of sorted values (nearest rank)."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+@dataclass
+class BenchResult:
+    operation: str
+    jobs: int
+    elapsed: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    errors: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def count(self) -> int:
+        return len(self.latencies) + sum(self.errors.values())
+
+    @property
+    def ops_per_second(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def latency(self, p: float) -> float:
+        return percentile(sorted(self.latencies), p)
+
+    def to_json(self) -> dict[str, Any]:
+        latencies = sorted(self.latencies)
+        return {
+            "operation": self.operation,
+            "jobs": self.jobs,
+            "count": self.count,
+            "errors": sum(self.errors.values()),
+            "elapsed": round(self.elapsed, 6),
+            "ops_per_second": round(self.ops_per_second, 3),
+            "latency": {
+                f"p{p}": round(percentile(latencies, p), 6) for p in (50, 95, 99)
+            }
+            | {"max": round(latencies[-1], 6) if latencies else 0.0},
+            "error_messages": dict(self.errors.most_common(MAX_ERROR_MESSAGES)),
+        }
+
+
+def run(
+    operation: str,
+    fn: Callable[[], Any],
+    count: int,
+    jobs: int,
+    warmup: int = 0,
+) -> BenchResult:
+    """Call `fn` `count` times on `jobs` threads and measure the latency of
+    every call.  Exceptions are counted as errors by message.  The `warmup`
+    calls are executed first and not measured, e. g. to open the connections
+    of the pool."""
+    result = BenchResult(operation=operation, jobs=jobs)
+    lock = threading.Lock()
+
+    def call(_: int) -> None:
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            with lock:
+                result.errors[str(e) or type(e).__name__] += 1
+        else:
+            latency = time.perf_counter() - start
+            with lock:
+                result.latencies.append(latency)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if warmup:
+            for _ in executor.map(lambda _: _ignore_errors(fn), range(warmup)):
+                pass
+        start = time.perf_counter()
+        for _ in executor.map(call, range(count)):
+            pass
+        result.elapsed = time.perf_counter() - start
+
+    return result
+
+
+def _ignore_errors(fn: Callable[[], Any]) -> None:
+    try:
+        fn()
+    except Exception:
+        pass
@@ -0,0 +1,238 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Helpers for commands that execute many NetHSM requests over one connection.
+"""
+
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    TextIO,
+    TypeVar,
+)
+
+from nethsm import NetHSM
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# The maximum length of a single random data request
+MAX_RANDOM_LENGTH = 1024
+
+
+class InputFormat(Enum):
+    BASE64 = "base64"
+    JSONL = "jsonl"
+
+
+@dataclass
+class Item:
+    """A single input of a bulk operation.
+
+    For the base64 format, `id` is the line number and `data` the content of
+    the line.  For the JSONL format, `id` and `data` are read from the fields
+    of the same name and all other fields are available in `fields`."""
+
+    id: Any
+    data: str
+    fields: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class Result:
+    item: Item
+    value: Optional[dict[str, str]] = None
+    error: Optional[str] = None
+
+
+def set_pool_size(nethsm: NetHSM, size: int) -> None:
+    """Keep up to `size` connections to the NetHSM open so that concurrent
+    requests can re-use them instead of opening new connections."""
+    pool_manager = nethsm.client.rest_client.pool_manager
+    pool_manager.connection_pool_kw["maxsize"] = size
+    pool_manager.clear()
+
+
+def read_items(
+    f: TextIO,
+    format: InputFormat,
+    columns: Sequence[str] = (),
+    data_fields: Sequence[str] = ("data",),
+) -> Iterator[Item]:
+    """Lazily read items from a file, skipping empty lines.
+
+    In the base64 format, a line may contain additional values separated by
+    whitespace that are stored in the fields with the names given in
+    `columns`, e. g. the initialization vector for decryption.  In the JSONL
+    format, the data is read from the first of the `data_fields` that is
+    set, e. g. to accept the output of another bulk command."""
+    for i, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if format == InputFormat.BASE64:
+            data, *values = line.split()
+            if len(values) > len(columns):
+                raise ValueError(f"Line {i} has too many values: {line}")
+            yield Item(id=i, data=data, fields=dict(zip(columns, values)))
+        else:
+            try:
+                fields = json.loads(line)
+                item_id = fields.pop("id", i)
+                name = next(name for name in data_fields if name in fields)
+                data = fields.pop(name)
+            except (ValueError, StopIteration, AttributeError, TypeError):
+                raise ValueError(
+                    f"Line {i} is not a JSON object with a {data_fields[0]} field: {line}"
+                )
+            yield Item(id=item_id, data=data, fields=fields)
+
+
+def write_result(f: TextIO, format: InputFormat, result: Result) -> None:
+    """Write one result line.  In the base64 format, the values are written
+    separated by spaces and errors are written to stderr, leaving an empty
+    line in the output so that the output lines match the input lines."""
+    if format == InputFormat.BASE64:
+        if result.error is not None:
+            print(f"Line {result.item.id}: {result.error}", file=sys.stderr)
+            print(file=f)
+        else:
+            assert result.value is not None
+            print(*result.value.values(), file=f)
+    else:
+        data: dict[str, Any] = {"id": result.item.id}
+        if result.error is not None:
+            data["error"] = result.error
+        else:
+            assert result.value is not None
+            data.update(result.value)
+        print(json.dumps(data), file=f)
+    f.flush()
+
+
+def ordered_map(fn: Callable[[T], R], items: Iterable[T], jobs: int) -> Iterator[R]:
+    """Apply `fn` to the items on `jobs` worker threads and yield the results
+    in input order as soon as they are available.
+
+    At most twice as many items as workers are in flight, so that the input
+    is consumed lazily and the memory usage is bounded."""
+    if jobs <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    pending: deque[Future[R]] = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def chunk_lengths(
+    length: Optional[int], chunk_size: int = MAX_RANDOM_LENGTH
+) -> Iterator[int]:
+    """Split `length` into chunks of at most `chunk_size`.  If `length` is
+    None, full chunks are generated without end."""
+    if length is None:
+        while True:
+            yield chunk_size
+    while length > 0:
+        yield min(length, chunk_size)
+        length -= chunk_size
+
+
+def random_stream(nethsm: NetHSM, length: Optional[int], jobs: int) -> Iterator[bytes]:
+    """Yield `length` random bytes (or an endless stream if `length` is None)
+    in chunks, keeping up to `jobs` requests in flight."""
+
+    def get_random_data(n: int) -> bytes:
+        return nethsm.get_random_data(n).decode()
+
+    return ordered_map(get_random_data, chunk_lengths(length), jobs)
+
+
+class Progress:
+    """Show the number of processed bytes and the throughput on a single line
+    of a terminal, updated at most every `interval` seconds.  Nothing is
+    printed if `file` is not a terminal."""
+
+    def __init__(
+        self, operation: str, file: TextIO = sys.stderr, interval: float = 0.5
+    ) -> None:
+        self.operation = operation
+        self.file = file
+        self.interval = interval
+        self.enabled = file.isatty()
+        self.start = time.monotonic()
+        self.last = 0.0
+        self.printed = False
+
+    def update(self, size: int) -> None:
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = size / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+        print(
+            f"\r{self.operation} {size / 1024 / 1024:.1f} MiB ({rate:.1f} MiB/s)",
+            end="",
+            file=self.file,
+            flush=True,
+        )
+        self.printed = True
+
+    def close(self) -> None:
+        if self.printed:
+            print(file=self.file)
+
+
+def report_throughput(
+    operation: str, size: int, start: float, file: TextIO = sys.stderr
+) -> None:
+    """Print the throughput of an operation on `size` bytes that was started
+    at `start` (as returned by time.monotonic)."""
+    elapsed = time.monotonic() - start
+    rate = size / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+    print(f"{operation} {size} bytes in {elapsed:.2f} s ({rate:.1f} MiB/s)", file=file)
+
+
+class Throughput:
+    """Count the operations of a bulk command and report the throughput."""
+
+    def __init__(self, operation: str) -> None:
+        self.operation = operation
+        self.count = 0
+        self.errors = 0
+        self.start = time.monotonic()
+
+    def add(self, result: Result) -> None:
+        self.count += 1
+        if result.error is not None:
+            self.errors += 1
+
+    def report(self, file: TextIO = sys.stderr) -> None:
+        elapsed = time.monotonic() - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        print(
+            f"{self.operation}: {self.count} items in {elapsed:.2f} s "
+            f"({rate:.1f} items/s), {self.errors} errors",
+            file=file,
+        )
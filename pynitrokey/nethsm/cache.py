@@ -0,0 +1,232 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+On-disk cache for the metadata of NetHSM keys.
+
+The type, mechanisms, tags and public key of a key only change if the key is
+replaced, so they are cached per host and namespace for a limited time.  The
+cache only contains public information.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Iterable, Optional
+
+from nethsm import (
+    Base64,
+    EcPublicKey,
+    Key,
+    KeyMechanism,
+    KeyType,
+    NetHSM,
+    PublicKey,
+    RsaPublicKey,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300
+CACHE_VERSION = 1
+
+
+def cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "pynitrokey", "nethsm")
+
+
+def namespace(username: Optional[str]) -> str:
+    """Return the namespace of a NetHSM user.  Key IDs are only unique within
+    a namespace, users in the root namespace have no prefix."""
+    if username and "~" in username:
+        return username.split("~", maxsplit=1)[0]
+    return ""
+
+
+def _encode_public_key(public_key: PublicKey) -> Optional[dict[str, str]]:
+    if isinstance(public_key, RsaPublicKey):
+        return {
+            "modulus": public_key.modulus.data,
+            "public_exponent": public_key.public_exponent.data,
+        }
+    elif isinstance(public_key, EcPublicKey):
+        return {"data": public_key.data.data}
+    return None
+
+
+def _decode_public_key(data: Optional[dict[str, str]]) -> PublicKey:
+    if data is None:
+        return None
+    elif "modulus" in data:
+        return RsaPublicKey(
+            modulus=Base64.from_encoded(data["modulus"]),
+            public_exponent=Base64.from_encoded(data["public_exponent"]),
+        )
+    else:
+        return EcPublicKey(data=Base64.from_encoded(data["data"]))
+
+
+class KeyCache:
+    """Cache of the key metadata for one host and namespace.
+
+    Entries older than `ttl` seconds are ignored.  If `refresh` is set, all
+    entries are ignored and replaced with the current data.  A `ttl` of zero
+    disables the cache.  Changes are only written to disk by `save`."""
+
+    def __init__(
+        self,
+        host: str,
+        namespace: str = "",
+        ttl: float = DEFAULT_TTL,
+        refresh: bool = False,
+    ) -> None:
+        self.ttl = ttl
+        self.refresh = refresh
+        digest = hashlib.sha256(f"{host}\0{namespace}".encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir(), f"keys-{digest}.json")
+        self.entries: dict[str, dict[str, Any]] = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if self.enabled:
+            self.entries = self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.debug(f"Ignoring unreadable key cache {self.path}: {e}")
+            return {}
+        if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+            return {}
+        entries = data.get("keys")
+        return entries if isinstance(entries, dict) else {}
+
+    def save(self) -> None:
+        """Write the cache to disk if it has been changed.  Expired entries are
+        dropped.  Errors are logged but otherwise ignored."""
+        if not self.enabled or not self.dirty:
+            return
+        now = time.time()
+        with self.lock:
+            entries = {
+                key_id: entry
+                for key_id, entry in self.entries.items()
+                if now - entry.get("time", 0) < self.ttl
+            }
+            self.dirty = False
+
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".keys-", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"version": CACHE_VERSION, "keys": entries}, f)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            logger.warning(f"Could not write the key cache {self.path}: {e}")
+
+    def _lookup(self, key_id: str, field: str) -> Any:
+        if not self.enabled or self.refresh:
+            return None
+        with self.lock:
+            entry = self.entries.get(key_id)
+        if entry is None or field not in entry:
+            return None
+        if time.time() - entry.get("time", 0) >= self.ttl:
+            return None
+        return entry[field]
+
+    def _store(self, key_id: str, field: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.entries.get(key_id)
+            now = time.time()
+            if entry is None or now - entry.get("time", 0) >= self.ttl:
+                # Do not mix fresh data with data from an expired entry
+                entry = {"time": now}
+                self.entries[key_id] = entry
+            entry[field] = value
+            self.dirty = True
+
+    def get_key(self, nethsm: NetHSM, key_id: str) -> Key:
+        """Return the cached metadata of a key or query and cache it.
+
+        The operation counter of a cached key can be outdated."""
+        data = self._lookup(key_id, "key")
+        if data is not None:
+            try:
+                return Key(
+                    key_id=key_id,
+                    type=KeyType.from_string(data["type"]),
+                    mechanisms=[
+                        KeyMechanism.from_string(m) for m in data["mechanisms"]
+                    ],
+                    operations=data["operations"],
+                    tags=data["tags"],
+                    public_key=_decode_public_key(data["public_key"]),
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                logger.debug(f"Ignoring invalid cache entry for key {key_id}: {e}")
+
+        key = nethsm.get_key(key_id)
+        self._store(
+            key_id,
+            "key",
+            {
+                "type": key.type.value,
+                "mechanisms": [m.value for m in key.mechanisms],
+                "operations": key.operations,
+                "tags": key.tags,
+                "public_key": _encode_public_key(key.public_key),
+            },
+        )
+        return key
+
+    def get_key_public_key(self, nethsm: NetHSM, key_id: str) -> str:
+        """Return the cached public key in PEM format or query and cache it."""
+        cached = self._lookup(key_id, "public_key_pem")
+        if isinstance(cached, str):
+            return cached
+        pem = nethsm.get_key_public_key(key_id)
+        self._store(key_id, "public_key_pem", pem)
+        return pem
+
+    def retain(self, key_ids: Iterable[str]) -> None:
+        """Remove the entries of keys that are not in `key_ids`, i. e. of keys
+        that have been deleted since they were cached."""
+        key_ids = set(key_ids)
+        with self.lock:
+            for key_id in list(self.entries):
+                if key_id not in key_ids:
+                    del self.entries[key_id]
+                    self.dirty = True
+
+    def invalidate(self, key_id: str) -> None:
+        with self.lock:
+            if self.entries.pop(key_id, None) is not None:
+                self.dirty = True
+
+    def clear(self) -> None:
+        with self.lock:
+            if self.entries:
+                self.entries.clear()
+                self.dirty = True
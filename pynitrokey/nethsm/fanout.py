@@ -0,0 +1,128 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Run a NetHSM command against multiple hosts concurrently.
+
+The command is executed once per host on a worker thread.  The output that a
+worker writes to stdout is captured per thread, so that the results can be
+reported per host after all workers are done.  A command reports a failure
+on a host by raising `HostError`.
+"""
+
+import io
+import json
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional, TextIO
+
+from pynitrokey.nethsm import bulk
+
+DEFAULT_JOBS = 16
+
+_local = threading.local()
+
+
+class HostError(Exception):
+    """The command failed on a host.  The message is reported as the error of
+    the host."""
+
+
+def is_worker() -> bool:
+    """Return whether the current thread executes a command for one of
+    multiple hosts.  Workers must not prompt the user."""
+    return getattr(_local, "output", None) is not None
+
+
+class _ThreadLocalStdout:
+    """Redirect writes of worker threads to their output buffers and pass
+    everything else through to the original stream."""
+
+    def __init__(self, stream: TextIO) -> None:
+        self._stream = stream
+
+    def _target(self) -> TextIO:
+        output: Optional[TextIO] = getattr(_local, "output", None)
+        return output if output is not None else self._stream
+
+    def write(self, s: str) -> int:
+        return self._target().write(s)
+
+    def flush(self) -> None:
+        self._target().flush()
+
+    def isatty(self) -> bool:
+        return not is_worker() and self._stream.isatty()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._stream, name)
+
+
+@dataclass
+class HostResult:
+    host: str
+    latency: float
+    output: str
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_json(self) -> dict[str, Any]:
+        # Embed the output of commands that print JSON as a JSON value
+        output: Any = self.output
+        try:
+            output = json.loads(self.output)
+        except ValueError:
+            pass
+        return {
+            "host": self.host,
+            "ok": self.ok,
+            "latency": round(self.latency, 6),
+            "output": output,
+            "error": self.error,
+        }
+
+
+def read_inventory(f: TextIO) -> list[str]:
+    """Read one host per line, ignoring empty lines and comments."""
+    hosts = []
+    for line in f:
+        line = line.split("#", maxsplit=1)[0].strip()
+        if line:
+            hosts.append(line)
+    return hosts
+
+
+def _run_host(fn: Callable[[str], None], host: str) -> HostResult:
+    output = io.StringIO()
+    error = None
+    _local.output = output
+    start = time.monotonic()
+    try:
+        fn(host)
+    except HostError as e:
+        error = str(e)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        latency = time.monotonic() - start
+        _local.output = None
+    return HostResult(host=host, latency=latency, output=output.getvalue(), error=error)
+
+
+def run(
+    hosts: Iterable[str], fn: Callable[[str], None], jobs: int = DEFAULT_JOBS
+) -> list[HostResult]:
+    """Call `fn` for every host on up to `jobs` threads and return the results
+    in the order of the hosts.  Failures are recorded in the results instead
+    of aborting the run."""
+    stdout = sys.stdout
+    sys.stdout = _ThreadLocalStdout(stdout)  # type: ignore[assignment]
+    try:
+        return list(bulk.ordered_map(lambda host: _run_host(fn, host), hosts, jobs))
+    finally:
+        sys.stdout = stdout
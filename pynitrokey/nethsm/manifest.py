@@ -0,0 +1,166 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Manifests describing keys to generate on or import into a NetHSM.
+
+A manifest is a list of key specifications with the fields id, type, length,
+mechanisms, tags and pem.  Keys with a pem field are imported from the PEM
+file at that path (relative to the manifest), all other keys are generated.
+Manifests can be written in JSON (a list or an object with a "keys" list),
+YAML (the same structure, requires PyYAML) or CSV (one key per row with a
+header row).  In CSV files and for convenience in the other formats,
+mechanisms and tags can be given as a string separated by whitespace, commas
+or semicolons.
+"""
+
+import csv
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Optional
+
+from nethsm import KeyMechanism, KeyType
+
+FIELDS = ["id", "type", "length", "mechanisms", "tags", "pem"]
+
+# The length of the curves, used if the length is not set in the manifest
+CURVE_LENGTHS = {
+    KeyType.CURVE25519: 255,
+    KeyType.EC_P224: 224,
+    KeyType.EC_P256: 256,
+    KeyType.EC_P384: 384,
+    KeyType.EC_P521: 521,
+}
+
+
+class ManifestFormat(Enum):
+    JSON = "json"
+    YAML = "yaml"
+    CSV = "csv"
+
+    @staticmethod
+    def from_filename(filename: str) -> "ManifestFormat":
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in (".yaml", ".yml"):
+            return ManifestFormat.YAML
+        if extension == ".csv":
+            return ManifestFormat.CSV
+        return ManifestFormat.JSON
+
+
+@dataclass
+class KeySpec:
+    id: str
+    type: Optional[KeyType] = None
+    length: Optional[int] = None
+    mechanisms: list[KeyMechanism] = field(default_factory=list)
+    tags: list[str] = field(default_factory=list)
+    pem: Optional[str] = None
+
+    @property
+    def action(self) -> str:
+        return "import" if self.pem else "generate"
+
+    def read_pem(self) -> str:
+        assert self.pem
+        with open(self.pem) as f:
+            return f.read()
+
+
+def _split(value: Any) -> list[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [s for s in re.split(r"[\s,;]+", value) if s]
+    if isinstance(value, list):
+        return [str(s) for s in value]
+    raise ValueError(f"Expected a list or a string, got {value!r}")
+
+
+def parse_key_spec(data: Any, directory: str = ".") -> KeySpec:
+    """Parse and validate one key specification.  Relative PEM paths are
+    resolved against `directory`."""
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected an object, got {data!r}")
+    unknown = set(data) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    key_id = data.get("id")
+    if not key_id:
+        raise ValueError("Missing key ID")
+    spec = KeySpec(id=str(key_id))
+
+    if data.get("type"):
+        spec.type = KeyType.from_string(str(data["type"]))
+    if data.get("length") not in (None, ""):
+        try:
+            spec.length = int(data["length"])
+        except ValueError:
+            raise ValueError(f"Invalid length {data['length']!r}")
+    spec.mechanisms = [
+        KeyMechanism.from_string(m) for m in _split(data.get("mechanisms"))
+    ]
+    spec.tags = _split(data.get("tags"))
+    if data.get("pem"):
+        spec.pem = os.path.join(directory, str(data["pem"]))
+        if spec.length is not None:
+            raise ValueError("The length must not be set for imported keys")
+    else:
+        if spec.type is None:
+            raise ValueError("Missing type for generated key")
+        if spec.length is None:
+            spec.length = CURVE_LENGTHS.get(spec.type)
+        if spec.length is None:
+            raise ValueError(f"Missing length for generated {spec.type.value} key")
+    return spec
+
+
+def _load(filename: str, format: ManifestFormat) -> list[Any]:
+    with open(filename, newline="") as f:
+        if format == ManifestFormat.CSV:
+            return [
+                {name: value for name, value in row.items() if name and value}
+                for row in csv.DictReader(f)
+            ]
+        if format == ManifestFormat.YAML:
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML must be installed to read YAML manifests")
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid YAML: {e}")
+        else:
+            data = json.load(f)
+
+    if isinstance(data, dict) and "keys" in data:
+        data = data["keys"]
+    if not isinstance(data, list):
+        raise ValueError("Expected a list of keys or an object with a keys field")
+    return data
+
+
+def read_manifest(
+    filename: str, format: Optional[ManifestFormat] = None
+) -> list[KeySpec]:
+    """Read and validate all key specifications of a manifest.  The format is
+    determined from the file extension if not set."""
+    format = format or ManifestFormat.from_filename(filename)
+    directory = os.path.dirname(os.path.abspath(filename))
+    specs = []
+    ids = set()
+    for i, data in enumerate(_load(filename, format), start=1):
+        try:
+            spec = parse_key_spec(data, directory)
+        except ValueError as e:
+            raise ValueError(f"Key {i}: {e}")
+        if spec.id in ids:
+            raise ValueError(f"Key {i}: Duplicate key ID {spec.id}")
+        ids.add(spec.id)
+        specs.append(spec)
+    return specs
@@ -0,0 +1,189 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Periodic scraping of NetHSM metrics and export in the Prometheus text format.
+"""
+
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "nethsm_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The metrics of the NetHSM that count events since its start.  All other
+# metrics, e. g. the memory usage or the response time, are gauges.
+COUNTERS = re.compile(
+    r"(http response \d+|http total requests|requests|kv write"
+    r"|log (errors|warnings)|gc (compactions|major collections|minor collections))"
+)
+
+
+def is_counter(name: str) -> bool:
+    return COUNTERS.fullmatch(name.lower()) is not None
+
+
+def metric_name(name: str) -> str:
+    """Convert a NetHSM metric name into a valid Prometheus metric name."""
+    name = re.sub(r"[^a-zA-Z0-9_]+", "_", name).strip("_").lower()
+    return PREFIX + name
+
+
+def numeric_value(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+@dataclass
+class Sample:
+    """The numeric metrics of one scrape and the rates per second of the
+    counters since the previous scrape."""
+
+    time: float
+    values: dict[str, float] = field(default_factory=dict)
+    rates: dict[str, float] = field(default_factory=dict)
+
+
+class MetricsState:
+    """Keep the last scrape of a host and compute the rates of the counters.
+
+    A decreasing counter is treated as a reset, e. g. after a reboot, and no
+    rate is reported for it in this scrape.  The time of a scrape is taken
+    from the monotonic clock."""
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.sample: Optional[Sample] = None
+        self.up = False
+        self.scrapes = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def update(self, metrics: Mapping[str, Any], now: Optional[float] = None) -> Sample:
+        now = time.monotonic() if now is None else now
+        sample = Sample(time=now)
+        for name, value in metrics.items():
+            number = numeric_value(value)
+            if number is not None:
+                sample.values[str(name)] = number
+
+        with self.lock:
+            previous = self.sample
+            if previous is not None and now > previous.time:
+                elapsed = now - previous.time
+                for name, value in sample.values.items():
+                    if not is_counter(name):
+                        continue
+                    last = previous.values.get(name)
+                    if last is not None and value >= last:
+                        sample.rates[name] = (value - last) / elapsed
+            self.sample = sample
+            self.up = True
+            self.scrapes += 1
+        return sample
+
+    def failed(self) -> None:
+        with self.lock:
+            self.up = False
+            self.scrapes += 1
+            self.errors += 1
+
+    def to_prometheus(self) -> str:
+        """Format the last scrape in the Prometheus text exposition format."""
+        labels = f'{{host="{_escape_label(self.host)}"}}'
+        lines = []
+
+        def add(name: str, help: str, value: float, type: str = "gauge") -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            lines.append(f"{name}{labels} {value!r}")
+
+        with self.lock:
+            add(f"{PREFIX}up", "Whether the last scrape succeeded", int(self.up))
+            add(
+                f"{PREFIX}scrapes_total",
+                "Number of scrapes",
+                self.scrapes,
+                type="counter",
+            )
+            add(
+                f"{PREFIX}scrape_errors_total",
+                "Number of failed scrapes",
+                self.errors,
+                type="counter",
+            )
+            if self.sample is not None:
+                for name, value in sorted(self.sample.values.items()):
+                    add(
+                        metric_name(name),
+                        f"NetHSM metric {name}",
+                        value,
+                        type="counter" if is_counter(name) else "gauge",
+                    )
+                for name, rate in sorted(self.sample.rates.items()):
+                    add(
+                        metric_name(name) + "_rate",
+                        f"Rate of change of the NetHSM metric {name} per second",
+                        rate,
+                    )
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def do_GET(self) -> None:
+        if self.path.split("?", maxsplit=1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.state.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serve the last scrape of a host at /metrics."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], state: MetricsState) -> None:
+        super().__init__(address, _MetricsRequestHandler)
+        self.state = state
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_listen_address(value: str) -> tuple[str, int]:
+    """Parse [HOST:]PORT, binding to localhost by default."""
+    host, sep, port = value.rpartition(":")
+    if not sep:
+        host = "127.0.0.1"
+    host = host.strip("[]")
+    try:
+        return (host, int(port))
+    except ValueError:
+        raise ValueError(f"Invalid listen address {value}, expected [HOST:]PORT")
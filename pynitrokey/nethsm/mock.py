@@ -0,0 +1,377 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+A minimal mock of the NetHSM REST API for benchmarks and tests.
+
+The mock serves an operational NetHSM with one user and a fixed set of keys
+over HTTPS with a self-signed certificate.  It implements the endpoints that
+are needed to query keys and to sign, encrypt and decrypt data, but it does
+not perform real cryptographic operations:  signatures are SHA-256 digests,
+and encrypt and decrypt return their input.  Generated keys have no key
+material, and key tags can be added.  A backup file can be set that is
+returned by the backup endpoint.  An artificial delay can be configured to
+simulate the processing time of an appliance.
+
+Run it with `python -m pynitrokey.nethsm.mock [PORT]`.
+"""
+
+import base64
+import datetime
+import hashlib
+import json
+import os
+import re
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+DEFAULT_USERNAME = "operator"
+DEFAULT_PASSWORD = "operator-passphrase"
+
+API_PREFIX = "/api/v1/"
+MAX_RANDOM_LENGTH = 1024
+
+
+@dataclass
+class MockKey:
+    type: str
+    mechanisms: list[str]
+    public: dict[str, str] = field(default_factory=dict)
+    public_pem: Optional[str] = None
+    operations: int = 0
+    tags: list[str] = field(default_factory=list)
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def _int_b64(n: int) -> str:
+    return _b64(n.to_bytes((n.bit_length() + 7) // 8, "big"))
+
+
+def _random_public(key_type: str) -> dict[str, str]:
+    if key_type == "Generic":
+        return {}
+    if key_type == "RSA":
+        return {"modulus": _b64(os.urandom(256)), "publicExponent": _int_b64(65537)}
+    return {"data": _b64(os.urandom(32))}
+
+
+def default_keys() -> dict[str, MockKey]:
+    rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    numbers = rsa_key.public_key().public_numbers()
+    rsa_pem = (
+        rsa_key.public_key()
+        .public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        .decode()
+    )
+    return {
+        "ed25519": MockKey(
+            type="Curve25519",
+            mechanisms=["EdDSA_Signature"],
+            public={"data": _b64(os.urandom(32))},
+        ),
+        "rsa": MockKey(
+            type="RSA",
+            mechanisms=[
+                "RSA_Signature_PKCS1",
+                "RSA_Signature_PSS_SHA256",
+                "RSA_Decryption_PKCS1",
+                "RSA_Decryption_OAEP_SHA256",
+            ],
+            public={
+                "modulus": _int_b64(numbers.n),
+                "publicExponent": _int_b64(numbers.e),
+            },
+            public_pem=rsa_pem,
+        ),
+        "aes": MockKey(
+            type="Generic",
+            mechanisms=["AES_Encryption_CBC", "AES_Decryption_CBC"],
+        ),
+    }
+
+
+def mechanism(operation: str, mode: str) -> str:
+    """Return the key mechanism that is required for an operation and mode."""
+    kind = {"sign": "Signature", "encrypt": "Encryption", "decrypt": "Decryption"}
+    if mode in ("EdDSA", "ECDSA"):
+        return f"{mode}_{kind[operation]}"
+    if mode.startswith("AES_"):
+        return f"AES_{kind[operation]}_{mode[4:]}"
+    return f"RSA_{kind[operation]}_{mode}"
+
+
+class MockError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so Nagle's algorithm would
+    # delay every response until the client acknowledges the headers.
+    disable_nagle_algorithm = True
+    server: "MockNetHSM"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def do_PUT(self) -> None:
+        self._handle("PUT")
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            if not self.path.startswith(API_PREFIX):
+                raise MockError(404, "Not found")
+            status, content_type, data = self.server.handle_api(
+                method,
+                self.path[len(API_PREFIX) :],
+                self.headers.get("Authorization"),
+                body,
+            )
+        except MockError as e:
+            status = e.status
+            content_type = "application/json"
+            data = json.dumps({"message": e.message}).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockNetHSM(ThreadingHTTPServer):
+    """A mock NetHSM listening on `address` (use port 0 for a free port)."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int] = ("127.0.0.1", 0),
+        username: str = DEFAULT_USERNAME,
+        password: str = DEFAULT_PASSWORD,
+        delay: float = 0.0,
+        keys: Optional[dict[str, MockKey]] = None,
+    ) -> None:
+        super().__init__(address, _MockRequestHandler)
+        self.authorization = "Basic " + _b64(f"{username}:{password}".encode())
+        self.delay = delay
+        self.keys = keys if keys is not None else default_keys()
+        self.backup: Optional[bytes] = None
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.socket = self._ssl_context().wrap_socket(self.socket, server_side=True)
+
+    @property
+    def host(self) -> str:
+        host, port = self.server_address[:2]
+        return f"{host!s}:{port}"
+
+    def _ssl_context(self) -> ssl.SSLContext:
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        with tempfile.TemporaryDirectory() as directory:
+            cert_path = os.path.join(directory, "cert.pem")
+            key_path = os.path.join(directory, "key.pem")
+            with open(cert_path, "wb") as f:
+                f.write(cert.public_bytes(serialization.Encoding.PEM))
+            with open(key_path, "wb") as f:
+                f.write(
+                    key.private_bytes(
+                        serialization.Encoding.PEM,
+                        serialization.PrivateFormat.PKCS8,
+                        serialization.NoEncryption(),
+                    )
+                )
+            context.load_cert_chain(cert_path, key_path)
+        return context
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def handle_api(
+        self, method: str, path: str, authorization: Optional[str], body: bytes
+    ) -> tuple[int, str, bytes]:
+        with self.lock:
+            self.requests += 1
+
+        if (method, path) == ("GET", "health/state"):
+            return self._json({"state": "Operational"})
+        if (method, path) == ("GET", "info"):
+            return self._json({"vendor": "Nitrokey GmbH", "product": "NetHSM Mock"})
+
+        if authorization != self.authorization:
+            raise MockError(401, "Unauthorized")
+
+        if (method, path) == ("GET", "metrics"):
+            return self._json({"requests": self.requests})
+        if (method, path) == ("GET", "keys"):
+            return self._json([{"id": key_id} for key_id in self.keys])
+        if (method, path) == ("POST", "random"):
+            return self._random(self._request(body))
+        if (method, path) == ("POST", "keys/generate"):
+            return self._generate(self._request(body))
+        if (method, path) == ("POST", "system/backup"):
+            if self.backup is None:
+                raise MockError(412, "No backup passphrase set")
+            return 200, "application/octet-stream", self.backup
+
+        match = re.fullmatch(r"keys/([^/]+)/restrictions/tags/([^/]+)", path)
+        if method == "PUT" and match:
+            return self._add_tag(*match.groups())
+
+        match = re.fullmatch(r"keys/([^/]+)(/[a-z.]+)?", path)
+        if not match:
+            raise MockError(404, "Not found")
+        key_id, operation = match.groups()
+        key = self.keys.get(key_id)
+        if key is None:
+            raise MockError(404, f"Key {key_id} not found")
+
+        if method == "GET" and operation is None:
+            data: dict[str, Any] = {
+                "type": key.type,
+                "mechanisms": key.mechanisms,
+                "restrictions": {"tags": key.tags},
+                "operations": key.operations,
+            }
+            if key.public:
+                data["public"] = key.public
+            return self._json(data)
+        if method == "GET" and operation == "/public.pem":
+            if key.public_pem is None:
+                raise MockError(404, "No public key")
+            return 200, "application/x-pem-file", key.public_pem.encode()
+        if method == "POST" and operation in ("/sign", "/encrypt", "/decrypt"):
+            return self._operation(key, operation[1:], self._request(body))
+        raise MockError(404, "Not found")
+
+    def _random(self, request: dict[str, Any]) -> tuple[int, str, bytes]:
+        length = request.get("length")
+        if not isinstance(length, int) or not 1 <= length <= MAX_RANDOM_LENGTH:
+            raise MockError(400, "Invalid length")
+        return self._json({"random": _b64(os.urandom(length))})
+
+    def _generate(self, request: dict[str, Any]) -> tuple[int, str, bytes]:
+        key_type = request.get("type")
+        mechanisms = request.get("mechanisms")
+        key_id = request.get("id") or os.urandom(8).hex()
+        if not isinstance(key_type, str) or not isinstance(mechanisms, list):
+            raise MockError(400, "Invalid key generation request")
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            if key_id in self.keys:
+                raise MockError(409, f"Key {key_id} already exists")
+            self.keys[key_id] = MockKey(
+                type=key_type, mechanisms=mechanisms, public=_random_public(key_type)
+            )
+        return 201, "application/json", json.dumps({"id": key_id}).encode()
+
+    def _add_tag(self, key_id: str, tag: str) -> tuple[int, str, bytes]:
+        with self.lock:
+            key = self.keys.get(key_id)
+            if key is None:
+                raise MockError(404, f"Key {key_id} not found")
+            if tag in key.tags:
+                return 304, "application/json", b""
+            key.tags.append(tag)
+        return 204, "application/json", b""
+
+    def _operation(
+        self, key: MockKey, operation: str, request: dict[str, Any]
+    ) -> tuple[int, str, bytes]:
+        mode = request.get("mode")
+        if (
+            not isinstance(mode, str)
+            or mechanism(operation, mode) not in key.mechanisms
+        ):
+            raise MockError(400, f"Invalid {operation} mode {mode}")
+
+        name = "encrypted" if operation == "decrypt" else "message"
+        try:
+            data = base64.b64decode(request[name], validate=True)
+        except (KeyError, TypeError, ValueError):
+            raise MockError(400, f"Invalid {name}")
+
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            key.operations += 1
+
+        if operation == "sign":
+            return self._json({"signature": _b64(hashlib.sha256(data).digest())})
+        elif operation == "encrypt":
+            iv = request.get("iv") or _b64(os.urandom(16))
+            return self._json({"encrypted": _b64(data), "iv": iv})
+        else:
+            return self._json({"decrypted": _b64(data)})
+
+    def _request(self, body: bytes) -> dict[str, Any]:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise MockError(400, "Invalid JSON")
+        if not isinstance(data, dict):
+            raise MockError(400, "Invalid JSON")
+        return data
+
+    def _json(self, data: Any) -> tuple[int, str, bytes]:
+        return 200, "application/json", json.dumps(data).encode()
+
+
+def main() -> None:
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8443
+    server = MockNetHSM(("127.0.0.1", port))
+    print(
+        f"Mock NetHSM listening on {server.host}, "
+        f"user {DEFAULT_USERNAME}, password {DEFAULT_PASSWORD}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
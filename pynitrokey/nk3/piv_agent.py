@@ -0,0 +1,507 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Local agent that keeps a connection to the PIV application of a Nitrokey 3.
+
+The agent listens on a Unix socket in a directory that is only accessible by
+the current user and transmits the APDUs it receives over one PC/SC
+connection, so the application is only selected once and stays
+authenticated between commands.  It also stores the `PivSession` of the
+connection so that clients can skip the admin authentication and the PIN
+verification if they use the same key and PIN again.  Clients connect with
+`connect`, which returns a `PivApp` that uses the agent.
+
+The salt and the digests of the admin key and the PIN never leave the agent.
+Clients send the admin key or the PIN and the agent compares it, see
+`AgentSession`.  A wrong secret clears the stored digest, so the agent
+cannot be used to guess the PIN without the retry counter of the card.
+
+Messages are framed as a command byte, the four-byte big-endian length of
+the payload and the payload.  Responses use the same framing with a status
+byte instead of the command.  A client holds the card from its first card
+command until it disconnects so that the APDUs of different clients are not
+interleaved.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+from pynitrokey.helpers import agent_dir
+from pynitrokey.nk3.piv_app import LogFn, PivApp, PivSession
+from pynitrokey.nk3.piv_trace import ApduTrace
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 600
+# a client that does not send a command for this number of seconds is
+# disconnected so that it does not block the card for other clients
+CLIENT_TIMEOUT = 60
+# generating RSA keys can take a long time
+REQUEST_TIMEOUT = 300
+STARTUP_TIMEOUT = 10
+MAX_MESSAGE_SIZE = 1 << 20
+SOCKET_NAME = "nk3-piv.sock"
+
+HEADER = struct.Struct(">BI")
+
+CMD_TRANSMIT = ord("T")
+CMD_GET_SESSION = ord("G")
+CMD_PUT_SESSION = ord("P")
+CMD_CHECK_SECRET = ord("C")
+CMD_SET_SECRET = ord("A")
+CMD_STATUS = ord("S")
+CMD_STOP = ord("Q")
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+SECRETS = ("admin_key", "pin")
+# the digest of a secret in a client session, which only knows whether the
+# secret is set in the agent
+AGENT_SECRET = "agent"
+
+
+class AgentError(Exception):
+    pass
+
+
+def is_supported() -> bool:
+    return hasattr(socket, "AF_UNIX") and hasattr(socketserver, "UnixStreamServer")
+
+
+def socket_path() -> str:
+    return os.path.join(agent_dir(), SOCKET_NAME)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+def send_message(sock: socket.socket, code: int, payload: bytes = b"") -> None:
+    sock.sendall(HEADER.pack(code, len(payload)) + payload)
+
+
+def recv_message(sock: socket.socket) -> Tuple[int, bytes]:
+    code, size = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if size > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Message too long: {size} bytes")
+    return code, _recv_exact(sock, size)
+
+
+@dataclass
+class AgentInfo:
+    socket_path: str
+    reader: str
+    pid: int
+    idle_timeout: int
+    requests: int
+
+
+class AgentSession(PivSession):
+    """The session of a client.  The digests of the admin key and the PIN are
+    kept in the agent, so the secrets are sent to the agent to compare and to
+    set them."""
+
+    def __init__(self, connection: "AgentConnection", **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.connection = connection
+
+    def check_secret(self, name: str, secret: bytes) -> bool:
+        return self.connection.check_secret(name, secret)
+
+    def set_secret(self, name: str, secret: bytes) -> None:
+        self.connection.set_secret(name, secret)
+        setattr(self, name, AGENT_SECRET)
+
+
+class AgentConnection:
+    """A connection to the agent that can be used instead of a PC/SC card
+    connection, see `connect`."""
+
+    def __init__(self, path: str, timeout: float = REQUEST_TIMEOUT) -> None:
+        # identifies the session of the agent, see Agent.generation
+        self.generation = 0
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+        except OSError:
+            self._sock.close()
+            raise
+
+    def request(self, command: int, payload: bytes = b"") -> bytes:
+        send_message(self._sock, command, payload)
+        status, data = recv_message(self._sock)
+        if status != STATUS_OK:
+            raise AgentError(data.decode(errors="replace"))
+        return data
+
+    def transmit(self, data: list[int]) -> Tuple[list[int], int, int]:
+        response = self.request(CMD_TRANSMIT, bytes(data))
+        return list(response[:-2]), response[-2], response[-1]
+
+    def getReader(self) -> str:
+        reader: str = json.loads(self.request(CMD_STATUS))["reader"]
+        return reader
+
+    def _request_json(self, command: int, data: dict[str, Any]) -> bytes:
+        data = dict(data, generation=self.generation)
+        return self.request(command, json.dumps(data).encode())
+
+    def load_session(self) -> AgentSession:
+        data = json.loads(self.request(CMD_GET_SESSION))
+        self.generation = data["generation"]
+        return AgentSession(
+            self,
+            selected=data["selected"],
+            extended=data["extended"],
+            admin_key=AGENT_SECRET if data["admin_key"] else None,
+            pin=AGENT_SECRET if data["pin"] else None,
+            salt="",
+        )
+
+    def save_session(self, session: PivSession) -> None:
+        """Update the session in the agent.  The admin key and the PIN can
+        only be cleared, see `set_secret`."""
+        self._request_json(
+            CMD_PUT_SESSION,
+            {
+                "selected": session.selected,
+                "extended": session.extended,
+                "admin_key": session.admin_key is not None,
+                "pin": session.pin is not None,
+            },
+        )
+
+    def check_secret(self, name: str, secret: bytes) -> bool:
+        data = {"name": name, "secret": secret.hex()}
+        return bool(json.loads(self._request_json(CMD_CHECK_SECRET, data)))
+
+    def set_secret(self, name: str, secret: bytes) -> None:
+        self._request_json(CMD_SET_SECRET, {"name": name, "secret": secret.hex()})
+
+    def disconnect(self) -> None:
+        self._sock.close()
+
+
+def status(path: str) -> Optional[AgentInfo]:
+    """Query the agent listening on the given socket, or return None if there
+    is no agent or if it does not respond."""
+    if not os.path.exists(path):
+        return None
+    try:
+        connection = AgentConnection(path, timeout=5.0)
+    except OSError as e:
+        logger.debug(f"PIV agent at {path} does not respond: {e}")
+        return None
+    try:
+        data = json.loads(connection.request(CMD_STATUS))
+    except (OSError, AgentError, ValueError) as e:
+        logger.debug(f"PIV agent at {path} does not respond: {e}")
+        return None
+    finally:
+        connection.disconnect()
+    return AgentInfo(
+        socket_path=path,
+        reader=data["reader"],
+        pid=data["pid"],
+        idle_timeout=data["idle_timeout"],
+        requests=data["requests"],
+    )
+
+
+def stop(path: str) -> bool:
+    try:
+        connection = AgentConnection(path, timeout=5.0)
+    except OSError:
+        return False
+    try:
+        connection.request(CMD_STOP)
+    except (OSError, AgentError):
+        return False
+    finally:
+        connection.disconnect()
+    return True
+
+
+def find() -> Optional[AgentInfo]:
+    """Find the running agent of the current user."""
+    if not is_supported():
+        return None
+    try:
+        path = socket_path()
+    except (OSError, ValueError) as e:
+        logger.debug(f"Cannot access the PIV agent directory: {e}")
+        return None
+    return status(path)
+
+
+def connect(
+    logfn: Optional[LogFn] = None, trace: Optional[ApduTrace] = None
+) -> Optional[PivApp]:
+    """Return a `PivApp` that uses the running agent of the current user, or
+    None if there is no agent."""
+    if not is_supported():
+        return None
+    try:
+        connection = AgentConnection(socket_path())
+    except (OSError, ValueError) as e:
+        logger.debug(f"Cannot connect to the PIV agent: {e}")
+        return None
+    try:
+        session = connection.load_session()
+    except (OSError, AgentError) as e:
+        logger.debug(f"Cannot load the session from the PIV agent: {e}")
+        connection.disconnect()
+        return None
+    return PivApp(
+        logfn,
+        connection=connection,
+        session=session,
+        save_session=connection.save_session,
+        trace=trace,
+    )
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    agent: "Agent"
+
+    def verify_request(self, request: Any, client_address: Any) -> bool:
+        # The socket directory is private to the current user, but where
+        # possible we also check the peer credentials of the connection.
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = request.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+            )
+            _, uid, _ = struct.unpack("3i", creds)
+            if uid != os.getuid():
+                logger.warning(f"Rejected connection from user {uid}")
+                return False
+        return True
+
+
+class _AgentRequestHandler(socketserver.BaseRequestHandler):
+    server: _AgentServer
+    request: socket.socket
+
+    def handle(self) -> None:
+        agent = self.server.agent
+        self.request.settimeout(CLIENT_TIMEOUT)
+        locked = False
+        try:
+            while True:
+                try:
+                    command, payload = recv_message(self.request)
+                except OSError:
+                    return
+
+                if command == CMD_STATUS:
+                    data = json.dumps(agent.status()).encode()
+                    send_message(self.request, STATUS_OK, data)
+                    continue
+                if command == CMD_STOP:
+                    send_message(self.request, STATUS_OK)
+                    agent.stop()
+                    return
+
+                if not locked:
+                    agent.card_lock.acquire()
+                    locked = True
+                try:
+                    response = agent.handle(command, payload)
+                except Exception as e:
+                    logger.warning(f"PIV agent command failed: {e}")
+                    send_message(self.request, STATUS_ERROR, str(e).encode())
+                else:
+                    send_message(self.request, STATUS_OK, response)
+        finally:
+            if locked:
+                agent.card_lock.release()
+
+
+class Agent:
+    """Serves APDUs on a Unix socket using one PC/SC connection until it is
+    stopped or idle for `idle_timeout` seconds.  If the connection fails, for
+    example because the device has been removed, the agent reconnects with a
+    new session on the next command."""
+
+    def __init__(self, idle_timeout: int = DEFAULT_IDLE_TIMEOUT) -> None:
+        self.idle_timeout = idle_timeout
+        self.socket_path = socket_path()
+        self.requests = 0
+        # incremented for every new connection, so that session updates from
+        # clients that started before the agent reconnected are ignored
+        self.generation = 0
+        # held by a client from its first card command until it disconnects
+        self.card_lock = threading.Lock()
+
+        self._app: Optional[PivApp] = None
+        self._last_activity = time.monotonic()
+        self._lock = threading.Lock()
+        self._server: Optional[_AgentServer] = None
+
+    def _connect(self) -> PivApp:
+        return PivApp(logger.debug)
+
+    def open(self) -> PivApp:
+        if self._app is None:
+            self._app = self._connect()
+            self.generation += 1
+        return self._app
+
+    def _session(self, data: dict[str, Any]) -> Optional[PivSession]:
+        """Return the session that a client request refers to, or None if the
+        agent has reconnected since the client loaded the session."""
+        app = self.open()
+        if data.get("generation") != self.generation:
+            return None
+        return app.session
+
+    def session_info(self) -> dict[str, Any]:
+        """Return the session without the salt and the digests."""
+        session = self.open().session
+        return {
+            "generation": self.generation,
+            "selected": session.selected,
+            "extended": session.extended,
+            "admin_key": session.admin_key is not None,
+            "pin": session.pin is not None,
+        }
+
+    def _secret(self, data: dict[str, Any]) -> Tuple[str, bytes]:
+        name = data["name"]
+        if name not in SECRETS:
+            raise ValueError(f"Unknown secret {name}")
+        return name, bytes.fromhex(data["secret"])
+
+    def _close(self) -> None:
+        if self._app is not None:
+            with contextlib.suppress(Exception):
+                self._app.close()
+            self._app = None
+
+    def touch(self) -> None:
+        with self._lock:
+            self._last_activity = time.monotonic()
+            self.requests += 1
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "reader": self._app.reader() if self._app else "",
+            "pid": os.getpid(),
+            "idle_timeout": self.idle_timeout,
+            "requests": self.requests,
+        }
+
+    def transmit(self, apdu: bytes) -> bytes:
+        app = self.open()
+        try:
+            data, sw1, sw2 = app.connection.transmit(list(apdu))
+        except Exception:
+            self._close()
+            raise
+        return bytes(data) + bytes([sw1, sw2])
+
+    def handle(self, command: int, payload: bytes) -> bytes:
+        """Handle a card command.  Must be called with the card lock held."""
+        self.touch()
+        if command == CMD_TRANSMIT:
+            return self.transmit(payload)
+        elif command == CMD_GET_SESSION:
+            return json.dumps(self.session_info()).encode()
+
+        data = json.loads(payload)
+        session = self._session(data)
+        if command == CMD_PUT_SESSION:
+            if session is not None:
+                session.selected = data["selected"]
+                session.extended = data["extended"]
+                for name in SECRETS:
+                    if not data[name]:
+                        setattr(session, name, None)
+            return b""
+        elif command == CMD_CHECK_SECRET:
+            name, secret = self._secret(data)
+            match = session is not None and session.check_secret(name, secret)
+            if session is not None and not match:
+                setattr(session, name, None)
+            return json.dumps(match).encode()
+        elif command == CMD_SET_SECRET:
+            name, secret = self._secret(data)
+            if session is not None:
+                session.set_secret(name, secret)
+            return b""
+        else:
+            raise ValueError(f"Unknown command {command}")
+
+    def bind(self) -> None:
+        """Create the socket.  A stale socket of an agent that is no longer
+        running is replaced."""
+        if os.path.exists(self.socket_path):
+            if status(self.socket_path) is not None:
+                raise ValueError("A PIV agent is already running")
+            os.unlink(self.socket_path)
+
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _AgentServer(self.socket_path, _AgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self._server.agent = self
+
+    def serve(self) -> None:
+        if self._server is None:
+            self.bind()
+        assert self._server is not None
+
+        watchdog = threading.Thread(target=self._watch_idle, daemon=True)
+        watchdog.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            with contextlib.suppress(OSError):
+                os.unlink(self.socket_path)
+            self._close()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+    def _watch_idle(self) -> None:
+        while True:
+            time.sleep(min(self.idle_timeout, 1))
+            with self._lock:
+                idle = time.monotonic() - self._last_activity
+            if idle >= self.idle_timeout:
+                logger.info(f"PIV agent idle for {int(idle)} s, stopping")
+                self.stop()
+                return
+
+
+def wait_for_start(timeout: float = STARTUP_TIMEOUT) -> Optional[AgentInfo]:
+    """Wait until an agent started in the background responds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = find()
+        if info is not None:
+            return info
+        time.sleep(0.1)
+    return None
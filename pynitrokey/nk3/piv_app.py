@@ -1,9 +1,22 @@
 # Copyright Nitrokey GmbH
 # SPDX-License-Identifier: Apache-2.0 OR MIT
 
+import hashlib
 import logging
 import os
-from typing import Any, Callable, Optional, Sequence, Union
+import time
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import smartcard
 from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
@@ -13,11 +26,63 @@ from smartcard.CardConnection import CardConnection
 from smartcard.Exceptions import NoCardException
 
 from pynitrokey.helpers import local_critical
+from pynitrokey.nk3.piv_trace import ApduTrace
 from pynitrokey.start.gnuk_token import iso7816_compose
-from pynitrokey.tlv import Tlv
+from pynitrokey.tlv import Tlv, TlvDecoder, TlvNode, TlvTree
 
 LogFn = Callable[[str], Any]
 
+PIV_AID = bytes.fromhex("A00000030800001000010000")
+SELECT_PIV = [0x00, 0xA4, 0x04, 0x00, len(PIV_AID), *PIV_AID, 0x00]
+# Probes the support for extended length APDUs with a GET DATA command for
+# the discovery object, see PivApp.extended_length
+PROBE_EXTENDED = Tlv.build([(0x5C, b"\x7e")])
+
+MORE_DATA_STATUS_BYTE = 0x61
+WRONG_LENGTH = 0x6700
+SECURITY_STATUS_NOT_SATISFIED = 0x6982
+CHAINING_NOT_SUPPORTED = 0x6884
+NOT_FOUND = 0x6A82
+CLA_NOT_SUPPORTED = 0x6E00
+
+# maximum data lengths of short and extended APDUs
+SHORT_MAX = 0xFF
+EXTENDED_MAX = 0xFFFF
+# command chaining is indicated by this bit in the class byte
+CLA_CHAINING = 0x10
+
+ALGO_RSA2048 = 0x07
+ALGO_NISTP256 = 0x11
+
+
+def encode_apdu(
+    ins: int,
+    p1: int,
+    p2: int,
+    data: bytes = b"",
+    cls: int = 0x00,
+    le: Optional[int] = None,
+    extended: bool = False,
+) -> bytes:
+    """Encode a command APDU with short or extended lengths.  `le` is the
+    maximum length of the response, where 0 means 256 bytes for short and
+    65536 bytes for extended APDUs.  If `le` is None, no response data is
+    expected."""
+    header = bytes([cls, ins, p1, p2])
+    if not extended:
+        if len(data) > SHORT_MAX:
+            raise ValueError(f"Data too long for a short APDU: {len(data)} bytes")
+        lc = bytes([len(data)]) + data if data else b""
+        return header + lc + (bytes([le & 0xFF]) if le is not None else b"")
+
+    if len(data) > EXTENDED_MAX:
+        raise ValueError(f"Data too long for an extended APDU: {len(data)} bytes")
+    lc = b"\x00" + len(data).to_bytes(2, "big") + data if data else b""
+    if le is None:
+        return header + lc
+    # the extended Le field has a leading zero byte if there is no Lc field
+    return header + lc + (b"" if data else b"\x00") + (le & 0xFFFF).to_bytes(2, "big")
+
 
 def find_by_id(tag: int, data: Sequence[tuple[int, bytes]]) -> Optional[bytes]:
     for t, b in data:
@@ -30,8 +95,12 @@ def find_by_id(tag: int, data: Sequence[tuple[int, bytes]]) -> Optional[bytes]:
 def prepare_for_pkcs1v15_sign_2048(data: bytes) -> bytes:
     digest = hashes.Hash(hashes.SHA256())
     digest.update(data)
-    hashed = digest.finalize()
+    return pkcs1v15_pad_sha256_2048(digest.finalize())
+
 
+def pkcs1v15_pad_sha256_2048(hashed: bytes) -> bytes:
+    if len(hashed) != 32:
+        raise ValueError("Expected a SHA-256 digest")
     prefix = bytearray.fromhex("3031300d060960864801650304020105000420")
     padding_len = 256 - 32 - 19 - 3
     padding = b"\x00\x01" + (b"\xFF" * padding_len) + b"\x00"
@@ -40,6 +109,55 @@ def prepare_for_pkcs1v15_sign_2048(data: bytes) -> bytes:
     return total
 
 
+@dataclass
+class PivSession:
+    """The state of the PIV application on a card connection.
+
+    The admin key and the PIN are only stored as salted digests, which are
+    used to recognize them if they are used again on the same connection.
+    The digests are compared and set with `check_secret` and `set_secret`
+    so that they can be kept elsewhere, see `piv_agent.AgentSession`."""
+
+    selected: bool = False
+    admin_key: Optional[str] = None
+    pin: Optional[str] = None
+    # whether extended length APDUs are supported, None if not yet probed
+    extended: Optional[bool] = None
+    salt: str = field(default_factory=lambda: os.urandom(16).hex())
+
+    def digest(self, secret: bytes) -> str:
+        return hashlib.sha256(bytes.fromhex(self.salt) + secret).hexdigest()
+
+    def check_secret(self, name: str, secret: bytes) -> bool:
+        """Return whether the secret has been used as the admin key or the PIN
+        (`name` is admin_key or pin) in this session."""
+        return bool(getattr(self, name) == self.digest(secret))
+
+    def set_secret(self, name: str, secret: bytes) -> None:
+        setattr(self, name, self.digest(secret))
+
+    def clear_auth(self) -> None:
+        self.admin_key = None
+        self.pin = None
+
+
+class Connection(Protocol):
+    """The methods of a PC/SC card connection that are used by PivApp."""
+
+    def transmit(self, data: list[int]) -> Tuple[list[int], int, int]:
+        ...
+
+    def getReader(self) -> str:
+        ...
+
+    def disconnect(self) -> None:
+        ...
+
+
+class CertificateError(ValueError):
+    pass
+
+
 class StatusError(Exception):
     def __init__(self, value: int):
         self.value = value
@@ -48,56 +166,154 @@ class StatusError(Exception):
         return f"{hex(self.value)}"
 
 
+def piv_connections() -> list[CardConnection]:
+    """Connect to all cards with a PIV application and select it."""
+    log = logging.getLogger("pivapp")
+    connections = []
+    for r in smartcard.System.readers():
+        log.debug(f"Reader: {r}")
+        connection = r.createConnection()
+        try:
+            connection.connect()
+        except NoCardException:
+            continue
+        data, sw1, sw2 = connection.transmit(SELECT_PIV)
+        if sw1 != 0x90 or sw2 != 0x00:
+            connection.disconnect()
+            continue
+        connections.append(connection)
+    return connections
+
+
 class PivApp:
-    log: logging.Logger
-    logfn: LogFn
-    connection: CardConnection
+    """The PIV application of a card.
 
-    def __init__(self, logfn: Optional[LogFn] = None):
-        self.log = logging.getLogger("pivapp")
-        readers = smartcard.System.readers()
-        chosen_connection: Optional[CardConnection] = None
-        for r in readers:
-            print(r)
-            connection = r.createConnection()
-            try:
-                connection.connect()
-            except NoCardException:
-                continue
-            select = [
-                0x00,
-                0xA4,
-                0x04,
-                0x00,
-                0x0C,
-                0xA0,
-                0x00,
-                0x00,
-                0x03,
-                0x08,
-                0x00,
-                0x00,
-                0x10,
-                0x00,
-                0x01,
-                0x00,
-                0x00,
-                0x00,
-            ]
-            data, sw1, sw2 = connection.transmit(select)
-            if sw1 != 0x90 or sw2 != 0x00:
-                continue
-            chosen_connection = connection
+    The card connection and the session state are kept for the lifetime of
+    the object, so the application is selected once and the admin key and
+    PIN are only verified again if a different key or PIN is used.  Use it
+    as a context manager to close the connection, e. g.:
 
-        if not chosen_connection:
-            raise NoCardException("No PIV card found", -1)
+        with PivApp() as device:
+            for container in containers:
+                device.cert(container)
+
+    A connection and a session can be passed to re-use them, for example to
+    connect through the agent, see `pynitrokey.nk3.piv_agent`.  Whenever the
+    session changes, it is passed to `save_session`.
 
-        self.connection = chosen_connection
+    The APDUs are passed to `trace`, which logs them at the debug level with
+    redacted secrets by default, see `pynitrokey.nk3.piv_trace`."""
 
+    log: logging.Logger
+    logfn: LogFn
+    connection: Connection
+    session: PivSession
+    trace: ApduTrace
+    round_trips: int
+
+    def __init__(
+        self,
+        logfn: Optional[LogFn] = None,
+        connection: Optional[Connection] = None,
+        session: Optional[PivSession] = None,
+        save_session: Optional[Callable[[PivSession], None]] = None,
+        trace: Optional[ApduTrace] = None,
+    ):
+        self.log = logging.getLogger("pivapp")
         if logfn is not None:
             self.logfn = logfn
         else:
             self.logfn = self.log.info
+        self.save_session = save_session
+        self.trace = trace or ApduTrace()
+        self.round_trips = 0
+
+        self.session = session or PivSession()
+        if connection is None:
+            self.connection = self._connect()
+            self.session.selected = True
+        else:
+            self.connection = connection
+
+    @classmethod
+    def open_all(
+        cls, logfn: Optional[LogFn] = None, trace: Optional[ApduTrace] = None
+    ) -> list["PivApp"]:
+        """Connect to the PIV applications of all cards.
+
+        If `trace` is given, every card gets its own trace for the device
+        with the name of its reader, see `ApduTrace.for_device`."""
+        return [
+            cls(
+                logfn,
+                connection=connection,
+                session=PivSession(selected=True),
+                trace=trace.for_device(connection.getReader()) if trace else None,
+            )
+            for connection in piv_connections()
+        ]
+
+    def _connect(self) -> CardConnection:
+        connections = piv_connections()
+        if not connections:
+            raise NoCardException("No PIV card found", -1)
+        for connection in connections[:-1]:
+            connection.disconnect()
+        return connections[-1]
+
+    def close(self) -> None:
+        self.trace.close()
+        self.connection.disconnect()
+
+    def __enter__(self) -> "PivApp":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _session_changed(self) -> None:
+        if self.save_session is not None:
+            self.save_session(self.session)
+
+    def select(self) -> None:
+        """Select the PIV application unless it is selected in this session."""
+        if self.session.selected:
+            return
+        self.logfn("Selecting the PIV application")
+        data, sw1, sw2 = self._transmit(bytes(SELECT_PIV), "SELECT")
+        if sw1 != 0x90 or sw2 != 0x00:
+            raise StatusError((sw1 << 8) | sw2)
+        self.session.selected = True
+        self.session.clear_auth()
+        self._session_changed()
+
+    def _transmit(self, apdu: bytes, info: str = "") -> Tuple[bytes, int, int]:
+        self.round_trips += 1
+        self.trace.command(apdu, info)
+        response_list, sw1, sw2 = self.connection.transmit(list(apdu))
+        response = bytes(response_list)
+        self.trace.response(response, sw1, sw2)
+        return response, sw1, sw2
+
+    def extended_length(self) -> bool:
+        """Check once per session whether the card and the reader accept
+        extended length APDUs."""
+        if self.session.extended is None:
+            self.select()
+            apdu = encode_apdu(0xCB, 0x3F, 0xFF, PROBE_EXTENDED, le=0, extended=True)
+            try:
+                _, sw1, sw2 = self._transmit(apdu, "probe")
+            except Exception as e:
+                self.logfn(f"Extended length APDU failed: {e}")
+                self.session.extended = False
+            else:
+                status = (sw1 << 8) | sw2
+                self.session.extended = sw1 in (0x90, MORE_DATA_STATUS_BYTE) or (
+                    status == NOT_FOUND
+                )
+            self.logfn(f"Extended length APDUs supported: {self.session.extended}")
+            self._session_changed()
+        return self.session.extended
 
     def send_receive(
         self,
@@ -106,67 +322,139 @@ class PivApp:
         p2: int,
         data: bytes = b"",
     ) -> bytes:
-        bytes_data = iso7816_compose(ins, p1, p2, data)
-        return self._send_receive_inner(bytes_data, log_info=f"{ins}")
-
-    def _send_receive_inner(self, data: bytes, log_info: str = "") -> bytes:
-        self.logfn(
-            f"Sending {log_info if log_info else ''} {data.hex() if data else data!r}"
-        )
+        return self._transceive(ins, p1, p2, data)
 
+    def send_receive_tlv(
+        self,
+        ins: int,
+        p1: int,
+        p2: int,
+        data: bytes = b"",
+    ) -> list[TlvNode]:
+        """Send a command and decode the TLV objects of the response while
+        the chunks of the response are received."""
+        decoder = TlvDecoder()
+        objects: list[TlvNode] = []
+
+        def receive(chunk: bytes) -> None:
+            for tag, value in decoder.feed(chunk):
+                objects.append(TlvNode(tag, memoryview(value)))
+
+        self._transceive(ins, p1, p2, data, receive=receive)
+        decoder.close()
+        self.logfn(f"Decoded {len(objects)} TLV objects")
+        return objects
+
+    def _transceive(
+        self,
+        ins: int,
+        p1: int,
+        p2: int,
+        data: bytes,
+        receive: Optional[Callable[[bytes], None]] = None,
+    ) -> bytes:
+        """Send a command with an extended length APDU if supported, so that
+        the command and the response usually need a single round trip.
+        Otherwise, or if the card rejects the length, short APDUs are used
+        with command chaining for data that does not fit into one APDU."""
+        self.select()
+        if self.extended_length():
+            apdu = encode_apdu(ins, p1, p2, data, le=0, extended=True)
+            try:
+                return self._send_receive_inner(apdu, f"{ins}", receive)
+            except StatusError as e:
+                if e.value != WRONG_LENGTH:
+                    raise
+            self.logfn("Extended length APDU rejected, using short APDUs")
+            self.session.extended = False
+            self._session_changed()
+
+        if len(data) > SHORT_MAX:
+            return self._send_chained(ins, p1, p2, data, receive)
+        apdu = iso7816_compose(ins, p1, p2, data)
+        return self._send_receive_inner(apdu, f"{ins}", receive)
+
+    def _send_chained(
+        self,
+        ins: int,
+        p1: int,
+        p2: int,
+        data: bytes,
+        receive: Optional[Callable[[bytes], None]] = None,
+    ) -> bytes:
+        """Send data that does not fit into a short APDU with command
+        chaining.  If the card does not support chaining, the data is sent
+        with an extended Lc field as before."""
+        chunks = [data[i : i + SHORT_MAX] for i in range(0, len(data), SHORT_MAX)]
+        for i, chunk in enumerate(chunks[:-1]):
+            apdu = iso7816_compose(ins, p1, p2, chunk, cls=CLA_CHAINING)
+            try:
+                self._send_receive_inner(apdu, f"{ins} (chained)")
+            except StatusError as e:
+                if i != 0 or e.value not in (CHAINING_NOT_SUPPORTED, CLA_NOT_SUPPORTED):
+                    raise
+                self.logfn("Command chaining not supported")
+                apdu = iso7816_compose(ins, p1, p2, data)
+                return self._send_receive_inner(apdu, f"{ins}", receive)
+        apdu = iso7816_compose(ins, p1, p2, chunks[-1])
+        return self._send_receive_inner(apdu, f"{ins}", receive)
+
+    def _send_receive_inner(
+        self,
+        data: bytes,
+        log_info: str = "",
+        receive: Optional[Callable[[bytes], None]] = None,
+    ) -> bytes:
+        """Send an APDU and receive the response, following 0x61 statuses
+        with GET RESPONSE.  If `receive` is set, it is called with every chunk
+        of the response as it arrives, and an empty response is returned."""
         try:
-            result_list, sw1, sw2 = self.connection.transmit(list(data))
+            result, sw1, sw2 = self._transmit(data, log_info)
         except Exception as e:
             self.logfn(f"Got exception: {e}")
+            self.session.selected = False
+            self.session.clear_auth()
             raise
 
-        result = bytes(result_list)
         status_bytes = bytes([sw1, sw2])
-        self.logfn(f"Received [{status_bytes.hex()}] {result.hex()}")
 
-        log_multipacket = False
-        data_final = bytes(result)
-        MORE_DATA_STATUS_BYTE = 0x61
+        data_final = bytearray()
+        if receive is None:
+            receive = data_final.extend
+
+        receive(result)
         while status_bytes[0] == MORE_DATA_STATUS_BYTE:
-            if log_multipacket:
-                self.logfn(
-                    f"Got RemainingData status: [{status_bytes.hex()}] {result.hex() if result else result!r}"
-                )
-            log_multipacket = True
-            ins = 0xC0
-            p1 = 0
-            p2 = 0
-            le = sw2 if sw2 != 0 else 0xFF
-            bytes_data = iso7816_compose(ins, p1, p2, le=le)
+            # Le 0 requests the maximum of 256 bytes
+            bytes_data = encode_apdu(0xC0, 0, 0, le=sw2)
             try:
-                result_list, sw1, sw2 = self.connection.transmit(list(bytes_data))
+                result, sw1, sw2 = self._transmit(bytes_data, "GET RESPONSE")
             except Exception as e:
                 self.logfn(f"Got exception: {e}")
                 raise
-            # Data order is different here than in APDU - SW is first, then the data if any
-            result = bytes(result_list)
             status_bytes = bytes([sw1, sw2])
-            self.logfn(f"Received [{status_bytes.hex()}] {bytes(result).hex()}")
             if status_bytes[0] in [0x90, MORE_DATA_STATUS_BYTE]:
-                data_final += bytes(result)
+                receive(result)
 
         if status_bytes != b"\x90\x00" and status_bytes[0] != MORE_DATA_STATUS_BYTE:
-            raise StatusError(int.from_bytes(status_bytes, byteorder="big"))
-
-        if log_multipacket:
-            self.logfn(
-                f"Received final data: [{status_bytes.hex()}] {data_final.hex() if data_final else data_final!r}"
-            )
-
-        if data_final:
-            try:
-                self.logfn(f"Decoded received: {data_final.hex()}")
-            except Exception:
-                pass
-
-        return data_final
+            status = int.from_bytes(status_bytes, byteorder="big")
+            if status == SECURITY_STATUS_NOT_SATISFIED and (
+                self.session.admin_key or self.session.pin
+            ):
+                # the card has lost the authentication state, for example
+                # because it has been reset by another application
+                self.session.clear_auth()
+                self._session_changed()
+            raise StatusError(status)
+
+        return bytes(data_final)
 
     def authenticate_admin(self, admin_key: bytes) -> None:
+        if self.session.check_secret("admin_key", admin_key):
+            self.logfn("Already authenticated with the admin key")
+            return
+        if self.session.admin_key is not None:
+            self.session.admin_key = None
+            self._session_changed()
 
         if len(admin_key) == 24:
             algorithm: Union[
@@ -191,21 +479,18 @@ class PivApp:
                 support_hint=False,
             )
 
-        challenge_body = Tlv.build([(0x7C, Tlv.build([(0x80, b"")]))])
+        challenge_body = Tlv.build([(0x7C, [(0x80, b"")])])
         challenge_response = self.send_receive(0x87, algo_byte, 0x9B, challenge_body)
-        general_auth_data = find_by_id(0x7C, Tlv.parse(challenge_response))
+        general_auth_data = TlvTree(challenge_response).get(0x7C)
         if general_auth_data is None:
             local_critical("Failed to get response to GENERAL AUTHENTICATE")
             return
 
-        challenge = find_by_id(
-            0x80,
-            Tlv.parse(general_auth_data),
-        )
-
-        if challenge is None:
+        challenge_node = general_auth_data.get(0x80)
+        if challenge_node is None:
             local_critical("Failed to get authentication challenge from the device")
             return
+        challenge = bytes(challenge_node)
 
         # challenge = decoded.first_by_id(0x7C).data.first_by_id(0x80).data
         if len(challenge) != expected_len:
@@ -218,25 +503,24 @@ class PivApp:
         decryptor = cipher.decryptor()
         our_challenge_encrypted = decryptor.update(our_challenge) + decryptor.finalize()
         response_body = Tlv.build(
-            [(0x7C, Tlv.build([(0x80, response), (0x81, our_challenge_encrypted)]))]
+            [(0x7C, [(0x80, response), (0x81, our_challenge_encrypted)])]
         )
 
         final_response = self.send_receive(0x87, algo_byte, 0x9B, response_body)
-        general_auth_data = find_by_id(0x7C, Tlv.parse(final_response))
+        general_auth_data = TlvTree(final_response).get(0x7C)
         if general_auth_data is None:
             local_critical("Failed to get response to GENERAL AUTHENTICATE")
             return
 
-        decoded_challenge = find_by_id(
-            0x82,
-            Tlv.parse(general_auth_data),
-        )
-
-        if decoded_challenge != our_challenge:
+        decoded_challenge = general_auth_data.get(0x82)
+        if decoded_challenge is None or bytes(decoded_challenge) != our_challenge:
             local_critical(
                 "Failed to authenticate with administrator key", support_hint=False
             )
 
+        self.session.set_secret("admin_key", admin_key)
+        self._session_changed()
+
     def set_admin_key(self, new_key: bytes) -> None:
         if len(new_key) == 24:
             # algo = "tdes"
@@ -254,6 +538,8 @@ class PivApp:
             )
         data = bytes([algo_byte, 0x9B, len(new_key)]) + new_key
         self.send_receive(0xFF, 0xFF, 0xFE, data)
+        self.session.admin_key = None
+        self._session_changed()
 
     def encode_pin(self, pin: str) -> bytes:
         body = pin.encode("utf-8")
@@ -265,11 +551,22 @@ class PivApp:
 
     def login(self, pin: str) -> None:
         body = self.encode_pin(pin)
+        if self.session.check_secret("pin", body):
+            self.logfn("Already logged in with the PIN")
+            return
+        if self.session.pin is not None:
+            self.session.pin = None
+            self._session_changed()
+
         self.send_receive(0x20, 0x00, 0x80, body)
+        self.session.set_secret("pin", body)
+        self._session_changed()
 
     def change_pin(self, old_pin: str, new_pin: str) -> None:
         body = self.encode_pin(old_pin) + self.encode_pin(new_pin)
         self.send_receive(0x24, 0, 0x80, body)
+        self.session.pin = None
+        self._session_changed()
 
     def change_puk(self, old_puk: str, new_puk: str) -> None:
         old_puk_bytes = old_puk.encode("utf-8")
@@ -287,40 +584,77 @@ class PivApp:
 
         body = puk_bytes + self.encode_pin(new_pin)
         self.send_receive(0x2C, 0, 0x80, body)
+        self.session.pin = None
+        self._session_changed()
 
     def factory_reset(self) -> None:
         self.send_receive(0xFB, 0, 0)
+        self.session.selected = False
+        self.session.clear_auth()
+        self._session_changed()
 
     def sign_p256(self, data: bytes, key: int) -> bytes:
         digest = hashes.Hash(hashes.SHA256())
         digest.update(data)
         payload = digest.finalize()
-        return self.raw_sign(payload, key, 0x11)
+        return self.raw_sign(payload, key, ALGO_NISTP256)
 
     def sign_rsa2048(self, data: bytes, key: int) -> bytes:
         payload = prepare_for_pkcs1v15_sign_2048(data)
-        return self.raw_sign(payload, key, 0x07)
+        return self.raw_sign(payload, key, ALGO_RSA2048)
+
+    def sign_digests(
+        self,
+        digests: Iterable[bytes],
+        key: int,
+        algo: int,
+        pin: Optional[str] = None,
+    ) -> Iterator[Tuple[bytes, float]]:
+        """Sign SHA-256 digests with a key and yield the signatures together
+        with the time in seconds that the card needed for them.
+
+        The digests are signed one by one over this connection, so they can
+        be read from and the signatures written to a stream.  The time does
+        not include reading the next digest.  The PIN is verified once if it
+        is given, and again if the card requires it for a signature, for
+        example for a key with the PIN-always policy."""
+        if algo not in (ALGO_NISTP256, ALGO_RSA2048):
+            raise ValueError(f"Unsupported algorithm {hex(algo)}")
+        if pin is not None:
+            self.login(pin)
+        for digest in digests:
+            if len(digest) != 32:
+                raise ValueError("Expected a SHA-256 digest")
+            if algo == ALGO_RSA2048:
+                payload = pkcs1v15_pad_sha256_2048(digest)
+            else:
+                payload = digest
+            start = time.perf_counter()
+            try:
+                signature = self.raw_sign(payload, key, algo)
+            except StatusError as e:
+                if e.value != SECURITY_STATUS_NOT_SATISFIED or pin is None:
+                    raise
+                self.login(pin)
+                signature = self.raw_sign(payload, key, algo)
+            yield signature, time.perf_counter() - start
 
     def raw_sign(self, payload: bytes, key: int, algo: int) -> bytes:
-        body = Tlv.build([(0x7C, Tlv.build([(0x81, payload), (0x82, b"")]))])
+        body = Tlv.build([(0x7C, [(0x81, payload), (0x82, b"")])])
         result = self.send_receive(0x87, algo, key, body)
-        general_auth_data = find_by_id(0x7C, Tlv.parse(result))
+        general_auth_data = TlvTree(result).get(0x7C)
         if general_auth_data is None:
             local_critical("Failed to get response to GENERAL AUTHENTICATE")
             return bytes()
 
-        signature = find_by_id(
-            0x82,
-            Tlv.parse(general_auth_data),
-        )
-
+        signature = general_auth_data.get(0x82)
         if signature is None:
             local_critical("Failed to get signature from device")
             # Satisfy the type checker.
             # local_critical raises always raises an error
             return b""
 
-        return signature
+        return bytes(signature)
 
     def init(self) -> bytes:
         # Template for card capabilities with nothing but a random ID
@@ -340,15 +674,13 @@ class PivApp:
                 (0x5C, bytes(bytearray.fromhex("5FC109"))),
                 (
                     0x53,
-                    Tlv.build(
-                        [
-                            (0x01, "Nitrokey PIV user".encode("ascii")),
-                            # TODO: use representation of real serial number of card (currently static value)
-                            # Base 10 representation of
-                            # https://github.com/Nitrokey/piv-authenticator/blob/2c948a966f3e410e9a4cee3c351ca20b956383e0/src/lib.rs#L197
-                            (0x05, "5437251".encode("ascii")),
-                        ]
-                    ),
+                    [
+                        (0x01, "Nitrokey PIV user".encode("ascii")),
+                        # TODO: use representation of real serial number of card (currently static value)
+                        # Base 10 representation of
+                        # https://github.com/Nitrokey/piv-authenticator/blob/2c948a966f3e410e9a4cee3c351ca20b956383e0/src/lib.rs#L197
+                        (0x05, "5437251".encode("ascii")),
+                    ],
                 ),
             ]
         )
@@ -360,51 +692,59 @@ class PivApp:
         return int.from_bytes(response, byteorder="big")
 
     def reader(self) -> str:
-        reader: str = self.connection.getReader()  # type: ignore
-        return reader
+        return self.connection.getReader()
 
     def guid(self) -> bytes:
         payload = Tlv.build([(0x5C, bytes(bytearray.fromhex("5FC102")))])
         chuid = self.send_receive(0xCB, 0x3F, 0xFF, payload)
 
-        chuid_tmp = find_by_id(0x53, Tlv.parse(chuid))
-        if chuid_tmp is None:
-            local_critical("Failed to get chuid from device")
-            return b""
-
-        chuid_data = find_by_id(0x34, Tlv.parse(chuid_tmp))
-        if chuid_data is None:
+        try:
+            return bytes(TlvTree(chuid)[0x53][0x34])
+        except KeyError:
             local_critical("Failed to get chuid from device")
             # Satisfy the type checker.
             # local_critical raises always raises an error
             return b""
 
-        return chuid_data
+    def write_cert(self, container_id: bytes, cert: bytes) -> None:
+        payload = Tlv.build(
+            [(0x5C, container_id), (0x53, [(0x70, cert), (0x71, bytes([0]))])]
+        )
+        self.send_receive(0xDB, 0x3F, 0xFF, payload)
 
-    def cert(self, container_id: bytes) -> Optional[bytes]:
+    def read_cert(self, container_id: bytes) -> Optional[bytes]:
+        """Read the certificate from a container, or return None if the
+        container is empty.  Raises a CertificateError if the data object
+        does not contain a certificate."""
         payload = Tlv.build([(0x5C, container_id)])
         try:
-            cert = self.send_receive(0xCB, 0x3F, 0xFF, payload)
-            parsed = Tlv.parse(cert)
-            if len(parsed) != 1:
-                local_critical("Bad number of elements", support_hint=False)
+            objects = self.send_receive_tlv(0xCB, 0x3F, 0xFF, payload)
+        except StatusError as e:
+            if e.value == NOT_FOUND:
+                return None
+            else:
+                raise ValueError(f"{hex(e.value)}, Received error")
 
-            tag, value = parsed[0]
-            if tag != 0x53:
-                local_critical("Bad tag", support_hint=False)
+        if len(objects) != 1:
+            raise CertificateError("Bad number of elements")
 
-            parsed = Tlv.parse(value)
-            if len(parsed) < 1:
-                local_critical("Bad number of sub-elements", support_hint=False)
+        node = objects[0]
+        if node.tag != 0x53:
+            raise CertificateError("Bad tag")
 
-            tag, value = parsed[0]
-            if tag != 0x70:
-                local_critical("Bad tag", support_hint=False)
+        children = node.children
+        if len(children) < 1:
+            raise CertificateError("Bad number of sub-elements")
 
-            return value
+        node = children.nodes[0]
+        if node.tag != 0x70:
+            raise CertificateError("Bad tag")
 
-        except StatusError as e:
-            if e.value == 0x6A82:
-                return None
-            else:
-                raise ValueError(f"{hex(e.value)}, Received error")
+        return bytes(node)
+
+    def cert(self, container_id: bytes) -> Optional[bytes]:
+        try:
+            return self.read_cert(container_id)
+        except CertificateError as e:
+            local_critical(str(e), support_hint=False)
+            return None
@@ -0,0 +1,205 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tracing of the APDUs exchanged with the PIV application.
+
+The APDUs are logged with the `LOGGER_NAME` logger at the debug level.  The
+messages are only formatted if the logger is enabled for this level, and
+long APDUs are truncated to `max_dump` bytes.  nitropy sets this logger to
+the info level unless the APDU log is enabled with `nk3 piv --log-apdus` or
+the PYNK_DEBUG environment variable.  Optionally, all APDUs are
+written in full to a binary trace file that can be read with `read_trace`.
+
+Secrets in the command data (PINs, PUKs, management and imported keys) are
+replaced with `REDACTED_BYTE` in the log and in the trace file unless the
+redaction is disabled.  With `Redaction.DATA`, all command and response data
+is redacted and only the headers, lengths and status words are kept.
+
+A trace file starts with `MAGIC`, followed by one record per APDU: the
+direction (`>` for commands, `<` for responses), the number of the device as
+a two-byte integer, the time in seconds since the start of the trace as a
+double, the length of the APDU as a four-byte integer, all big-endian, and
+the APDU itself.  Responses include the status word.
+
+If several devices are used concurrently, each device has its own trace
+created with `ApduTrace.for_device`, which shares the logger and the file.
+Its log messages start with the name of the reader, and a record with the
+direction `@` assigns the next device number to the name of the reader,
+which is stored instead of the APDU.  Otherwise, the device number is 0.
+"""
+
+import copy
+import itertools
+import logging
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import BinaryIO, Iterator, Optional
+
+LOGGER_NAME = "pivapp.apdu"
+
+MAGIC = b"NKAPDU\x02"
+RECORD_HEADER = struct.Struct(">cHdI")
+COMMAND = b">"
+RESPONSE = b"<"
+DEVICE = b"@"
+
+REDACTED_BYTE = 0x2A
+DEFAULT_MAX_DUMP = 64
+
+# The offset of the secret data in the data field of commands with secrets:
+# VERIFY, CHANGE REFERENCE DATA, RESET RETRY COUNTER, IMPORT ASYMMETRIC KEY
+# and SET MANAGEMENT KEY
+SECRET_DATA_OFFSETS = {0x20: 0, 0x24: 0, 0x2C: 0, 0xFE: 0, 0xFF: 3}
+
+
+class Redaction(Enum):
+    NONE = "none"
+    SECRETS = "secrets"
+    DATA = "data"
+
+
+def _data_range(apdu: bytes) -> tuple[int, int]:
+    """Return the start and end offsets of the data field of a command."""
+    if len(apdu) <= 5:
+        return len(apdu), len(apdu)
+    if apdu[4] == 0 and len(apdu) > 7:
+        return 7, min(7 + int.from_bytes(apdu[5:7], "big"), len(apdu))
+    return 5, min(5 + apdu[4], len(apdu))
+
+
+def redact_command(apdu: bytes, redaction: Redaction) -> bytes:
+    if redaction == Redaction.NONE or len(apdu) < 4:
+        return apdu
+    start, end = _data_range(apdu)
+    if redaction == Redaction.SECRETS:
+        offset = SECRET_DATA_OFFSETS.get(apdu[1])
+        if offset is None:
+            return apdu
+        start = min(start + offset, end)
+    return apdu[:start] + bytes([REDACTED_BYTE]) * (end - start) + apdu[end:]
+
+
+def redact_response(data: bytes, redaction: Redaction) -> bytes:
+    """Redact the data of a response without the status word."""
+    if redaction != Redaction.DATA:
+        return data
+    return bytes([REDACTED_BYTE]) * len(data)
+
+
+class _Dump:
+    """Formats an APDU when the log message is formatted."""
+
+    def __init__(self, apdu: bytes, max_dump: int) -> None:
+        self.apdu = apdu
+        self.max_dump = max_dump
+
+    def __str__(self) -> str:
+        if len(self.apdu) <= self.max_dump:
+            return self.apdu.hex()
+        return f"{self.apdu[:self.max_dump].hex()}... ({len(self.apdu)} bytes)"
+
+
+@dataclass
+class TraceRecord:
+    direction: bytes
+    device: int
+    time: float
+    apdu: bytes
+
+    @property
+    def is_command(self) -> bool:
+        return self.direction == COMMAND
+
+
+class ApduTrace:
+    """Logs the APDUs and writes them to a trace file if `file` is set."""
+
+    def __init__(
+        self,
+        logger: Optional[logging.Logger] = None,
+        redaction: Redaction = Redaction.SECRETS,
+        file: Optional[BinaryIO] = None,
+        max_dump: int = DEFAULT_MAX_DUMP,
+    ) -> None:
+        self.logger = logger or logging.getLogger(LOGGER_NAME)
+        self.redaction = redaction
+        self.file = file
+        self.max_dump = max_dump
+        self.device = 0
+        self._prefix = ""
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._devices = itertools.count(1)
+        if file is not None:
+            file.write(MAGIC)
+
+    def for_device(self, name: str) -> "ApduTrace":
+        """Return a trace for one of several devices that are used
+        concurrently, marking its log messages and records with the reader
+        `name`."""
+        trace = copy.copy(self)
+        trace.device = next(self._devices)
+        trace._prefix = f"{name}: "
+        if self.file is not None:
+            trace._write(DEVICE, name.encode())
+        return trace
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None or self.logger.isEnabledFor(logging.DEBUG)
+
+    def _write(self, direction: bytes, apdu: bytes) -> None:
+        assert self.file is not None
+        elapsed = time.monotonic() - self._start
+        header = RECORD_HEADER.pack(direction, self.device, elapsed, len(apdu))
+        with self._lock:
+            self.file.write(header + apdu)
+
+    def command(self, apdu: bytes, info: str = "") -> None:
+        if not self.enabled:
+            return
+        apdu = redact_command(apdu, self.redaction)
+        if self.file is not None:
+            self._write(COMMAND, apdu)
+        self.logger.debug(
+            "%sSending %s %s", self._prefix, info, _Dump(apdu, self.max_dump)
+        )
+
+    def response(self, data: bytes, sw1: int, sw2: int) -> None:
+        if not self.enabled:
+            return
+        data = redact_response(data, self.redaction)
+        if self.file is not None:
+            self._write(RESPONSE, data + bytes([sw1, sw2]))
+        self.logger.debug(
+            "%sReceived [%02x%02x] %s",
+            self._prefix,
+            sw1,
+            sw2,
+            _Dump(data, self.max_dump),
+        )
+
+    def close(self) -> None:
+        if self.file is not None:
+            with self._lock:
+                self.file.flush()
+
+
+def read_trace(file: BinaryIO) -> Iterator[TraceRecord]:
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not an APDU trace file")
+    while True:
+        header = file.read(RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) != RECORD_HEADER.size:
+            raise ValueError("Truncated APDU trace file")
+        direction, device, elapsed, length = RECORD_HEADER.unpack(header)
+        apdu = file.read(length)
+        if len(apdu) != length:
+            raise ValueError("Truncated APDU trace file")
+        yield TraceRecord(direction, device, elapsed, apdu)
@@ -28,7 +28,7 @@ import time
 from array import array
 from contextlib import contextmanager
 from struct import *
-from typing import TYPE_CHECKING, Iterator, Optional, Tuple
+from typing import TYPE_CHECKING, Callable, Iterator, Optional, Tuple
 
 import usb
 
@@ -63,6 +63,34 @@ HID_CLASS = 0x03
 HID_SUBCLASS_NO_BOOT = 0x00
 HID_PROTOCOL_0 = 0x00
 
+# The firmware is downloaded in blocks of 256 bytes.  The Gnuk bootloader
+# accepts any length for a download to RAM, so several blocks are sent per
+# control transfer.  regnual writes every block to flash separately.
+DOWNLOAD_BLOCK_SIZE = 256
+DOWNLOAD_BLOCKS_PER_TRANSFER = 16
+# the timeout for a control transfer of one block in ms
+DOWNLOAD_TIMEOUT = 10
+# the minimum progress between two calls of the progress function
+PROGRESS_STEP = 0.01
+
+
+def throttle_progress(
+    progress_func: Optional[Callable[[float], None]], step: float = PROGRESS_STEP
+) -> Callable[[float], None]:
+    """Return a progress function that only calls `progress_func` at the start
+    and if the progress advanced by at least `step`."""
+    last: Optional[float] = None
+
+    def progress(value: float) -> None:
+        nonlocal last
+        if progress_func is None:
+            return
+        if last is None or value == 0 or value - last >= step:
+            last = value
+            progress_func(value)
+
+    return progress
+
 
 def icc_compose(
     msg_type: int, data_len: int, slot: int, seq: int, param: int, data: bytes
@@ -155,6 +183,12 @@ class gnuk_token(object):
         if verbose:
             print(message)
 
+    def log_block(self, addr: int, i: int, size: int, verbose: bool) -> None:
+        if verbose:
+            self.local_print("# %08x: %d : %d" % (addr, i, size), verbose)
+        else:
+            self.logger.debug("print: # %08x: %d : %d", addr, i, size)
+
     def get_string(self, num):
         return self.__devhandle.getString(num, 512)
 
@@ -196,40 +230,57 @@ class gnuk_token(object):
         end = ((mem[7] * 256 + mem[6]) * 256 + mem[5]) * 256 + mem[4]
         return (start, end)
 
-    def download(self, start, data, verbose=False, progress_func=None):
+    def download(
+        self,
+        start: int,
+        data: bytes,
+        verbose: bool = False,
+        progress_func: Optional[Callable[[float], None]] = None,
+        blocks_per_transfer: int = DOWNLOAD_BLOCKS_PER_TRANSFER,
+    ) -> None:
+        """
+        Download data to RAM, sending up to blocks_per_transfer blocks per
+        control transfer.  The last partial block is sent separately so that
+        the bootloader pads it with zeros.
+        """
+        if blocks_per_transfer < 1:
+            raise ValueError(
+                f"blocks_per_transfer must be at least 1, got {blocks_per_transfer}"
+            )
         addr = start
         addr_end = (start + len(data)) & 0xFFFFFF00
         i = int((addr - 0x20000000) / 0x100)
         j = 0
         self.local_print("start %08x" % addr, verbose)
         self.local_print("end   %08x" % addr_end)
-        if progress_func:
-            progress_func(0)
+        progress = throttle_progress(progress_func)
+        progress(0)
         while addr < addr_end:
-            if progress_func:
-                progress_func((addr - start) / (addr_end - start))
-            self.local_print("# %08x: %d : %d" % (addr, i, 256), verbose)
+            progress((addr - start) / (addr_end - start))
+            blocks = min(blocks_per_transfer, (addr_end - addr) // DOWNLOAD_BLOCK_SIZE)
+            size = blocks * DOWNLOAD_BLOCK_SIZE
+            self.log_block(addr, i, size, verbose)
             self.__devhandle.controlMsg(
                 requestType=0x40,
                 request=1,
-                buffer=data[j * 256 : j * 256 + 256],
+                buffer=data[j * 256 : j * 256 + size],
                 value=i,
                 index=0,
-                timeout=10,
+                timeout=DOWNLOAD_TIMEOUT * blocks,
             )
-            i = i + 1
-            j = j + 1
-            addr = addr + 256
+            i = i + blocks
+            j = j + blocks
+            addr = addr + size
         residue = len(data) % 256
         if residue != 0:
-            self.local_print("# %08x: %d : %d" % (addr, i, residue), verbose)
+            self.log_block(addr, i, residue, verbose)
             self.__devhandle.controlMsg(
                 requestType=0x40,
                 request=1,
                 buffer=data[j * 256 :],
                 value=i,
                 index=0,
-                timeout=10,
+                timeout=DOWNLOAD_TIMEOUT,
             )
 
     def execute(self, last_addr):
@@ -611,12 +662,14 @@ class regnual(object):
         j = 0
         self.local_print("start %08x" % addr, verbose)
         self.local_print("end   %08x" % addr_end, verbose)
-        if progress_func:
-            progress_func(0)
+        progress = throttle_progress(progress_func)
+        progress(0)
         while addr < addr_end:
-            if progress_func:
-                progress_func((addr - start) / (addr_end - start))
-            self.local_print("# %08x: %d: %d : %d" % (addr, i, j, 256), verbose)
+            progress((addr - start) / (addr_end - start))
+            if verbose:
+                self.local_print("# %08x: %d: %d : %d" % (addr, i, j, 256), verbose)
+            else:
+                self.logger.debug("print: # %08x: %d: %d : %d", addr, i, j, 256)
             self.__devhandle.controlMsg(
                 requestType=0x40,
                 request=1,
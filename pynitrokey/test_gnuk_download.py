@@ -0,0 +1,144 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests and benchmark for the firmware download to the Gnuk bootloader, using a
+simulated USB device handle.  Does not require a device.
+
+Run `python -m pynitrokey.test_gnuk_download` to compare the number of
+control transfers and the download time with one and with several blocks
+per transfer.  The simulated handle adds a fixed latency to every transfer.
+"""
+
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+from pynitrokey.start.gnuk_token import (
+    CCID_CLASS,
+    CCID_SUBCLASS,
+    DOWNLOAD_BLOCKS_PER_TRANSFER,
+    gnuk_token,
+    throttle_progress,
+)
+
+RAM_START = 0x20001400
+# the latency of a control transfer to a USB full speed device
+LATENCY = 0.001
+
+
+class SimulatedHandle:
+    """A USB device handle that stores downloads in a simulated RAM."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.ram = bytearray(0x5000)
+        self.transfers = 0
+
+    def claimInterface(self, interface: Any) -> None:
+        pass
+
+    def setAltInterface(self, interface: Any) -> None:
+        pass
+
+    def controlMsg(
+        self,
+        requestType: int,
+        request: int,
+        buffer: bytes,
+        value: int,
+        index: int,
+        timeout: int,
+    ) -> None:
+        assert (requestType, request) == (0x40, 1)
+        self.transfers += 1
+        time.sleep(self.latency)
+        offset = value * 0x100 + index
+        self.ram[offset : offset + len(buffer)] = buffer
+        if len(buffer) < 0x100:
+            self.ram[offset + len(buffer) : offset + 0x100] = bytes(0x100 - len(buffer))
+
+
+def open_token(handle: SimulatedHandle) -> gnuk_token:
+    interface = SimpleNamespace(
+        interfaceClass=CCID_CLASS,
+        interfaceSubClass=CCID_SUBCLASS,
+        interfaceNumber=0,
+        alternateSetting=0,
+    )
+    device = SimpleNamespace(open=lambda: handle)
+    configuration = SimpleNamespace(interfaces=[])
+    return gnuk_token(device, configuration, interface)  # type: ignore[arg-type]
+
+
+def image(size: int) -> bytes:
+    return bytes(i % 251 for i in range(size))
+
+
+@pytest.mark.parametrize("blocks_per_transfer", [1, DOWNLOAD_BLOCKS_PER_TRANSFER])
+def test_download(blocks_per_transfer: int) -> None:
+    handle = SimulatedHandle()
+    token = open_token(handle)
+    data = image(19 * 256 + 100)
+    progress: list[float] = []
+
+    token.download(
+        RAM_START,
+        data,
+        progress_func=progress.append,
+        blocks_per_transfer=blocks_per_transfer,
+    )
+
+    offset = RAM_START - 0x20000000
+    assert handle.ram[offset : offset + len(data)] == data
+    # the last partial block is padded with zeros
+    assert handle.ram[offset + len(data) : offset + 20 * 256] == bytes(156)
+    assert handle.transfers == -(-19 // blocks_per_transfer) + 1
+    assert progress[0] == 0
+    assert progress == sorted(progress)
+
+
+@pytest.mark.parametrize("blocks_per_transfer", [0, -1])
+def test_download_invalid_blocks(blocks_per_transfer: int) -> None:
+    handle = SimulatedHandle()
+    token = open_token(handle)
+    with pytest.raises(ValueError, match="blocks_per_transfer"):
+        token.download(RAM_START, image(1024), blocks_per_transfer=blocks_per_transfer)
+    assert handle.transfers == 0
+
+
+def test_throttle_progress() -> None:
+    values: list[float] = []
+    progress = throttle_progress(values.append, step=0.25)
+    for i in range(101):
+        progress(i / 100)
+    assert values == [0, 0.25, 0.5, 0.75, 1]
+
+
+def main() -> None:
+    print(f"{'size':>8}  {'blocks':>6}  {'transfers':>9}  {'time':>8}")
+    for size in (4096, 16384):
+        data = image(size)
+        for blocks_per_transfer in (1, DOWNLOAD_BLOCKS_PER_TRANSFER):
+            handle = SimulatedHandle(latency=LATENCY)
+            token = open_token(handle)
+
+            start = time.perf_counter()
+            token.download(
+                RAM_START,
+                data,
+                progress_func=lambda value: None,
+                blocks_per_transfer=blocks_per_transfer,
+            )
+            elapsed = time.perf_counter() - start
+
+            print(
+                f"{size:>6} B  {blocks_per_transfer:>6}  {handle.transfers:>9}  "
+                f"{elapsed * 1000:>5.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
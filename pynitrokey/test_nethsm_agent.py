@@ -0,0 +1,69 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the NetHSM agent, forwarding requests to the local mock of the
+NetHSM API.  Does not require a device.
+"""
+
+import threading
+from typing import Iterator
+
+import pytest
+from nethsm import Authentication, NetHSM
+
+from pynitrokey.nethsm import agent as nethsm_agent
+from pynitrokey.nethsm.mock import DEFAULT_PASSWORD, DEFAULT_USERNAME, MockNetHSM
+
+
+@pytest.fixture
+def agent(
+    mock: MockNetHSM,
+    tmp_path_factory: pytest.TempPathFactory,
+    monkeypatch: pytest.MonkeyPatch,
+) -> Iterator[nethsm_agent.Agent]:
+    # the path of the socket must be short
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path_factory.mktemp("run")))
+    auth = Authentication(DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    agent = nethsm_agent.Agent(mock.host, auth, verify_tls=False)
+    agent.bind()
+    thread = threading.Thread(target=agent.serve, daemon=True)
+    thread.start()
+    yield agent
+    assert nethsm_agent.stop(agent.socket_path)
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert nethsm_agent.status(agent.socket_path) is None
+
+
+def test_find(mock: MockNetHSM, agent: nethsm_agent.Agent) -> None:
+    info = nethsm_agent.find(mock.host, DEFAULT_USERNAME)
+    assert info is not None
+    assert info.socket_path == agent.socket_path
+    assert (info.host, info.username) == (mock.host, DEFAULT_USERNAME)
+
+    # without a user name, the only agent for the host is used
+    assert nethsm_agent.find(mock.host, None) == info
+    assert nethsm_agent.find(mock.host, "admin") is None
+    assert nethsm_agent.find("127.0.0.1:1", None) is None
+
+
+def test_forward(mock: MockNetHSM, agent: nethsm_agent.Agent) -> None:
+    info = nethsm_agent.find(mock.host, DEFAULT_USERNAME)
+    assert info is not None
+
+    # the agent replaces the credentials of the client with its own
+    nethsm = NetHSM(mock.host, Authentication(DEFAULT_USERNAME, "wrong"), False)
+    try:
+        nethsm_agent.attach(nethsm, info)
+        assert set(nethsm.list_keys()) == set(mock.keys)
+        assert nethsm.get_key("rsa").type.value == mock.keys["rsa"].type
+    finally:
+        nethsm.close()
+    assert agent.requests == 2
+
+
+def test_bind_running(agent: nethsm_agent.Agent) -> None:
+    other = nethsm_agent.Agent(agent.host, agent.auth, verify_tls=False, idle_timeout=1)
+    with pytest.raises(ValueError, match="already running"):
+        other.bind()
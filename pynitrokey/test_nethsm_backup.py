@@ -0,0 +1,196 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the download, parsing and export of NetHSM backups, using
+generated backup files and the local mock of the NetHSM API.  Does not
+require a device.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import subprocess
+from pathlib import Path
+
+import pytest
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from nethsm.backup import EncryptedBackup
+
+from pynitrokey.nethsm import backup as nethsm_backup
+from pynitrokey.nethsm.backup import HEADER, VERSION
+from pynitrokey.nethsm.mock import MockNetHSM
+from pynitrokey.testing import nethsm_args, run_nitropy
+
+PASSPHRASE = "passphrase"
+
+
+def field(data: bytes) -> bytes:
+    return struct.pack(">BH", len(data) >> 16, len(data) & 0xFFFF) + data
+
+
+def encrypt(key: bytes, adata: bytes, data: bytes) -> bytes:
+    iv = os.urandom(12)
+    return iv + AESGCM(key).encrypt(iv, data, adata)
+
+
+def build_backup(items: dict[str, bytes], passphrase: str = PASSPHRASE) -> bytes:
+    """Create a backup in the format of the NetHSM."""
+    salt = os.urandom(16)
+    key = hashlib.scrypt(
+        password=passphrase.encode(), salt=salt, n=16384, r=8, p=16, dklen=32
+    )
+    backup = HEADER + bytes([VERSION]) + field(salt)
+    backup += field(encrypt(key, b"backup-version", bytes([VERSION])))
+    backup += field(encrypt(key, b"domain-key", b"domain key"))
+    for name, value in items.items():
+        backup += field(encrypt(key, b"backup", field(name.encode()) + value))
+    return backup
+
+
+def export(*args: str) -> subprocess.CompletedProcess[str]:
+    return run_nitropy("nethsm", "export-backup", *args)
+
+
+def test_reader() -> None:
+    items = {"/key/a": b"1", "/key/b": bytes(100000)}
+    data = build_backup(items)
+    reader = nethsm_backup.BackupReader(data)
+    assert reader.validate() == 2
+
+    key = reader.key(PASSPHRASE)
+    assert reader.decrypt_metadata(key) == (VERSION, b"domain key")
+    assert dict(reader.decrypt_items(key)) == items
+
+    # the result is the same as with the parser of the NetHSM SDK
+    backup = EncryptedBackup.parse(data).decrypt(PASSPHRASE)
+    assert backup.domain_key == b"domain key"
+    assert backup.data == items
+    reader.release()
+
+
+def test_reader_invalid() -> None:
+    data = build_backup({"/key/a": b"1"})
+    with pytest.raises(ValueError, match="does not contain a NetHSM header"):
+        nethsm_backup.BackupReader(b"_NETHSM_")
+    with pytest.raises(ValueError, match="Version mismatch"):
+        nethsm_backup.BackupReader(HEADER + b"\x01" + data[len(HEADER) + 1 :])
+    with pytest.raises(ValueError, match="Failed to extract field"):
+        nethsm_backup.BackupReader(data[: len(HEADER) + 10])
+    with pytest.raises(ValueError, match="Failed to extract field"):
+        nethsm_backup.BackupReader(data[:-1]).validate()
+
+    reader = nethsm_backup.BackupReader(data)
+    with pytest.raises(ValueError, match="Authentication tag verification failed"):
+        reader.decrypt_metadata(reader.key("wrong"))
+
+
+def test_open_backup(tmp_path: Path) -> None:
+    path = tmp_path / "backup"
+    path.write_bytes(b"")
+    with pytest.raises(ValueError, match="does not contain a NetHSM header"):
+        with nethsm_backup.open_backup(str(path)):
+            pass
+
+    path.write_bytes(build_backup({"/key/a": b"1"}))
+    with nethsm_backup.open_backup(str(path)) as reader:
+        assert reader.validate() == 1
+
+
+def test_temporary_file(tmp_path: Path) -> None:
+    path = tmp_path / "backup"
+    with pytest.raises(RuntimeError):
+        with nethsm_backup.temporary_file(str(path)) as f:
+            f.write(b"partial")
+            raise RuntimeError()
+    assert list(tmp_path.iterdir()) == []
+
+    with nethsm_backup.temporary_file(str(path)) as f:
+        f.write(b"backup")
+    assert path.read_bytes() == b"backup"
+
+    with pytest.raises(FileExistsError):
+        with nethsm_backup.temporary_file(str(path)) as f:
+            f.write(b"other")
+    assert list(tmp_path.iterdir()) == [path]
+    assert path.read_bytes() == b"backup"
+
+
+def test_download(mock: MockNetHSM, tmp_path: Path) -> None:
+    args = nethsm_args(mock.host)
+    path = tmp_path / "backup"
+
+    result = run_nitropy(*args, "backup", str(path))
+    assert result.returncode != 0
+    assert "backup passphrase is not set" in result.stderr
+    assert not path.exists()
+
+    mock.backup = build_backup({f"/key/{i}": os.urandom(1000) for i in range(100)})
+    result = run_nitropy(*args, "backup", str(path))
+    assert result.returncode == 0
+    assert path.read_bytes() == mock.backup
+
+    result = run_nitropy("nethsm", "validate-backup", "-p", PASSPHRASE, str(path))
+    assert result.returncode == 0
+    assert "Backup metadata and content are valid." in result.stdout
+
+
+def test_export(tmp_path: Path) -> None:
+    path = tmp_path / "backup"
+    path.write_bytes(build_backup({"/key/a": b"1", "/key/b": b"2"}))
+
+    result = export("-p", PASSPHRASE, str(path))
+    assert result.returncode == 0
+    assert json.loads(result.stdout) == {
+        ".locked-domain-key": "ZG9tYWluIGtleQ==",
+        ".version": VERSION,
+        "/key/a": "MQ==",
+        "/key/b": "Mg==",
+    }
+
+
+def test_export_wrong_passphrase(tmp_path: Path) -> None:
+    path = tmp_path / "backup"
+    path.write_bytes(build_backup({"/key/a": b"1"}))
+
+    for format in ["json", "jsonl"]:
+        result = export("-p", "wrong", "--format", format, str(path))
+        assert result.returncode != 0
+        assert "Failed to decrypt backup metadata" in result.stdout
+        # nothing of the export has been printed
+        assert "{" not in result.stdout
+
+
+def test_diff_entries() -> None:
+    old = [("a", 1), ("b", {"x": 1}), ("c", "removed")]
+    new = [("d", "added"), ("b", {"x": 2}), ("a", 1)]
+    assert list(nethsm_backup.diff_entries(old, new)) == [
+        ("added", "d", "added"),
+        ("changed", "b", {"x": 2}),
+        ("removed", "c", None),
+    ]
+
+
+def test_export_jsonl_and_diff(tmp_path: Path) -> None:
+    old = tmp_path / "old"
+    old.write_bytes(build_backup({"/key/a": b"1", "/key/b": b"2"}))
+    new = tmp_path / "new"
+    new.write_bytes(build_backup({"/key/a": b"1", "/key/b": b"3", "/key/c": b"4"}))
+
+    result = export("-p", PASSPHRASE, "--format", "jsonl", str(new))
+    assert result.returncode == 0
+    assert [json.loads(line) for line in result.stdout.splitlines()] == [
+        {"key": ".locked-domain-key", "value": "ZG9tYWluIGtleQ=="},
+        {"key": ".version", "value": VERSION},
+        {"key": "/key/a", "value": "MQ=="},
+        {"key": "/key/b", "value": "Mw=="},
+        {"key": "/key/c", "value": "NA=="},
+    ]
+
+    result = export("-p", PASSPHRASE, "--diff", str(old), str(new))
+    assert result.returncode == 0
+    assert [json.loads(line) for line in result.stdout.splitlines()] == [
+        {"change": "changed", "key": "/key/b", "value": "Mw=="},
+        {"change": "added", "key": "/key/c", "value": "NA=="},
+    ]
@@ -0,0 +1,40 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Runs `nitropy nethsm bench` against the local mock of the NetHSM API.
+Does not require a device.
+"""
+
+import json
+from typing import Any
+
+import pytest
+
+from pynitrokey.testing import run_nitropy
+
+
+def run_bench(*args: str) -> dict[str, Any]:
+    result = run_nitropy("nethsm", "bench", "--mock", "--format=json", *args)
+    assert result.returncode == 0, result.stderr
+    data = json.loads(result.stdout)
+    assert isinstance(data, dict)
+    return data
+
+
+@pytest.mark.parametrize("operation", ["sign", "encrypt", "decrypt", "random"])
+def test_bench_mock(operation: str) -> None:
+    result = run_bench("--operation", operation, "--count", "50", "--jobs", "4")
+    assert result["count"] == 50
+    assert result["errors"] == 0
+    assert result["ops_per_second"] > 0
+    latency = result["latency"]
+    assert 0 < latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]
+
+
+def test_bench_mock_rsa_decrypt() -> None:
+    result = run_bench(
+        "--operation", "decrypt", "--key-id", "rsa", "--mode", "OAEP_SHA256"
+    )
+    assert result["operation"] == "decrypt OAEP_SHA256"
+    assert result["errors"] == 0
@@ -0,0 +1,215 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the bulk helpers and runs the nethsm bulk-* commands against the
+local mock of the NetHSM API.  Does not require a device.
+"""
+
+import base64
+import hashlib
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from pynitrokey.nethsm import bulk
+from pynitrokey.nethsm.mock import MockNetHSM
+from pynitrokey.testing import NITROPY, nethsm_args, run_nitropy
+
+
+def nitropy(
+    mock: MockNetHSM, input: str, *args: str
+) -> subprocess.CompletedProcess[str]:
+    return run_nitropy(*nethsm_args(mock.host), *args, input=input)
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def test_read_items() -> None:
+    items = list(
+        bulk.read_items(io.StringIO("YQ==\n\nYg==\n"), bulk.InputFormat.BASE64)
+    )
+    assert [(item.id, item.data) for item in items] == [(1, "YQ=="), (3, "Yg==")]
+
+    lines = '{"id": "a", "data": "YQ==", "iv": "x"}\n{"data": "Yg=="}\n'
+    items = list(bulk.read_items(io.StringIO(lines), bulk.InputFormat.JSONL))
+    assert [(item.id, item.data) for item in items] == [("a", "YQ=="), (2, "Yg==")]
+    assert items[0].fields == {"iv": "x"}
+
+    with pytest.raises(ValueError, match="Line 1 has too many values"):
+        list(bulk.read_items(io.StringIO("YQ== x\n"), bulk.InputFormat.BASE64))
+    with pytest.raises(ValueError, match="Line 2 is not a JSON object"):
+        list(bulk.read_items(io.StringIO('{"data": ""}\n[]\n'), bulk.InputFormat.JSONL))
+
+
+def test_write_result(capsys: pytest.CaptureFixture[str]) -> None:
+    item = bulk.Item(id=2, data="YQ==")
+    ok = bulk.Result(item, value={"signature": "c2ln"})
+    failed = bulk.Result(item, error="Invalid data")
+
+    output = io.StringIO()
+    bulk.write_result(output, bulk.InputFormat.BASE64, ok)
+    bulk.write_result(output, bulk.InputFormat.BASE64, failed)
+    # the failed item leaves an empty line so that the lines match the input
+    assert output.getvalue() == "c2ln\n\n"
+    assert capsys.readouterr().err == "Line 2: Invalid data\n"
+
+    output = io.StringIO()
+    bulk.write_result(output, bulk.InputFormat.JSONL, ok)
+    bulk.write_result(output, bulk.InputFormat.JSONL, failed)
+    assert [json.loads(line) for line in output.getvalue().splitlines()] == [
+        {"id": 2, "signature": "c2ln"},
+        {"id": 2, "error": "Invalid data"},
+    ]
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_ordered_map(jobs: int) -> None:
+    lock = threading.Lock()
+    read = 0
+    running = 0
+    max_running = 0
+
+    def items() -> Iterator[int]:
+        nonlocal read
+        for i in range(20):
+            read += 1
+            yield i
+
+    def fn(i: int) -> int:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        # later items finish first
+        time.sleep(0.001 * (i % 4))
+        with lock:
+            running -= 1
+        return i * i
+
+    results = bulk.ordered_map(fn, items(), jobs)
+    assert next(results) == 0
+    # the input is consumed lazily
+    assert read <= 2 * jobs
+    assert list(results) == [i * i for i in range(1, 20)]
+    assert max_running <= jobs
+
+
+def test_bulk_sign(mock: MockNetHSM) -> None:
+    data = [os.urandom(i) for i in range(1, 20)]
+    lines = [b64(value) for value in data]
+    lines[3] = "invalid"
+
+    result = nitropy(
+        mock,
+        "\n".join(lines) + "\n",
+        "bulk-sign",
+        "--key-id=ed25519",
+        "--mode=EdDSA",
+        "--jobs=4",
+    )
+    assert result.returncode != 0
+    assert "1 of 19 requests" in result.stderr
+    assert "Signed: 19 items" in result.stderr
+
+    signatures = result.stdout.split("\n")[:-1]
+    assert len(signatures) == len(data)
+    for i, (value, signature) in enumerate(zip(data, signatures)):
+        if i == 3:
+            assert signature == ""
+        else:
+            assert signature == b64(hashlib.sha256(value).digest())
+
+
+def test_bulk_sign_jsonl(mock: MockNetHSM) -> None:
+    lines = [json.dumps({"id": f"item{i}", "data": b64(bytes([i]))}) for i in range(5)]
+    result = nitropy(
+        mock,
+        "\n".join(lines),
+        "bulk-sign",
+        "--key-id=ed25519",
+        "--mode=EdDSA",
+        "--format=jsonl",
+    )
+    assert result.returncode == 0
+    assert [json.loads(line) for line in result.stdout.splitlines()] == [
+        {"id": f"item{i}", "signature": b64(hashlib.sha256(bytes([i])).digest())}
+        for i in range(5)
+    ]
+
+
+def test_read_items_columns() -> None:
+    lines = io.StringIO("YQ== aXY=\nYg==\n")
+    items = list(bulk.read_items(lines, bulk.InputFormat.BASE64, columns=["iv"]))
+    assert [item.fields for item in items] == [{"iv": "aXY="}, {}]
+
+
+@pytest.mark.parametrize("format", ["base64", "jsonl"])
+def test_bulk_encrypt_decrypt(mock: MockNetHSM, format: str) -> None:
+    data = [os.urandom(16 * i) for i in range(1, 10)]
+    if format == "base64":
+        input = "\n".join(b64(value) for value in data)
+    else:
+        input = "\n".join(json.dumps({"data": b64(value)}) for value in data)
+    args = ["--key-id=aes", "--mode=AES_CBC", f"--format={format}", "--jobs=4"]
+
+    encrypted = nitropy(mock, input, "bulk-encrypt", *args)
+    assert encrypted.returncode == 0
+    assert len(encrypted.stdout.splitlines()) == len(data)
+
+    # the output of bulk-encrypt is the input of bulk-decrypt
+    decrypted = nitropy(mock, encrypted.stdout, "bulk-decrypt", *args)
+    assert decrypted.returncode == 0
+    if format == "base64":
+        lines = decrypted.stdout.splitlines()
+    else:
+        lines = [
+            json.loads(line)["decrypted"] for line in decrypted.stdout.splitlines()
+        ]
+    assert lines == [b64(value) for value in data]
+
+
+def test_chunk_lengths() -> None:
+    assert list(bulk.chunk_lengths(2500)) == [1024, 1024, 452]
+    assert list(itertools.islice(bulk.chunk_lengths(None), 3)) == [1024] * 3
+
+
+def test_random_raw(mock: MockNetHSM, tmp_path: Path) -> None:
+    path = tmp_path / "random"
+    result = nitropy(mock, "", "random", "--raw", "2500", "-o", str(path))
+    assert result.returncode == 0, result.stderr
+    assert len(path.read_bytes()) == 2500
+    assert "Received 2500 bytes" in result.stderr
+
+    result = nitropy(mock, "", "random", "16", "-o", str(path))
+    assert result.returncode == 2
+    assert "-o/--output can only be used with --raw" in result.stderr
+
+
+def test_random_raw_broken_pipe(mock: MockNetHSM) -> None:
+    # nitropy nethsm random --raw 0 | head -c 10
+    process = subprocess.Popen(
+        [sys.executable, "-c", NITROPY, *nethsm_args(mock.host)]
+        + ["random", "--raw", "0"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=dict(os.environ, ALLOW_ROOT="1"),
+    )
+    assert process.stdout is not None
+    assert len(process.stdout.read(10)) == 10
+    process.stdout.close()
+    _, stderr = process.communicate(timeout=30)
+    assert process.returncode == 0, stderr
+    assert b"Traceback" not in stderr
+    assert b"Received" in stderr
@@ -0,0 +1,161 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the key metadata cache, using the local mock of the NetHSM API.
+Does not require a device.
+"""
+
+import json
+import os
+from pathlib import Path
+from subprocess import CompletedProcess
+from typing import Iterator, Optional
+
+import pytest
+from nethsm import Authentication, KeyType, NetHSM
+
+from pynitrokey.nethsm import cache as nethsm_cache
+from pynitrokey.nethsm.mock import DEFAULT_PASSWORD, DEFAULT_USERNAME, MockNetHSM
+from pynitrokey.testing import nethsm_args, run_nitropy
+
+
+@pytest.fixture
+def nethsm(
+    mock: MockNetHSM, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> Iterator[NetHSM]:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    auth = Authentication(DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    client = NetHSM(mock.host, auth, verify_tls=False)
+    yield client
+    client.close()
+
+
+def test_namespace() -> None:
+    assert nethsm_cache.namespace(None) == ""
+    assert nethsm_cache.namespace("operator") == ""
+    assert nethsm_cache.namespace("tenant~operator") == "tenant"
+
+
+def test_get_key(mock: MockNetHSM, nethsm: NetHSM) -> None:
+    cache = nethsm_cache.KeyCache(nethsm.host)
+    key = cache.get_key(nethsm, "rsa")
+    pem = cache.get_key_public_key(nethsm, "rsa")
+    requests = mock.requests
+    cache.save()
+    assert os.path.exists(cache.path)
+
+    # the entries are read from disk
+    cache = nethsm_cache.KeyCache(nethsm.host)
+    assert cache.get_key(nethsm, "rsa") == key
+    assert cache.get_key_public_key(nethsm, "rsa") == pem
+    assert mock.requests == requests
+
+    # other namespaces have their own cache
+    cache = nethsm_cache.KeyCache(nethsm.host, "tenant")
+    assert cache.get_key(nethsm, "rsa").type == KeyType.RSA
+    assert mock.requests == requests + 1
+
+
+def test_invalidate(mock: MockNetHSM, nethsm: NetHSM) -> None:
+    cache = nethsm_cache.KeyCache(nethsm.host)
+    cache.get_key(nethsm, "rsa")
+    cache.get_key(nethsm, "aes")
+    mock.keys["rsa"].tags.append("tag")
+
+    cache.invalidate("rsa")
+    assert cache.get_key(nethsm, "rsa").tags == ["tag"]
+
+    # deleted keys are removed
+    cache.retain(["rsa"])
+    assert set(cache.entries) == {"rsa"}
+    cache.clear()
+    assert cache.entries == {}
+
+
+def test_expired(mock: MockNetHSM, nethsm: NetHSM) -> None:
+    cache = nethsm_cache.KeyCache(nethsm.host, ttl=60)
+    cache.get_key(nethsm, "rsa")
+    cache.entries["rsa"]["time"] -= 60
+    requests = mock.requests
+    cache.get_key(nethsm, "rsa")
+    assert mock.requests == requests + 1
+
+    # expired entries are not written to disk
+    cache.get_key(nethsm, "aes")
+    cache.entries["aes"]["time"] -= 60
+    cache.save()
+    assert nethsm_cache.KeyCache(nethsm.host).entries.keys() == {"rsa"}
+
+
+def test_refresh_and_disabled(mock: MockNetHSM, nethsm: NetHSM) -> None:
+    cache = nethsm_cache.KeyCache(nethsm.host)
+    cache.get_key(nethsm, "rsa")
+    cache.save()
+
+    for cache in [
+        nethsm_cache.KeyCache(nethsm.host, refresh=True),
+        nethsm_cache.KeyCache(nethsm.host, ttl=0),
+    ]:
+        requests = mock.requests
+        cache.get_key(nethsm, "rsa")
+        assert mock.requests == requests + 1
+
+
+def test_invalid_file(nethsm: NetHSM) -> None:
+    cache = nethsm_cache.KeyCache(nethsm.host)
+    os.makedirs(os.path.dirname(cache.path))
+    for content in ["invalid", json.dumps({"version": 0, "keys": {"rsa": {}}})]:
+        with open(cache.path, "w") as f:
+            f.write(content)
+        assert nethsm_cache.KeyCache(nethsm.host).entries == {}
+
+
+def test_cli(mock: MockNetHSM, tmp_path: Path) -> None:
+    def nitropy(*args: str) -> str:
+        result = run_nitropy(
+            *nethsm_args(mock.host), *args, env={"XDG_CACHE_HOME": str(tmp_path)}
+        )
+        assert result.returncode == 0, result.stderr
+        return result.stdout
+
+    def tags() -> dict[str, list[str]]:
+        keys = json.loads(nitropy("list-keys", "--format=json"))
+        return {key["key_id"]: key["tags"] for key in keys}
+
+    assert tags() == {"ed25519": [], "rsa": [], "aes": []}
+    requests = mock.requests
+    tags()
+    # only the list of keys is queried
+    assert mock.requests == requests + 1
+
+    # commands that change a key invalidate its entry
+    nitropy("add-key-tag", "rsa", "tag")
+    assert tags()["rsa"] == ["tag"]
+
+
+def test_cli_mode(mock: MockNetHSM, tmp_path: Path) -> None:
+    def nitropy(*args: str, input: Optional[str] = None) -> CompletedProcess[str]:
+        return run_nitropy(
+            *nethsm_args(mock.host),
+            *args,
+            input=input,
+            env={"XDG_CACHE_HOME": str(tmp_path)},
+        )
+
+    # the prompt only offers the modes of the key
+    result = nitropy("sign", "-k", "rsa", "-d", "YWJj", input="PSS_SHA256\n")
+    assert result.returncode == 0, result.stderr
+    assert "Mode (PKCS1, PSS_SHA256):" in result.stdout
+
+    # an unsupported mode is rejected with the cached metadata, without a
+    # request to the NetHSM
+    requests = mock.requests
+    result = nitropy("sign", "-k", "rsa", "-d", "YWJj", "-m", "PSS_SHA512")
+    assert result.returncode != 0
+    assert "Key rsa does not support the mode PSS_SHA512" in result.stderr
+    assert mock.requests == requests
+
+    result = nitropy("encrypt", "-k", "rsa", "-d", "YWJj", "-m", "AES_CBC")
+    assert result.returncode != 0
+    assert "Key rsa does not support the encryption operation" in result.stderr
@@ -0,0 +1,102 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for running NetHSM commands on multiple hosts, using the local mock of
+the NetHSM API.  Does not require a device.
+"""
+
+import io
+import json
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from pynitrokey.nethsm import fanout
+from pynitrokey.nethsm.mock import MockNetHSM
+from pynitrokey.test_nethsm_backup import build_backup
+from pynitrokey.testing import mock_nethsm, nethsm_args, run_nitropy
+
+
+@pytest.fixture
+def mocks() -> Iterator[list[MockNetHSM]]:
+    with mock_nethsm() as first, mock_nethsm() as second:
+        yield [first, second]
+
+
+def test_read_inventory() -> None:
+    inventory = io.StringIO("# NetHSMs\nnethsm1:8443\n\n  nethsm2  # backup\n")
+    assert fanout.read_inventory(inventory) == ["nethsm1:8443", "nethsm2"]
+
+
+def test_run() -> None:
+    def fn(host: str) -> None:
+        assert fanout.is_worker()
+        # the hosts finish in the reverse order
+        time.sleep(0.01 * (3 - int(host[-1])))
+        print(f"output of {host}")
+        if host == "host2":
+            raise fanout.HostError("Failed on host2")
+        if host == "host3":
+            raise ValueError("Unexpected")
+
+    results = fanout.run(["host1", "host2", "host3"], fn, jobs=3)
+    assert not fanout.is_worker()
+    assert [result.host for result in results] == ["host1", "host2", "host3"]
+    assert [result.output for result in results] == [
+        f"output of host{i}\n" for i in range(1, 4)
+    ]
+    assert [result.error for result in results] == [
+        None,
+        "Failed on host2",
+        "ValueError: Unexpected",
+    ]
+
+
+def test_cli(mocks: list[MockNetHSM]) -> None:
+    hosts = [mock.host for mock in mocks] + ["127.0.0.1:1"]
+    result = run_nitropy(
+        *nethsm_args(*hosts),
+        "--results",
+        "json",
+        "list-keys",
+        "--no-details",
+        "--format",
+        "json",
+    )
+    assert result.returncode != 0
+    assert "list-keys failed on 1 of 3 hosts" in result.stderr
+
+    results = json.loads(result.stdout)
+    assert [r["host"] for r in results] == hosts
+    assert [r["ok"] for r in results] == [True, True, False]
+    for r in results[:2]:
+        assert {key["key_id"] for key in r["output"]} == set(mocks[0].keys)
+    # the CliException of the command is reported as the error of the host
+    assert "Is the NetHSM running and reachable?" in results[2]["error"]
+
+
+def test_backup(mocks: list[MockNetHSM], tmp_path: Path) -> None:
+    for i, mock in enumerate(mocks):
+        mock.backup = build_backup({"/key/a": bytes([i])})
+    hosts = [mock.host for mock in mocks]
+    result = run_nitropy(*nethsm_args(*hosts), "backup", str(tmp_path / "backup"))
+    assert result.returncode == 0, result.stdout
+
+    # every host writes its own file
+    for mock in mocks:
+        path = tmp_path / f"backup.{mock.host.replace(':', '_')}"
+        assert path.read_bytes() == mock.backup
+
+
+def test_backup_filename() -> None:
+    from pynitrokey.cli.nethsm import backup_filename
+
+    assert backup_filename("backup", "nethsm:8443") == "backup"
+    assert backup_filename("{host}.bin", "nethsm:8443") == "nethsm_8443.bin"
+    results = fanout.run(
+        ["nethsm"], lambda host: print(backup_filename("backup", host)), jobs=1
+    )
+    assert results[0].output == "backup.nethsm\n"
@@ -0,0 +1,103 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Runs `nitropy nethsm bulk-add-keys` against the local mock of the NetHSM API.
+Does not require a device.
+"""
+
+import json
+from pathlib import Path
+
+import pytest
+from nethsm import KeyMechanism, KeyType
+
+from pynitrokey.nethsm import manifest
+from pynitrokey.nethsm.mock import MockNetHSM
+from pynitrokey.testing import nethsm_args, run_nitropy
+
+
+def bulk_add_keys(
+    mock: MockNetHSM, tmp_path: Path, filename: Path
+) -> list[dict[str, str]]:
+    result = run_nitropy(
+        *nethsm_args(mock.host),
+        "bulk-add-keys",
+        "--format=json",
+        str(filename),
+        env={"XDG_CACHE_HOME": str(tmp_path)},
+    )
+    assert result.returncode == 0, result.stderr
+    data = json.loads(result.stdout)
+    assert isinstance(data, list)
+    return data
+
+
+def test_read_manifest_csv(tmp_path: Path) -> None:
+    filename = tmp_path / "keys.csv"
+    filename.write_text(
+        "id,type,length,mechanisms,tags\n"
+        "rsa1,RSA,2048,RSA_Signature_PKCS1;RSA_Decryption_PKCS1,a b\n"
+        "ec1,EC_P256,,,\n"
+    )
+    rsa, ec = manifest.read_manifest(str(filename))
+    assert rsa.type == KeyType.RSA
+    assert rsa.length == 2048
+    assert rsa.mechanisms == [
+        KeyMechanism.RSA_SIGNATURE_PKCS1,
+        KeyMechanism.RSA_DECRYPTION_PKCS1,
+    ]
+    assert rsa.tags == ["a", "b"]
+    assert ec.length == 256
+    assert ec.mechanisms == []
+
+
+def test_read_manifest_invalid(tmp_path: Path) -> None:
+    filename = tmp_path / "keys.json"
+    filename.write_text(json.dumps([{"id": "k", "type": "RSA"}]))
+    with pytest.raises(ValueError, match="Missing length"):
+        manifest.read_manifest(str(filename))
+
+    filename.write_text(json.dumps([{"id": "k", "type": "Generic", "length": 128}] * 2))
+    with pytest.raises(ValueError, match="Duplicate key ID"):
+        manifest.read_manifest(str(filename))
+
+
+def test_bulk_add_keys(mock: MockNetHSM, tmp_path: Path) -> None:
+    filename = tmp_path / "keys.json"
+    filename.write_text(
+        json.dumps(
+            {
+                "keys": [
+                    {
+                        "id": "rsa",
+                        "type": "RSA",
+                        "length": 2048,
+                        "mechanisms": ["RSA_Signature_PKCS1"],
+                    },
+                    {"id": "new1", "type": "Curve25519", "tags": ["tenant"]},
+                    {
+                        "id": "new2",
+                        "type": "Generic",
+                        "length": 256,
+                        "mechanisms": "AES_Encryption_CBC AES_Decryption_CBC",
+                    },
+                ]
+            }
+        )
+    )
+
+    results = bulk_add_keys(mock, tmp_path, filename)
+    assert [r["result"] for r in results] == ["skipped", "generated", "generated"]
+    assert mock.keys["new1"].mechanisms == ["EdDSA_Signature"]
+    assert mock.keys["new1"].tags == ["tenant"]
+    assert mock.keys["new2"].mechanisms == ["AES_Encryption_CBC", "AES_Decryption_CBC"]
+
+    results = bulk_add_keys(mock, tmp_path, filename)
+    assert [r["result"] for r in results] == ["skipped"] * 3
+
+    # missing tags of existing keys are added, for example after tagging failed
+    mock.keys["new1"].tags = []
+    results = bulk_add_keys(mock, tmp_path, filename)
+    assert [r["result"] for r in results] == ["skipped", "tagged", "skipped"]
+    assert mock.keys["new1"].tags == ["tenant"]
@@ -0,0 +1,64 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the rates and the Prometheus export of NetHSM metrics.  Does not
+require a device.
+"""
+
+from pynitrokey.nethsm.metrics import MetricsState
+
+
+def test_update() -> None:
+    state = MetricsState("nethsm.example")
+    sample = state.update({"requests": 10, "memory used": 100}, now=1.0)
+    assert sample.values == {"requests": 10.0, "memory used": 100.0}
+    assert sample.rates == {}
+
+    # only counters have a rate
+    sample = state.update({"requests": 30, "memory used": 200}, now=5.0)
+    assert sample.rates == {"requests": 5.0}
+
+    # a reset counter, e. g. after a reboot, has no rate
+    sample = state.update({"requests": 2, "memory used": 200}, now=6.0)
+    assert sample.rates == {}
+
+    # non-numeric values are ignored
+    sample = state.update({"requests": 4, "state": "Operational", "up": True}, now=7.0)
+    assert sample.values == {"requests": 4.0}
+    assert sample.rates == {"requests": 2.0}
+
+
+def test_update_same_time() -> None:
+    state = MetricsState("nethsm.example")
+    state.update({"requests": 10}, now=1.0)
+    assert state.update({"requests": 20}, now=1.0).rates == {}
+
+
+def test_to_prometheus() -> None:
+    state = MetricsState('nethsm "1"')
+    state.update({"requests": 10, "memory used": 100}, now=1.0)
+    state.update({"requests": 30, "memory used": 200}, now=5.0)
+    state.failed()
+
+    labels = '{host="nethsm \\"1\\""}'
+    assert state.to_prometheus().splitlines() == [
+        "# HELP nethsm_up Whether the last scrape succeeded",
+        "# TYPE nethsm_up gauge",
+        f"nethsm_up{labels} 0",
+        "# HELP nethsm_scrapes_total Number of scrapes",
+        "# TYPE nethsm_scrapes_total counter",
+        f"nethsm_scrapes_total{labels} 3",
+        "# HELP nethsm_scrape_errors_total Number of failed scrapes",
+        "# TYPE nethsm_scrape_errors_total counter",
+        f"nethsm_scrape_errors_total{labels} 1",
+        "# HELP nethsm_memory_used NetHSM metric memory used",
+        "# TYPE nethsm_memory_used gauge",
+        f"nethsm_memory_used{labels} 200.0",
+        "# HELP nethsm_requests NetHSM metric requests",
+        "# TYPE nethsm_requests counter",
+        f"nethsm_requests{labels} 30.0",
+        "# HELP nethsm_requests_rate Rate of change of the NetHSM metric requests per second",
+        "# TYPE nethsm_requests_rate gauge",
+        f"nethsm_requests_rate{labels} 5.0",
+    ]
@@ -0,0 +1,102 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the PIV agent, using a simulated card behind a real agent socket.
+Does not require a device, but requires pyscard.
+"""
+
+import json
+import threading
+from typing import Iterator
+
+import pytest
+
+pytest.importorskip("smartcard")
+
+from pynitrokey.nk3 import piv_agent  # noqa: E402
+from pynitrokey.nk3.piv_app import PivApp, PivSession, StatusError  # noqa: E402
+from pynitrokey.test_piv_transport import SimulatedCard  # noqa: E402
+
+
+class SimulatedAgent(piv_agent.Agent):
+    def __init__(self, card: SimulatedCard) -> None:
+        super().__init__()
+        self.card = card
+
+    def _connect(self) -> PivApp:
+        return PivApp(
+            lambda message: None,
+            connection=self.card,
+            session=PivSession(selected=True),
+        )
+
+
+@pytest.fixture
+def card(
+    tmp_path_factory: pytest.TempPathFactory, monkeypatch: pytest.MonkeyPatch
+) -> Iterator[SimulatedCard]:
+    # the path of the socket must be short
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path_factory.mktemp("run")))
+    card = SimulatedCard(extended=True)
+    agent = SimulatedAgent(card)
+    agent.bind()
+    thread = threading.Thread(target=agent.serve, daemon=True)
+    thread.start()
+    yield card
+    assert piv_agent.stop(agent.socket_path)
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def connect() -> PivApp:
+    app = piv_agent.connect(lambda message: None)
+    assert app is not None
+    return app
+
+
+def login(pin: str) -> bool:
+    """Log in with a new client and return whether the PIN has been sent to
+    the card."""
+    with connect() as app:
+        app.login(pin)
+        return app.round_trips > 0
+
+
+def test_status(card: SimulatedCard) -> None:
+    info = piv_agent.find()
+    assert info is not None
+    assert info.socket_path == piv_agent.socket_path()
+
+    with connect() as app:
+        assert app.reader() == card.getReader()
+
+
+def test_session(card: SimulatedCard) -> None:
+    assert login("123456")
+    assert card.verified
+    # the next client skips the PIN verification
+    assert not login("123456")
+
+    # the session does not contain the salt or the digest of the PIN
+    connection = piv_agent.AgentConnection(piv_agent.socket_path())
+    try:
+        data = json.loads(connection.request(piv_agent.CMD_GET_SESSION))
+    finally:
+        connection.disconnect()
+    assert "salt" not in data
+    assert data["pin"] is True
+
+    # a wrong PIN clears the stored PIN
+    with pytest.raises(StatusError):
+        login("654321")
+    assert login("123456")
+    assert not login("123456")
+
+
+def test_sign(card: SimulatedCard) -> None:
+    login("123456")
+    with connect() as app:
+        app.login("123456")
+        assert app.round_trips == 0
+        assert app.raw_sign(b"abc", 0x9C, 0x11) == b"cba"
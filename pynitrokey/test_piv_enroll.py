@@ -0,0 +1,237 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the enrollment of PIV key slots from a manifest, using a simulated
+card that generates NIST P-256 keys.  Does not require a device, but
+requires pyscard.
+"""
+
+import datetime
+import io
+import json
+import os
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+import click
+import pytest
+from click.testing import CliRunner
+from cryptography import x509
+from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
+
+pytest.importorskip("smartcard")
+
+from pynitrokey.cli import nitropy  # noqa: E402
+from pynitrokey.cli.nk3 import piv  # noqa: E402
+from pynitrokey.nk3.piv_app import PivApp, PivSession  # noqa: E402
+from pynitrokey.test_piv_transport import SimulatedCard, decode_apdu  # noqa: E402
+from pynitrokey.tlv import Tlv, TlvTree  # noqa: E402
+
+ADMIN_KEY = bytes.fromhex("010203040506070801020304050607080102030405060708")
+PIN = "123456"
+
+
+class EnrollmentCard(SimulatedCard):
+    """A simulated card that authenticates the 3DES admin key, generates
+    NIST P-256 keys and signs with them.  The key generation fails for the
+    key references in `failing`."""
+
+    def __init__(self, failing: Tuple[int, ...] = ()) -> None:
+        super().__init__(extended=True)
+        self.failing = failing
+        self.keys: dict[int, ec.EllipticCurvePrivateKey] = {}
+        self._challenge = b""
+
+    def _cipher(self) -> Cipher[modes.ECB]:
+        return Cipher(TripleDES(ADMIN_KEY), modes.ECB())
+
+    def _authenticate(self, data: bytes, le: int) -> Tuple[list[int], int, int]:
+        auth = TlvTree(data)[0x7C]
+        witness = auth.get(0x81)
+        if witness is None:
+            self._challenge = os.urandom(8)
+            return self._respond(Tlv.build([(0x7C, [(0x80, self._challenge)])]), le)
+        decryptor = self._cipher().decryptor()
+        expected = decryptor.update(self._challenge) + decryptor.finalize()
+        if bytes(auth[0x80]) != expected:
+            return [], 0x69, 0x82
+        encryptor = self._cipher().encryptor()
+        response = encryptor.update(bytes(witness)) + encryptor.finalize()
+        return self._respond(Tlv.build([(0x7C, [(0x82, response)])]), le)
+
+    def _generate(
+        self, key_ref: int, data: bytes, le: int
+    ) -> Tuple[list[int], int, int]:
+        if key_ref in self.failing or bytes(TlvTree(data)[0xAC][0x80]) != b"\x11":
+            return [], 0x6A, 0x80
+        key = ec.generate_private_key(ec.SECP256R1())
+        self.keys[key_ref] = key
+        point = key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        )
+        return self._respond(Tlv.build([(0x7F49, [(0x86, point)])]), le)
+
+    def _sign(self, key_ref: int, data: bytes, le: int) -> Tuple[list[int], int, int]:
+        if not self.verified:
+            return [], 0x69, 0x82
+        digest = bytes(TlvTree(data)[0x7C][0x81])
+        signature = self.keys[key_ref].sign(
+            digest, ec.ECDSA(Prehashed(hashes.SHA256()))
+        )
+        return self._respond(Tlv.build([(0x7C, [(0x82, signature)])]), le)
+
+    def transmit(self, apdu: list[int]) -> Tuple[list[int], int, int]:
+        _, ins, data, le, _ = decode_apdu(bytes(apdu))
+        le = le or 0x10000
+        p1, p2 = apdu[2], apdu[3]
+        if ins == 0x87 and p2 == 0x9B:
+            return self._authenticate(data, le)
+        if ins == 0x87 and p1 == 0x11:
+            return self._sign(p2, data, le)
+        if ins == 0x47:
+            return self._generate(p2, data, le)
+        return super().transmit(apdu)
+
+
+def open_app(card: SimulatedCard) -> PivApp:
+    return PivApp(
+        lambda message: None, connection=card, session=PivSession(selected=True)
+    )
+
+
+def manifest(*slots: dict[str, Any]) -> io.StringIO:
+    return io.StringIO(json.dumps({"slots": list(slots)}))
+
+
+def certificate(card: SimulatedCard, key: str) -> x509.Certificate:
+    container = bytes.fromhex(piv.KEY_TO_CERT_OBJ_ID_MAP[key])
+    data = open_app(card).cert(container)
+    assert data is not None
+    return x509.load_der_x509_certificate(data)
+
+
+def enroll(
+    card: SimulatedCard,
+    output_dir: Path,
+    signer: Optional[piv.CertificateSigner] = None,
+    admin_key: bytes = ADMIN_KEY,
+) -> list[Tuple[str, Optional[str]]]:
+    slots = piv.load_manifest(
+        manifest({"key": "9a", "subject_name": ["Alice"]}, {"key": "9C"})
+    )
+    return piv.enroll_device(
+        open_app(card), admin_key, PIN, slots, str(output_dir), signer
+    )
+
+
+@pytest.mark.parametrize(
+    "slot,error",
+    [
+        ({"key": 0x9A}, "key must be a string"),
+        ({"key": "9A", "algo": None}, "algo must be a string"),
+        ({"key": "9A", "subject_name": "Alice"}, "subject_name must be a list"),
+        ({"key": "9A", "domain_component": [1]}, "domain_component must be a list"),
+        ({"key": "9A", "subject_alt_name_upn": 1}, "upn must be a string"),
+        ({"key": "9B"}, "Invalid key slot in manifest: 9B"),
+        ({"key": "9A", "algo": "ed25519"}, "Invalid algorithm in manifest"),
+        ({"key": "9A", "unknown": 1}, "Invalid manifest"),
+    ],
+)
+def test_load_manifest_invalid(slot: dict[str, Any], error: str) -> None:
+    with pytest.raises(click.ClickException, match=error):
+        piv.load_manifest(manifest(slot))
+
+
+def test_enroll_device(tmp_path: Path) -> None:
+    card = EnrollmentCard()
+    assert enroll(card, tmp_path) == [("9A", None), ("9C", None)]
+    assert sorted(os.listdir(tmp_path)) == ["305419896-9A.csr", "305419896-9C.csr"]
+
+    csr = x509.load_der_x509_csr((tmp_path / "305419896-9A.csr").read_bytes())
+    assert csr.is_signature_valid
+    assert csr.subject.rfc4514_string() == "CN=Alice"
+    # the certificate is self-signed with the generated key
+    cert = certificate(card, "9A")
+    assert cert.issuer == cert.subject == csr.subject
+    assert cert.public_key() == card.keys[0x9A].public_key()
+    cert.verify_directly_issued_by(cert)
+
+
+def test_enroll_device_failing_slot(tmp_path: Path) -> None:
+    card = EnrollmentCard(failing=(0x9A,))
+    (key, error), result = enroll(card, tmp_path)
+    assert key == "9A" and error is not None and "0x6a80" in error.lower()
+    # the other slot is still enrolled
+    assert result == ("9C", None)
+    assert os.listdir(tmp_path) == ["305419896-9C.csr"]
+
+
+def test_enroll_device_critical_error(tmp_path: Path) -> None:
+    # local_critical raises SystemExit for an unsupported key length
+    results = enroll(EnrollmentCard(), tmp_path, admin_key=bytes(5))
+    assert results == [
+        ("9A", "authentication failed: critical error, see above"),
+        ("9C", "authentication failed: critical error, see above"),
+    ]
+    assert os.listdir(tmp_path) == []
+
+
+def test_enroll_device_ca(tmp_path: Path) -> None:
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, "Test CA")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ca_cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(ca_key.public_key())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .serial_number(x509.random_serial_number())
+        .sign(ca_key, hashes.SHA256())
+    )
+    signer = piv.ca_signer(
+        io.BytesIO(ca_cert.public_bytes(serialization.Encoding.PEM)),
+        io.BytesIO(
+            ca_key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        ),
+        days=30,
+    )
+
+    card = EnrollmentCard()
+    assert enroll(card, tmp_path, signer) == [("9A", None), ("9C", None)]
+    cert = certificate(card, "9A")
+    assert cert.issuer == name
+    assert cert.subject.rfc4514_string() == "CN=Alice"
+    assert cert.public_key() == card.keys[0x9A].public_key()
+    cert.verify_directly_issued_by(ca_cert)
+    assert cert.not_valid_after_utc - cert.not_valid_before_utc == (
+        datetime.timedelta(days=30)
+    )
+
+
+def test_enroll_cli(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    card = EnrollmentCard(failing=(0x9C,))
+    monkeypatch.setattr(piv, "open_device", lambda: open_app(card))
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps({"slots": [{"key": "9A"}, {"key": "9C"}]}))
+
+    result = CliRunner().invoke(
+        nitropy,
+        ["nk3", "piv", "--experimental", "--no-agent", "enroll", str(path)]
+        + ["--pin", PIN, "--output-dir", str(tmp_path)],
+    )
+    assert result.exit_code != 0
+    assert "enrolled key 9A" in result.output
+    assert "Simulated Reader: failed to enroll key 9C" in result.output
+    assert "Failed to enroll 1 of 2 slots" in result.output
+    assert (tmp_path / "305419896-9A.csr").exists()
@@ -0,0 +1,146 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the inventory of the PIV key slots, using a simulated card.
+Does not require a device, but requires pyscard.
+"""
+
+import datetime
+import json
+from pathlib import Path
+from typing import Any, Tuple
+
+import pytest
+from click.testing import CliRunner
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+pytest.importorskip("smartcard")
+
+from pynitrokey.cli import nitropy  # noqa: E402
+from pynitrokey.cli.nk3 import piv  # noqa: E402
+from pynitrokey.nk3.piv_app import CertificateError, PivApp, PivSession  # noqa: E402
+from pynitrokey.test_piv_transport import SimulatedCard  # noqa: E402
+from pynitrokey.tlv import Tlv  # noqa: E402
+
+
+class NoSerialCard(SimulatedCard):
+    """A simulated card that does not support the serial number command."""
+
+    def transmit(self, apdu: list[int]) -> Tuple[list[int], int, int]:
+        if apdu[1] == 0x01:
+            return [], 0x6D, 0x00
+        return super().transmit(apdu)
+
+
+def open_app(card: SimulatedCard) -> PivApp:
+    return PivApp(
+        lambda message: None, connection=card, session=PivSession(selected=True)
+    )
+
+
+def container(key: str) -> bytes:
+    return bytes.fromhex(piv.KEY_TO_CERT_OBJ_ID_MAP[key])
+
+
+def build_certificate() -> x509.Certificate:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, "Alice")])
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .not_valid_before(datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+        .not_valid_after(datetime.datetime(2034, 1, 1, tzinfo=datetime.timezone.utc))
+        .serial_number(0x1234)
+        .sign(key, hashes.SHA256())
+    )
+
+
+CERTIFICATE = build_certificate()
+
+
+def slots(inventory: dict[str, Any]) -> dict[str, dict[str, Any]]:
+    return {slot["slot"]: slot for slot in inventory["slots"]}
+
+
+@pytest.fixture
+def card() -> SimulatedCard:
+    card = SimulatedCard(extended=True)
+    app = open_app(card)
+    app.write_cert(
+        container("9A"), CERTIFICATE.public_bytes(serialization.Encoding.DER)
+    )
+    # a data object without a certificate and one with an invalid certificate
+    card.objects[container("9C")] = Tlv.build([(0x53, [(0x71, b"\x00")])])
+    card.objects[container("9D")] = Tlv.build([(0x53, [(0x70, b"invalid")])])
+    return card
+
+
+def test_read_cert(card: SimulatedCard) -> None:
+    app = open_app(card)
+    value = app.read_cert(container("9A"))
+    assert value is not None
+    assert x509.load_der_x509_certificate(value).serial_number == 0x1234
+    assert app.read_cert(container("9E")) is None
+    with pytest.raises(CertificateError, match="Bad tag"):
+        app.read_cert(container("9C"))
+
+
+def test_read_inventory(card: SimulatedCard) -> None:
+    inventory = piv.read_inventory(open_app(card))
+    assert inventory["reader"] == "Simulated Reader"
+    assert inventory["serial"] == card.serial
+
+    result = slots(inventory)
+    assert set(result) == set(piv.KEY_TO_CERT_OBJ_ID_MAP)
+    assert result["9A"]["certificate"] == {
+        "subject": "CN=Alice",
+        "issuer": "CN=Alice",
+        "serial_number": "1234",
+        "not_before": "2024-01-01T00:00:00+00:00",
+        "not_after": "2034-01-01T00:00:00+00:00",
+        "key_algorithm": "EC-secp256r1",
+        "signature_hash": "sha256",
+        "fingerprint_sha256": CERTIFICATE.fingerprint(hashes.SHA256()).hex(),
+    }
+    # empty slots have no certificate and malformed objects are reported
+    assert result["9E"] == {
+        "slot": "9E",
+        "container": piv.KEY_TO_CERT_OBJ_ID_MAP["9E"],
+        "certificate": None,
+    }
+    assert result["9C"]["error"] == "Bad tag"
+    assert "error" in result["9D"] and "certificate" not in result["9D"]
+
+
+def test_read_inventory_without_serial() -> None:
+    inventory = piv.read_inventory(open_app(NoSerialCard(extended=True)))
+    assert inventory["serial"] is None
+    assert all(slot["certificate"] is None for slot in inventory["slots"])
+
+
+def test_inventory_cli(
+    card: SimulatedCard, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(piv, "open_device", lambda: open_app(card))
+    path = tmp_path / "inventory.json"
+    result = CliRunner().invoke(
+        nitropy,
+        [
+            "nk3",
+            "piv",
+            "--experimental",
+            "--no-agent",
+            "inventory",
+            "--path",
+            str(path),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    (inventory,) = json.loads(path.read_text())
+    assert slots(inventory)["9A"]["certificate"]["subject"] == "CN=Alice"
+    assert slots(inventory)["9C"]["error"] == "Bad tag"
@@ -0,0 +1,170 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests for the APDU trace of the PIV application.
+Does not require a device.
+"""
+
+import io
+import logging
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from pynitrokey.confconsts import ENV_DEBUG_VAR, Verbosity
+from pynitrokey.nk3.piv_trace import (
+    DEVICE,
+    MAGIC,
+    ApduTrace,
+    Redaction,
+    _Dump,
+    read_trace,
+    redact_command,
+    redact_response,
+)
+
+PIN = b"123456\xff\xff"
+VERIFY = bytes.fromhex("0020008008") + PIN
+VERIFY_EXTENDED = bytes.fromhex("00200080000008") + PIN + b"\x00\x00"
+SET_MANAGEMENT_KEY = bytes.fromhex("00ffffFE1b039b18") + bytes(range(24))
+GET_DATA = bytes.fromhex("00cb3fff055c035fc105")
+
+
+def test_redact_secrets() -> None:
+    assert redact_command(VERIFY, Redaction.SECRETS) == VERIFY[:5] + b"*" * 8
+    assert redact_command(VERIFY_EXTENDED, Redaction.SECRETS) == (
+        VERIFY_EXTENDED[:7] + b"*" * 8 + b"\x00\x00"
+    )
+    # the algorithm, key reference and length are kept
+    assert redact_command(SET_MANAGEMENT_KEY, Redaction.SECRETS) == (
+        SET_MANAGEMENT_KEY[:8] + b"*" * 24
+    )
+    assert redact_command(GET_DATA, Redaction.SECRETS) == GET_DATA
+    assert redact_command(VERIFY, Redaction.NONE) == VERIFY
+
+
+def test_redact_data() -> None:
+    assert redact_command(GET_DATA, Redaction.DATA) == GET_DATA[:5] + b"*" * 5
+    assert redact_command(b"\x00\xc0\x00\x00\x00", Redaction.DATA) == (
+        b"\x00\xc0\x00\x00\x00"
+    )
+    assert redact_response(b"abc", Redaction.DATA) == b"***"
+    assert redact_response(b"abc", Redaction.SECRETS) == b"abc"
+
+
+def test_trace_file() -> None:
+    file = io.BytesIO()
+    trace = ApduTrace(logging.getLogger("test_piv_trace.disabled"), file=file)
+    trace.command(VERIFY, "VERIFY")
+    trace.response(b"", 0x90, 0x00)
+    trace.command(GET_DATA)
+    trace.response(bytes(1000), 0x90, 0x00)
+
+    assert file.getvalue().startswith(MAGIC)
+    file.seek(0)
+    records = list(read_trace(file))
+    assert [r.is_command for r in records] == [True, False, True, False]
+    assert {r.device for r in records} == {0}
+    assert records[0].apdu == VERIFY[:5] + b"*" * 8
+    assert records[3].apdu == bytes(1000) + b"\x90\x00"
+    assert 0 <= records[0].time <= records[3].time
+
+    with pytest.raises(ValueError):
+        list(read_trace(io.BytesIO(file.getvalue()[:-1])))
+    with pytest.raises(ValueError):
+        list(read_trace(io.BytesIO(b"not a trace")))
+
+
+def test_trace_devices(caplog: pytest.LogCaptureFixture) -> None:
+    file = io.BytesIO()
+    trace = ApduTrace(logging.getLogger("test_piv_trace.devices"), file=file)
+    devices = [trace.for_device(f"Reader {i}") for i in range(2)]
+
+    def run(device: ApduTrace) -> None:
+        for _ in range(100):
+            device.command(GET_DATA)
+            device.response(bytes(100), 0x90, 0x00)
+
+    with caplog.at_level(logging.DEBUG, logger="test_piv_trace.devices"):
+        threads = [threading.Thread(target=run, args=(d,)) for d in devices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert caplog.messages[0].startswith(("Reader 0: Sending", "Reader 1: Sending"))
+
+    file.seek(0)
+    records = list(read_trace(file))
+    assert [(r.direction, r.device, r.apdu) for r in records[:2]] == [
+        (DEVICE, 1, b"Reader 0"),
+        (DEVICE, 2, b"Reader 1"),
+    ]
+    # the records of every device are complete and in order
+    for device in [1, 2]:
+        apdus = [r.apdu for r in records[2:] if r.device == device]
+        assert apdus == [GET_DATA, bytes(100) + b"\x90\x00"] * 100
+
+
+def test_trace_is_lazy(monkeypatch: pytest.MonkeyPatch) -> None:
+    def fail(self: _Dump) -> str:
+        raise AssertionError("APDU formatted although logging is disabled")
+
+    logger = logging.getLogger("test_piv_trace.lazy")
+    logger.setLevel(logging.INFO)
+    trace = ApduTrace(logger)
+    assert not trace.enabled
+
+    monkeypatch.setattr(_Dump, "__str__", fail)
+    trace.command(GET_DATA)
+    trace.response(bytes(1000), 0x90, 0x00)
+
+
+def test_trace_log(caplog: pytest.LogCaptureFixture) -> None:
+    trace = ApduTrace(logging.getLogger("test_piv_trace.log"), max_dump=4)
+    with caplog.at_level(logging.DEBUG, logger="test_piv_trace.log"):
+        trace.command(VERIFY, "VERIFY")
+        trace.response(bytes(100), 0x61, 0x00)
+    assert caplog.messages == [
+        "Sending VERIFY 00200080... (13 bytes)",
+        "Received [6100] 00000000... (100 bytes)",
+    ]
+
+
+def apdu_log_enabled(*args: str, debug: bool = False) -> bool:
+    """Run nitropy with the logging setup of the CLI and return whether the
+    APDUs are logged afterwards."""
+    script = f"""
+from pynitrokey.cli import nitropy
+from pynitrokey.nk3.piv_trace import ApduTrace
+nitropy.main({list(args)!r}, standalone_mode=False)
+print(ApduTrace().enabled)
+"""
+    env = {k: v for k, v in os.environ.items() if k != ENV_DEBUG_VAR}
+    env["ALLOW_ROOT"] = "1"
+    if debug:
+        env[ENV_DEBUG_VAR] = str(Verbosity.debug.value)
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    return result.stdout.splitlines()[-1] == "True"
+
+
+def test_cli_apdu_log(tmp_path: Path) -> None:
+    pytest.importorskip("smartcard")
+    path = tmp_path / "trace"
+    path.write_bytes(MAGIC)
+    args = ["nk3", "piv", "--experimental", "show-trace", str(path)]
+    # the CLI logs everything else at the debug level, but not the APDUs
+    assert not apdu_log_enabled(*args)
+    assert apdu_log_enabled(*args, debug=True)
+    args.insert(3, "--log-apdus")
+    assert apdu_log_enabled(*args)
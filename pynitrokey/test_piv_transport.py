@@ -0,0 +1,257 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests and benchmark for the APDU transport of the PIV application, using a
+simulated card.  Does not require a device, but requires pyscard.
+
+Run `python -m pynitrokey.test_piv_transport` to compare the round trips and
+the latency of certificate reads and writes with short and extended length
+APDUs.  The simulated card adds a fixed latency to every round trip.
+"""
+
+import time
+from typing import Iterator, Optional, Tuple
+
+import pytest
+
+pytest.importorskip("smartcard")
+
+from pynitrokey.nk3.piv_app import (  # noqa: E402
+    ALGO_NISTP256,
+    CLA_CHAINING,
+    PivApp,
+    PivSession,
+    encode_apdu,
+)
+from pynitrokey.tlv import Tlv, TlvTree  # noqa: E402
+
+CONTAINER = bytes.fromhex("5fc105")
+PIN = b"123456\xff\xff"
+# the latency of a round trip to a USB CCID device
+LATENCY = 0.002
+
+
+def decode_apdu(apdu: bytes) -> Tuple[int, int, bytes, Optional[int], bool]:
+    """Return the class, the instruction, the data, Le and whether the APDU
+    uses extended lengths."""
+    cls, ins, body = apdu[0], apdu[1], apdu[4:]
+    if not body:
+        return cls, ins, b"", None, False
+    if len(body) == 1:
+        return cls, ins, b"", body[0] or 0x100, False
+    if body[0] == 0:
+        if len(body) == 3:
+            return cls, ins, b"", int.from_bytes(body[1:], "big") or 0x10000, True
+        lc = int.from_bytes(body[1:3], "big")
+        rest = body[3 + lc :]
+        le = (int.from_bytes(rest, "big") or 0x10000) if rest else None
+        return cls, ins, body[3 : 3 + lc], le, True
+    lc = body[0]
+    rest = body[1 + lc :]
+    return cls, ins, body[1 : 1 + lc], (rest[0] or 0x100) if rest else None, False
+
+
+class SimulatedCard:
+    """A PIV card that stores data objects, has a serial number and supports
+    response chaining, and optionally extended length APDUs up to
+    `extended_max` bytes and command chaining.  Signatures require the PIN,
+    and with `pin_always`, the PIN must be verified again for every
+    signature."""
+
+    def __init__(
+        self,
+        extended: bool,
+        chaining: bool = True,
+        extended_max: int = 0xFFFF,
+        latency: float = 0.0,
+        pin_always: bool = False,
+    ) -> None:
+        self.extended = extended
+        self.chaining = chaining
+        self.extended_max = extended_max
+        self.latency = latency
+        self.pin_always = pin_always
+        self.verified = False
+        self.serial = 0x12345678
+        self.objects: dict[bytes, bytes] = {}
+        self.transmits = 0
+        self._chained = b""
+        self._pending = b""
+
+    def getReader(self) -> str:
+        return "Simulated Reader"
+
+    def disconnect(self) -> None:
+        pass
+
+    def _respond(self, data: bytes, le: int) -> Tuple[list[int], int, int]:
+        chunk, self._pending = data[:le], data[le:]
+        if self._pending:
+            return list(chunk), 0x61, min(len(self._pending), 0x100) & 0xFF
+        return list(chunk), 0x90, 0x00
+
+    def transmit(self, apdu: list[int]) -> Tuple[list[int], int, int]:
+        self.transmits += 1
+        time.sleep(self.latency)
+        cls, ins, data, le, extended = decode_apdu(bytes(apdu))
+        if extended and (not self.extended or len(data) > self.extended_max):
+            return [], 0x67, 0x00
+        if cls & CLA_CHAINING:
+            if not self.chaining:
+                return [], 0x68, 0x84
+            self._chained += data
+            return [], 0x90, 0x00
+        data, self._chained = self._chained + data, b""
+        le = le or (0x10000 if extended else 0x100)
+
+        if ins == 0xA4:
+            return [], 0x90, 0x00
+        if ins == 0x01:
+            return self._respond(self.serial.to_bytes(4, "big"), le)
+        if ins == 0x20:
+            self.verified = data == PIN
+            return [], 0x90 if self.verified else 0x63, 0x00
+        if ins == 0x87:
+            if not self.verified:
+                return [], 0x69, 0x82
+            self.verified = not self.pin_always
+            payload = bytes(TlvTree(data)[0x7C][0x81])
+            signature = Tlv.build([(0x7C, [(0x82, payload[::-1])])])
+            return self._respond(signature, le)
+        if ins == 0xC0:
+            return self._respond(self._pending, le)
+        if ins == 0xCB:
+            container = bytes(TlvTree(data)[0x5C])
+            if container not in self.objects:
+                return [], 0x6A, 0x82
+            return self._respond(self.objects[container], le)
+        if ins == 0xDB:
+            tree = TlvTree(data)
+            self.objects[bytes(tree[0x5C])] = Tlv.build([(0x53, tree[0x53].value)])
+            return [], 0x90, 0x00
+        return [], 0x6D, 0x00
+
+
+def open_app(card: SimulatedCard) -> PivApp:
+    """Connect to the card and negotiate the APDU lengths."""
+    app = PivApp(lambda message: None, connection=card, session=PivSession())
+    app.extended_length()
+    return app
+
+
+def write_read(app: PivApp, cert: bytes) -> Tuple[int, int]:
+    """Write and read a certificate and return the round trips for both."""
+    start = app.round_trips
+    app.write_cert(CONTAINER, cert)
+    write = app.round_trips - start
+    assert app.cert(CONTAINER) == cert
+    return write, app.round_trips - start - write
+
+
+def test_encode_apdu() -> None:
+    assert encode_apdu(0xCB, 0x3F, 0xFF) == bytes.fromhex("00cb3fff")
+    assert encode_apdu(0xC0, 0, 0, le=0) == bytes.fromhex("00c0000000")
+    assert encode_apdu(0xCB, 0x3F, 0xFF, b"\x01", le=0x20) == bytes.fromhex(
+        "00cb3fff010120"
+    )
+    assert encode_apdu(0xCB, 0, 0, le=0, extended=True) == bytes.fromhex(
+        "00cb0000000000"
+    )
+    assert encode_apdu(0xDB, 0, 0, bytes(0x100), le=0, extended=True) == (
+        bytes.fromhex("00db0000000100") + bytes(0x100) + b"\x00\x00"
+    )
+    with pytest.raises(ValueError):
+        encode_apdu(0xDB, 0, 0, bytes(0x100))
+
+
+def test_short_apdus() -> None:
+    card = SimulatedCard(extended=False)
+    app = open_app(card)
+    # 2 KiB need 9 chained commands and 9 responses
+    assert write_read(app, bytes(range(256)) * 8) == (9, 9)
+    assert app.session.extended is False
+
+
+def test_extended_apdus() -> None:
+    card = SimulatedCard(extended=True)
+    app = open_app(card)
+    assert write_read(app, bytes(range(256)) * 8) == (1, 1)
+    assert app.session.extended is True
+    assert card.transmits == 4  # select, probe, write, read
+
+
+def test_extended_apdu_fallback() -> None:
+    # the card accepts extended lengths, but not for the certificate
+    card = SimulatedCard(extended=True, extended_max=1024)
+    app = open_app(card)
+    assert write_read(app, bytes(2048)) == (10, 9)
+    assert app.session.extended is False
+
+    # without command chaining, the data is sent with an extended Lc as before
+    card = SimulatedCard(extended=True, chaining=False)
+    app = PivApp(lambda message: None, connection=card)
+    app.session.extended = False
+    assert write_read(app, bytes(2048)) == (2 + 1, 9)  # including the select
+
+
+@pytest.mark.parametrize("pin_always", [False, True])
+def test_sign_digests(pin_always: bool) -> None:
+    card = SimulatedCard(extended=True, pin_always=pin_always)
+    app = open_app(card)
+    digests = [bytes([i]) * 32 for i in range(3)]
+
+    start = app.round_trips
+    signatures = app.sign_digests(iter(digests), 0x9C, ALGO_NISTP256, "123456")
+    results = list(signatures)
+    assert [signature for signature, _ in results] == [d[::-1] for d in digests]
+    assert all(latency > 0 for _, latency in results)
+    # the PIN is verified once, or again after every rejected signature
+    assert app.round_trips - start == (1 + 3 + 2 * 2 if pin_always else 1 + 3)
+
+    with pytest.raises(ValueError):
+        list(app.sign_digests([bytes(20)], 0x9C, ALGO_NISTP256))
+
+
+def test_sign_digests_latency() -> None:
+    card = SimulatedCard(extended=True, latency=LATENCY)
+    app = open_app(card)
+
+    def digests() -> Iterator[bytes]:
+        for i in range(3):
+            # reading the input is not part of the latency
+            time.sleep(50 * LATENCY)
+            yield bytes([i]) * 32
+
+    for _, latency in app.sign_digests(digests(), 0x9C, ALGO_NISTP256, "123456"):
+        assert LATENCY <= latency < 50 * LATENCY
+
+
+def main() -> None:
+    print(f"{'size':>8}  {'APDUs':>8}  {'round trips':>11}  {'write':>8}  {'read':>8}")
+    for size in (512, 2048, 4096):
+        cert = bytes(range(256)) * (size // 256)
+        for extended in (False, True):
+            card = SimulatedCard(extended=extended, latency=LATENCY)
+            app = open_app(card)
+            app.round_trips = 0
+
+            start = time.perf_counter()
+            app.write_cert(CONTAINER, cert)
+            write_time = time.perf_counter() - start
+            write = app.round_trips
+
+            start = time.perf_counter()
+            assert app.cert(CONTAINER) == cert
+            read_time = time.perf_counter() - start
+            read = app.round_trips - write
+
+            print(
+                f"{size:>6} B  {'extended' if extended else 'short':>8}  "
+                f"{write:>5} + {read:<3}  {write_time * 1000:>5.1f} ms  "
+                f"{read_time * 1000:>5.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Startup benchmark for the nitropy entry point.
+Does not require a device.
+
+The time budget for `nitropy --help` can be configured with the
+NITROPY_STARTUP_BUDGET environment variable (in seconds).
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+from pynitrokey.testing import NITROPY, run_nitropy
+
+STARTUP_BUDGET_VAR = "NITROPY_STARTUP_BUDGET"
+DEFAULT_STARTUP_BUDGET = 1.0
+RUNS = 5
+
+
+def time_nitropy(*args: str) -> float:
+    start = time.perf_counter()
+    result = run_nitropy(*args)
+    assert result.returncode == 0, result.stderr
+    return time.perf_counter() - start
+
+
+def test_help_startup_budget() -> None:
+    budget = float(os.environ.get(STARTUP_BUDGET_VAR, DEFAULT_STARTUP_BUDGET))
+    # use the best run to reduce the influence of other processes
+    elapsed = min(time_nitropy("--help") for _ in range(RUNS))
+    assert (
+        elapsed <= budget
+    ), f"nitropy --help took {elapsed:.3f} s, budget is {budget:.3f} s"
+
+
+def test_help_does_not_import_subcommands() -> None:
+    script = f"""
+import sys
+sys.argv = ["nitropy", "--help"]
+try:
+    {NITROPY}
+except SystemExit:
+    pass
+heavy = [
+    "fido2", "nethsm", "usb", "pynitrokey.libnk", "pynitrokey.cli.nk3", "pynitrokey.nk3"
+]
+print("imported:", *[module for module in heavy if module in sys.modules])
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    )
+    imported = result.stdout.splitlines()[-1].split()[1:]
+    assert imported == [], f"nitropy --help imported {', '.join(imported)}"
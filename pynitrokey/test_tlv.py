@@ -0,0 +1,234 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Tests and micro-benchmark for the TLV module.
+Does not require a device.
+
+Run `python -m pynitrokey.test_tlv` to compare the parser and the builder
+with the previous implementations that sliced the input on every step and
+concatenated the output of nested builds.
+"""
+
+import time
+from typing import Callable, Sequence, Tuple
+
+import pytest
+
+from pynitrokey.tlv import (
+    Tlv,
+    TlvBuilder,
+    TlvDecoder,
+    TlvTree,
+    build_one,
+    iter_tlv,
+    parse_header,
+    take_do,
+)
+
+
+def slicing_parse(data: bytes) -> Sequence[Tuple[int, bytes]]:
+    """The previous implementation of Tlv.parse, for comparison."""
+    res = []
+    current = data
+    while len(current) != 0:
+        b1 = current[0]
+        if (b1 & 0x1F) == 0x1F:
+            tag, current = (b1 << 8) | current[1], current[2:]
+        else:
+            tag, current = b1, current[1:]
+        l1 = current[0]
+        if l1 <= 0x7F:
+            length, current = l1, current[1:]
+        elif l1 == 0x81:
+            length, current = current[1], current[2:]
+        else:
+            length, current = (current[1] << 8) | current[2], current[3:]
+        res.append((tag, current[:length]))
+        current = current[length:]
+    return res
+
+
+def concatenating_build(input: Sequence[Tuple[int, bytes]]) -> bytes:
+    """The previous implementation of Tlv.build, for comparison."""
+    out = bytearray()
+    for tag, data in input:
+        header = bytearray(tag.to_bytes((tag.bit_length() + 7) // 8, "big"))
+        length = len(data)
+        if length <= 0x7F:
+            header.append(length)
+        else:
+            size = (length.bit_length() + 7) // 8
+            header.append(0x80 + size)
+            header += length.to_bytes(size, "big")
+        out += header + data
+    return out
+
+
+def make_input(size: int) -> bytes:
+    """Many small objects with one- and two-byte tags, `size` bytes in total."""
+    return Tlv.build([(0x80, b"\x01"), (0x5F01, b"\x02\x03")] * (size // 9))
+
+
+def test_parse_build_roundtrip() -> None:
+    objects = [
+        (0x01, b""),
+        (0x5C, b"\x5f\xc1\x02"),
+        (0x7F49, bytes(range(0x80))),
+        (0x53, bytes(0x100)),
+        (0x70, bytes(0x1234)),
+    ]
+    data = Tlv.build(objects)
+    assert Tlv.parse(data) == objects
+    assert [(tag, bytes(value)) for tag, value in iter_tlv(data)] == objects
+
+
+def test_build_lengths() -> None:
+    assert build_one(0x53, bytes(0x7F))[:2] == b"\x53\x7f"
+    assert build_one(0x53, bytes(0x80))[:3] == b"\x53\x81\x80"
+    assert build_one(0x53, bytes(0x100))[:4] == b"\x53\x82\x01\x00"
+    assert build_one(0x5FC1, bytes(0x10000))[:6] == b"\x5f\xc1\x83\x01\x00\x00"
+    assert Tlv.parse(build_one(0x53, bytes(0x12345))) == [(0x53, bytes(0x12345))]
+    with pytest.raises(ValueError):
+        build_one(0x53, bytes(0x1000000))
+
+
+def test_build_nested() -> None:
+    cert = bytes(range(256)) * 2
+    expected = Tlv.build(
+        [(0x5C, b"\x5f\xc1\x05"), (0x53, Tlv.build([(0x70, cert), (0x71, b"\0")]))]
+    )
+    assert (
+        Tlv.build([(0x5C, b"\x5f\xc1\x05"), (0x53, [(0x70, cert), (0x71, b"\0")])])
+        == expected
+    )
+
+    builder = TlvBuilder().add(0x5C, b"\x5f\xc1\x05")
+    builder.nested(0x53).add(0x70, memoryview(cert)).add(0x71, b"\0")
+    assert builder.build() == expected
+
+
+def test_iter_tlv_returns_views() -> None:
+    data = bytearray(Tlv.build([(0x53, b"abc"), (0x54, b"de")]))
+    (_, first), (_, second) = iter_tlv(data)
+    assert first.obj is data
+    assert (first.tobytes(), second.tobytes()) == (b"abc", b"de")
+
+    _, start, end = parse_header(data, 5)
+    assert [(0x54, b"de")] == [(t, bytes(v)) for t, v in iter_tlv(data, 5)]
+    assert (start, end) == (7, 9)
+
+
+def test_take_do_compatibility() -> None:
+    data = Tlv.build([(0x5FC1, b"xyz"), (0x01, b"")])
+    assert take_do(data) == (0x5FC1, b"xyz", bytes(data[6:]))
+    # a truncated value is not an error, as before
+    assert Tlv.parse(b"\x53\x05ab") == [(0x53, b"ab")]
+
+
+@pytest.mark.parametrize(
+    "data", [b"\x53", b"\x5f", b"\x53\x81", b"\x53\x82\x01", b"\x53\x84"]
+)
+def test_parse_invalid(data: bytes) -> None:
+    with pytest.raises(ValueError):
+        Tlv.parse(data)
+
+
+def test_tree_lookup() -> None:
+    cert = bytes(range(0x90))
+    data = Tlv.build(
+        [
+            (0x53, Tlv.build([(0x70, cert), (0x71, b"\x00"), (0x71, b"\x01")])),
+            (0x5C, b"\x5f\xc1\x05"),
+        ]
+    )
+    tree = TlvTree(data)
+    assert len(tree) == 2
+    assert 0x53 in tree and 0x54 not in tree
+    assert bytes(tree[0x53][0x70]) == cert
+    assert [bytes(node) for node in tree[0x53].children.get_all(0x71)] == [
+        b"\x00",
+        b"\x01",
+    ]
+    assert tree[0x53].children is tree[0x53].children
+    assert tree.get(0x54) is None
+    with pytest.raises(KeyError):
+        tree[0x53][0x72]
+
+
+def test_tree_is_lazy() -> None:
+    # the invalid nested value is only parsed when it is accessed
+    tree = TlvTree(Tlv.build([(0x53, b"\x5f"), (0x54, b"")]))
+    assert bytes(tree[0x54]) == b""
+    with pytest.raises(ValueError):
+        tree[0x53][0x70]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 255, 100000])
+def test_decoder_chunks(chunk_size: int) -> None:
+    objects = [(0x53, bytes(range(256)) * 8), (0x5FC1, b""), (0x01, b"\x02")]
+    data = Tlv.build(objects)
+    ends = [2052, 2055, 2058]
+    decoder = TlvDecoder()
+    decoded = []
+    for i in range(0, len(data), chunk_size):
+        decoded += decoder.feed(data[i : i + chunk_size])
+        # objects are emitted as soon as they are complete
+        assert len(decoded) == sum(1 for end in ends if end <= i + chunk_size)
+    decoder.close()
+    assert decoded == objects
+    assert len(decoder.buffer) < chunk_size + 8
+
+
+def test_decoder_incomplete() -> None:
+    decoder = TlvDecoder()
+    assert decoder.feed(b"\x53\x82\x01") == []
+    assert decoder.feed(b"\x00" + bytes(0xFF)) == []
+    with pytest.raises(
+        ValueError, match="^Failed to parse TLV data: 259 bytes of incomplete data$"
+    ):
+        decoder.close()
+    with pytest.raises(ValueError):
+        TlvDecoder().feed(b"\x53\x84\x00\x00\x00\x00")
+
+
+def best_time(fn: Callable[[bytes], object], data: bytes, runs: int = 5) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(data)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_parse_is_linear() -> None:
+    small = best_time(Tlv.parse, make_input(8 * 1024))
+    large = best_time(Tlv.parse, make_input(64 * 1024))
+    # 8 times the input should take about 8 times as long, allow for noise
+    assert large < 24 * small, f"{small:.6f} s for 8 KiB, {large:.6f} s for 64 KiB"
+
+
+def main() -> None:
+    print(f"{'size':>8}  {'parse':>10}  {'slicing':>10}")
+    for kib in (4, 16, 64, 256):
+        data = make_input(kib * 1024)
+        parse = best_time(Tlv.parse, data)
+        slicing = best_time(slicing_parse, data, runs=1)
+        print(f"{kib:>5} KiB  {parse * 1000:>7.2f} ms  {slicing * 1000:>7.2f} ms")
+
+    print()
+    print(f"{'size':>8}  {'nested build':>12}  {'concatenating':>13}")
+    for kib in (4, 64, 1024):
+        value = bytes(kib * 1024)
+        new = best_time(lambda v: Tlv.build([(0x53, [(0x70, v), (0x71, b"")])]), value)
+        old = best_time(
+            lambda v: concatenating_build(
+                [(0x53, concatenating_build([(0x70, v), (0x71, b"")]))]
+            ),
+            value,
+        )
+        print(f"{kib:>5} KiB  {new * 1e6:>9.1f} us  {old * 1e6:>10.1f} us")
+
+
+if __name__ == "__main__":
+    main()
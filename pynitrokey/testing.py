@@ -0,0 +1,58 @@
+# Copyright Nitrokey GmbH
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+
+"""
+Helpers for the tests that run nitropy in a subprocess, for example against
+the local mock of the NetHSM API, see `pynitrokey.nethsm.mock`.
+"""
+
+import contextlib
+import os
+import subprocess
+import sys
+from typing import Iterator, Optional
+
+from pynitrokey.nethsm.mock import DEFAULT_PASSWORD, DEFAULT_USERNAME, MockNetHSM
+
+NITROPY = "from pynitrokey.cli import main; main()"
+
+
+def run_nitropy(
+    *args: str, input: Optional[str] = None, env: Optional[dict[str, str]] = None
+) -> subprocess.CompletedProcess[str]:
+    """Run nitropy with the given arguments and capture its output.  `env` is
+    added to the environment of the current process."""
+    return subprocess.run(
+        [sys.executable, "-c", NITROPY, *args],
+        input=input,
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, ALLOW_ROOT="1", **(env or {})),
+    )
+
+
+def nethsm_args(*hosts: str) -> list[str]:
+    """Return the arguments of `nitropy nethsm` for the given hosts of mock
+    NetHSMs with the default credentials.  A running agent is not used."""
+    if len(hosts) == 1:
+        host_args = ["--host", hosts[0]]
+    else:
+        host_args = ["--hosts", ",".join(hosts)]
+    return ["nethsm", *host_args, "--no-verify-tls", "--no-agent"] + [
+        "--username",
+        DEFAULT_USERNAME,
+        "--password",
+        DEFAULT_PASSWORD,
+    ]
+
+
+@contextlib.contextmanager
+def mock_nethsm() -> Iterator[MockNetHSM]:
+    """Run a mock NetHSM until the context is left."""
+    server = MockNetHSM()
+    server.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
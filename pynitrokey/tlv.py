@@ -1,84 +1,330 @@
 # Copyright Nitrokey GmbH
 # SPDX-License-Identifier: Apache-2.0 OR MIT
 
-from typing import Optional, Sequence, Tuple
+"""
+BER-TLV encoding as used by the smart card applications.
 
+The parser works with offsets into a memoryview of the input, so iterating
+over the objects with `iter_tlv` does not copy any data.  `Tlv.parse` and
+the take_* functions are kept for compatibility and copy each value once.
+`TlvTree` indexes the objects by tag and parses nested objects on demand.
+`TlvBuilder` joins nested objects into a single buffer of the final size.
+`TlvDecoder` decodes objects incrementally from chunks of data.
+Lengths are supported up to three bytes in the long form (0x83).
+"""
 
-def build_one(tag: int, data: bytes) -> bytes:
-    data_len = len(data)
-    out = bytearray()
-    out += tag.to_bytes((tag.bit_length() + 7) // 8, byteorder="big")
-    if data_len <= 0x7F:
-        out.append(data_len)
-    elif data_len <= 0xFF:
-        out.append(0x81)
-        out.append(data_len)
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+# The maximum length that can be encoded, using the three-byte long form
+MAX_LENGTH = 0xFFFFFF
+
+# A value is either primitive data or a sequence of nested objects
+TlvValue = Union[Buffer, Sequence[Tuple[int, "TlvValue"]]]
+
+
+def tag_size(tag: int) -> int:
+    return max(1, (tag.bit_length() + 7) // 8)
+
+
+def len_size(length: int) -> int:
+    if length <= 0x7F:
+        return 1
+    elif length <= 0xFF:
+        return 2
+    elif length <= 0xFFFF:
+        return 3
+    elif length <= MAX_LENGTH:
+        return 4
     else:
-        assert data_len <= 0xFFFF
-        out.append(0x82)
-        out += data_len.to_bytes((data_len.bit_length() + 7) // 8, byteorder="big")
+        raise ValueError(f"TLV value too long: {length} bytes")
+
 
-    return out + data
+def encode_header(tag: int, length: int) -> bytes:
+    if tag <= 0xFF and length <= 0x7F:
+        return bytes((tag, length))
+    size = len_size(length)
+    if size == 1:
+        encoded_len = bytes([length])
+    else:
+        encoded_len = bytes([0x80 + size - 1]) + length.to_bytes(size - 1, "big")
+    return tag.to_bytes(tag_size(tag), byteorder="big") + encoded_len
 
 
-def take_tag(data: bytes) -> Tuple[int, bytes]:
-    data_len = len(data)
-    if data_len == 0:
+class TlvBuilder:
+    """Build TLV data with nested constructed objects into one buffer.
+
+    The objects are added with `add`, either with primitive data or with a
+    sequence of nested objects, or with `nested`, which returns a builder
+    for the value of a constructed object.  `build` collects the headers and
+    values of all objects and joins them into a buffer of the final size, so
+    every value is copied exactly once."""
+
+    def __init__(self, objects: Sequence[Tuple[int, TlvValue]] = ()) -> None:
+        self.objects: List[Tuple[int, TlvValue]] = list(objects)
+
+    def add(self, tag: int, value: TlvValue) -> "TlvBuilder":
+        self.objects.append((tag, value))
+        return self
+
+    def nested(self, tag: int) -> "TlvBuilder":
+        builder = TlvBuilder()
+        self.objects.append((tag, builder.objects))
+        return builder
+
+    def build(self) -> bytes:
+        parts: List[Buffer] = []
+        _collect(self.objects, parts)
+        return b"".join(parts)
+
+
+def _collect(objects: Sequence[Tuple[int, TlvValue]], parts: List[Buffer]) -> int:
+    """Append the headers and values of the objects to `parts` and return
+    their total size.  The header of a constructed object is inserted when
+    the length of its value is known."""
+    total = 0
+    for tag, value in objects:
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            length = len(value)
+            header = encode_header(tag, length)
+            parts.append(header)
+            parts.append(value)
+        else:
+            index = len(parts)
+            parts.append(b"")
+            length = _collect(value, parts)
+            header = encode_header(tag, length)
+            parts[index] = header
+        total += len(header) + length
+    return total
+
+
+def build_one(tag: int, data: bytes) -> bytes:
+    return TlvBuilder([(tag, data)]).build()
+
+
+def parse_tag(data: Buffer, offset: int = 0) -> Tuple[int, int]:
+    """Parse the tag at `offset` and return it with the offset of the length."""
+    if offset >= len(data):
         raise ValueError("Failed to parse TLV data: empty data when parsing tag")
 
-    b1 = data[0]
+    b1 = data[offset]
     if (b1 & 0x1F) == 0x1F:
-        if data_len < 2:
+        if offset + 2 > len(data):
             raise ValueError("Failed to parse TLV data: partial tag")
-        b2 = data[1]
-        return (int.from_bytes([b1, b2], byteorder="big"), data[2:])
+        return (b1 << 8) | data[offset + 1], offset + 2
     else:
-        return (int.from_bytes([0, b1], byteorder="big"), data[1:])
+        return b1, offset + 1
 
 
-def take_len(data: bytes) -> Tuple[int, bytes]:
-    data_len = len(data)
-    if data_len == 0:
+def parse_len(data: Buffer, offset: int = 0) -> Tuple[int, int]:
+    """Parse the length at `offset` and return it with the offset of the
+    value."""
+    if offset >= len(data):
         raise ValueError("Failed to parse TLV data: empty data when parsing len")
 
-    l1 = data[0]
+    l1 = data[offset]
     if l1 <= 0x7F:
-        return (l1, data[1:])
+        return l1, offset + 1
     elif l1 == 0x81:
-        if data_len < 2:
+        if offset + 2 > len(data):
             raise ValueError("Failed to parse TLV data: partial len")
-        return (data[1], data[2:])
+        return data[offset + 1], offset + 2
     elif l1 == 0x82:
-        if data_len < 3:
+        if offset + 3 > len(data):
+            raise ValueError("Failed to parse TLV data: partial len")
+        return (data[offset + 1] << 8) | data[offset + 2], offset + 3
+    elif l1 == 0x83:
+        if offset + 4 > len(data):
             raise ValueError("Failed to parse TLV data: partial len")
-        l2 = data[1]
-        l3 = data[2]
-        return (int.from_bytes([l2, l3], byteorder="big"), data[3:])
+        length = (data[offset + 1] << 16) | (data[offset + 2] << 8) | data[offset + 3]
+        return length, offset + 4
     else:
         raise ValueError("Failed to parse TLV data: invalid len")
 
 
+def parse_header(data: Buffer, offset: int = 0) -> Tuple[int, int, int]:
+    """Parse the tag and length at `offset` and return the tag and the start
+    and end offsets of the value.  Like the previous slicing implementation,
+    a value that is truncated at the end of the data is not an error, and
+    the end offset is limited to the size of the data."""
+    tag, offset = parse_tag(data, offset)
+    length, offset = parse_len(data, offset)
+    return tag, offset, min(offset + length, len(data))
+
+
+def iter_tlv(
+    data: Buffer, offset: int = 0, end: Optional[int] = None
+) -> Iterator[Tuple[int, memoryview]]:
+    """Iterate over the TLV objects in `data[offset:end]`.  The values are
+    views into `data` and are only valid as long as `data` is not modified."""
+    view = memoryview(data)
+    if end is not None:
+        view = view[:end]
+    while offset < len(view):
+        tag, start, offset = parse_header(view, offset)
+        yield tag, view[start:offset]
+
+
+def take_tag(data: bytes) -> Tuple[int, bytes]:
+    tag, offset = parse_tag(data)
+    return tag, data[offset:]
+
+
+def take_len(data: bytes) -> Tuple[int, bytes]:
+    length, offset = parse_len(data)
+    return length, data[offset:]
+
+
 def take_do(data: bytes) -> Tuple[int, bytes, bytes]:
-    tag, rem = take_tag(data)
-    len, rem = take_len(rem)
+    tag, start, end = parse_header(data)
+    return tag, data[start:end], data[end:]
+
+
+class TlvNode:
+    """A TLV object.  Its value is only parsed as nested TLV objects when
+    `children` or a child tag is accessed, and at most once."""
+
+    def __init__(self, tag: int, value: memoryview) -> None:
+        self.tag = tag
+        self.value = value
+        self._children: Optional["TlvTree"] = None
+
+    @property
+    def children(self) -> "TlvTree":
+        if self._children is None:
+            self._children = TlvTree(self.value)
+        return self._children
+
+    def __getitem__(self, tag: int) -> "TlvNode":
+        return self.children[tag]
+
+    def get(self, tag: int) -> Optional["TlvNode"]:
+        return self.children.get(tag)
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.value)
+
+    def __repr__(self) -> str:
+        return f"TlvNode(0x{self.tag:X}, {self.value.hex()})"
+
+
+class TlvTree:
+    """A sequence of TLV objects that is parsed on first access and indexed
+    by tag, e. g. `TlvTree(data)[0x53][0x70]`.
+
+    Indexing returns the first object with a tag and raises a KeyError if
+    there is none.  All objects with a tag are returned by `get_all`.  The
+    values are views into `data`."""
+
+    def __init__(self, data: Buffer) -> None:
+        self.data = data
+        self._nodes: Optional[List[TlvNode]] = None
+        self._index: Dict[int, List[TlvNode]] = {}
+
+    def _parse(self) -> List[TlvNode]:
+        if self._nodes is None:
+            nodes = []
+            index: Dict[int, List[TlvNode]] = {}
+            for tag, value in iter_tlv(self.data):
+                node = TlvNode(tag, value)
+                nodes.append(node)
+                index.setdefault(tag, []).append(node)
+            self._nodes, self._index = nodes, index
+        return self._nodes
+
+    @property
+    def nodes(self) -> List[TlvNode]:
+        return self._parse()
+
+    def __getitem__(self, tag: int) -> TlvNode:
+        node = self.get(tag)
+        if node is None:
+            raise KeyError(f"TLV tag 0x{tag:X} not found")
+        return node
+
+    def get(self, tag: int) -> Optional[TlvNode]:
+        nodes = self.get_all(tag)
+        return nodes[0] if nodes else None
+
+    def get_all(self, tag: int) -> List[TlvNode]:
+        self._parse()
+        return self._index.get(tag, [])
+
+    def __contains__(self, tag: int) -> bool:
+        return bool(self.get_all(tag))
+
+    def __iter__(self) -> Iterator[TlvNode]:
+        return iter(self.nodes)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+class TlvDecoder:
+    """Decode a stream of TLV objects that arrives in chunks, e. g. the
+    responses to GET RESPONSE.
+
+    `feed` appends a chunk to an internal buffer and returns the top-level
+    objects that are complete, so decoding can start before the last chunk
+    has arrived.  Consumed data is dropped from the buffer."""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.offset = 0
+
+    @property
+    def pending(self) -> int:
+        """The number of buffered bytes that are not yet decoded."""
+        return len(self.buffer) - self.offset
+
+    def _header_size(self) -> Optional[int]:
+        """Return the size of the next header or None if it is incomplete."""
+        available = self.pending
+        if available < 1:
+            return None
+        size = 2 if (self.buffer[self.offset] & 0x1F) == 0x1F else 1
+        if available < size + 1:
+            return None
+        l1 = self.buffer[self.offset + size]
+        size += 1 + (l1 - 0x80 if 0x81 <= l1 <= 0x83 else 0)
+        return size if available >= size else None
+
+    def feed(self, chunk: Buffer) -> List[Tuple[int, bytes]]:
+        self.buffer += chunk
+        objects = []
+        while self._header_size() is not None:
+            tag, start = parse_tag(self.buffer, self.offset)
+            length, start = parse_len(self.buffer, start)
+            if start + length > len(self.buffer):
+                break
+            objects.append((tag, bytes(self.buffer[start : start + length])))
+            self.offset = start + length
+
+        # drop the consumed data once it is more than half of the buffer so
+        # that the cost of moving the remaining data stays linear
+        if self.offset > len(self.buffer) // 2:
+            del self.buffer[: self.offset]
+            self.offset = 0
+        return objects
 
-    return tag, rem[:len], rem[len:]
+    def close(self) -> None:
+        """Check that the stream did not end within an object."""
+        if self.pending:
+            raise ValueError(
+                f"Failed to parse TLV data: {self.pending} bytes of incomplete data"
+            )
 
 
 class Tlv:
     @staticmethod
-    def build(input: Sequence[Tuple[int, bytes]]) -> bytes:
-        out = bytearray()
-        for tag, data in input:
-            out += build_one(tag, data)
-        return out
+    def build(input: Sequence[Tuple[int, TlvValue]]) -> bytes:
+        """Build TLV data.  A value may be a sequence of nested objects, which
+        avoids copying the data of nested calls to build."""
+        return TlvBuilder(input).build()
 
     @staticmethod
     def parse(data: bytes) -> Sequence[Tuple[int, bytes]]:
-        res = []
-        current = data
-        while len(current) != 0:
-            tag, value, rem = take_do(current)
-            res.append((tag, value))
-            current = rem
-        return res
+        return [(tag, bytes(value)) for tag, value in iter_tlv(data)]
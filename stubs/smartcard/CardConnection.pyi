@@ -6,3 +6,5 @@ from typing import Tuple
 class CardConnection:
     def connect(self) -> None: ...
     def transmit(self, data: list[int]) -> Tuple[list[int], int, int]: ...
+    def getReader(self) -> str: ...
+    def disconnect(self) -> None: ...
@@ -1,7 +1,7 @@
 # Copyright Nitrokey GmbH
 # SPDX-License-Identifier: Apache-2.0 OR MIT
 
-from typing import Any, Iterable, Sequence
+from typing import Any, Iterable, Sequence, Union
 
 from .core import USBError as USBError
 
@@ -36,6 +36,15 @@ class DeviceHandle:
     def bulkWrite(
         self, endpoint: int, buffer: Sequence[int], timeout: int = 100
     ) -> int: ...
+    def controlMsg(
+        self,
+        requestType: int,
+        request: int,
+        buffer: Union[int, bytes, None],
+        value: int = 0,
+        index: int = 0,
+        timeout: int = 100,
+    ) -> Any: ...
 
 class Bus:
     devices: Sequence[Device]